@@ -0,0 +1,53 @@
+'''Measures the per-call overhead OpenAIWrapper adds to openai.ChatCompletion.create(...).
+
+The wrapped client is a local fake and logging is replaced by a no-op, so only the wrapper itself is timed.
+
+Run with: python benchmarks/bench_openai_wrapper.py [number_of_calls]
+'''
+
+import sys
+import time
+import types
+from wonkalytics import openai_wrapper, utils
+
+
+class FakeChatCompletion:
+    @classmethod
+    def create(cls, **kwargs):
+        return {"id": "chatcmpl-bench", "choices": [{"message": {"role": "assistant", "content": "4"}}]}
+
+
+def main(n=100000):
+    fake_openai = types.ModuleType("openai")
+    fake_openai.ChatCompletion = FakeChatCompletion
+    fake_openai.api_key = "sk-bench"
+
+    # Only time the wrapper, not the logging
+    utils.wonkalytics_and_promptlayer_api_request = lambda *args, **kwargs: "wl_bench"
+    openai_wrapper.api_key = "pl-bench"
+    openai = openai_wrapper.OpenAIWrapper(fake_openai, function_name="openai")
+    messages = [{"role": "user", "content": "2 + 2 ="}]
+
+    start = time.perf_counter()
+    for _ in range(n):
+        FakeChatCompletion.create(model="gpt-4", messages=messages)
+    direct = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(n):
+        openai.ChatCompletion.create(model="gpt-4", messages=messages)
+    wrapped = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(n):
+        openai.api_key
+    attribute = time.perf_counter() - start
+
+    print(
+        f"calls={n} direct_us={direct / n * 1e6:.2f} wrapped_us={wrapped / n * 1e6:.2f} "
+        f"overhead_us={(wrapped - direct) / n * 1e6:.2f} primitive_attribute_us={attribute / n * 1e6:.2f}"
+    )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
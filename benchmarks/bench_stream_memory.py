@@ -0,0 +1,71 @@
+'''Measures the peak memory GeneratorWrapper holds while streaming a long chat completion.
+
+Run with: python benchmarks/bench_stream_memory.py [number_of_chunks]
+'''
+
+import sys
+import time
+import tracemalloc
+from openai.openai_object import OpenAIObject
+from wonkalytics import generator_wrapper
+from wonkalytics.generator_wrapper import GeneratorWrapper
+
+
+def make_chunks(n):
+    """ Yield OpenAI (0.28) style chat completion chunks, like openai.ChatCompletion.create(stream=True). """
+    created = int(time.time())
+    for i in range(n):
+        delta = {"role": "assistant", "content": ""} if i == 0 else {"content": f" token{i}"}
+        yield OpenAIObject.construct_from(
+            {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": "gpt-4-1106-preview",
+                "system_fingerprint": "fp_bench",
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": delta,
+                        "finish_reason": "stop" if i == n - 1 else None,
+                    }
+                ],
+            }
+        )
+
+
+def main(n=4000):
+    logged = []
+    # Capture the logged response instead of sending it anywhere
+    generator_wrapper.wonkalytics_and_promptlayer_api_request = lambda *args, **kwargs: logged.append(args[6])
+    generator_wrapper.get_api_key = lambda: "bench"
+
+    wrapper = GeneratorWrapper(
+        make_chunks(n),
+        {
+            "function_name": "openai.ChatCompletion.create",
+            "provider_type": "openai",
+            "request": None,
+            "args": (),
+            "kwargs": {},
+            "tags": None,
+            "request_start_time": time.time(),
+            "request_end_time": time.time(),
+            "return_pl_id": False,
+        },
+    )
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in wrapper:
+        pass
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert len(logged) == 1
+    print(f"chunks={n} peak_memory_kib={peak / 1024:.1f} per_chunk_us={elapsed / n * 1e6:.2f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 4000)
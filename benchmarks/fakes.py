@@ -0,0 +1,198 @@
+'''Local fakes for the benchmarks: an OpenAI (0.28 style) client, a pyodbc-like connection pool and a PromptLayer stand-in.
+
+Nothing here talks to the network, except the PromptLayer stand-in on 127.0.0.1.
+'''
+
+import contextlib
+import json
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from openai.openai_object import OpenAIObject
+from wonkalytics.schema import ColumnInfo, TableSchema
+
+COLUMNS = {
+    "id": ColumnInfo("id", "nvarchar", -1),
+    "username": ColumnInfo("username", "text", 2147483647),
+    "tenant_id": ColumnInfo("tenant_id", "text", 2147483647),
+    "email": ColumnInfo("email", "text", 2147483647),
+    "timestamp": ColumnInfo("timestamp", "datetime", None),
+    "system_msg": ColumnInfo("system_msg", "text", 2147483647),
+    "messages": ColumnInfo("messages", "text", 2147483647),
+    "model": ColumnInfo("model", "text", 2147483647),
+    "provider_type": ColumnInfo("provider_type", "text", 2147483647),
+    "temperature": ColumnInfo("temperature", "float", None),
+    "response": ColumnInfo("response", "nvarchar", -1),
+    "response_id": ColumnInfo("response_id", "nvarchar", -1),
+    "start_time": ColumnInfo("start_time", "float", None),
+    "end_time": ColumnInfo("end_time", "float", None),
+    "stream_status": ColumnInfo("stream_status", "nvarchar", 20),
+    "finish_reason": ColumnInfo("finish_reason", "nvarchar", 50),
+    "score": ColumnInfo("score", "int", None),
+}
+
+MESSAGES = [
+    {"role": "system", "content": "You are a helpful assistant that answers briefly. " * 20},
+    {"role": "user", "content": "What is 2 + 2?"},
+    {"role": "assistant", "content": "4"},
+    {"role": "user", "content": "And 3 + 3?"},
+]
+
+
+def table_schema(*args, **kwargs):
+    """ Stands in for schema.get_table_schema. """
+    return TableSchema("analytics", COLUMNS, time.monotonic())
+
+
+def completion():
+    return OpenAIObject.construct_from(
+        {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": 1700000000,
+            "model": "gpt-4-1106-preview",
+            "system_fingerprint": "fp_bench",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "6"}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 50, "completion_tokens": 1, "total_tokens": 51},
+        }
+    )
+
+
+def make_chunks(n):
+    """ Yield chat completion chunks, like openai.ChatCompletion.create(stream=True). """
+    chunks = []
+    for i in range(n):
+        delta = {"role": "assistant", "content": ""} if i == 0 else {"content": f" token{i}"}
+        chunks.append(
+            OpenAIObject.construct_from(
+                {
+                    "id": "chatcmpl-bench",
+                    "object": "chat.completion.chunk",
+                    "created": 1700000000,
+                    "model": "gpt-4-1106-preview",
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": "stop" if i == n - 1 else None}],
+                }
+            )
+        )
+    return chunks
+
+
+class FakeChatCompletion:
+    """ openai.ChatCompletion without the network: create/acreate, with stream=True returning (async) generators. """
+
+    chunks = 100
+
+    @classmethod
+    def create(cls, stream=False, **kwargs):
+        if stream:
+            return (chunk for chunk in make_chunks(cls.chunks))
+        return completion()
+
+    @classmethod
+    async def acreate(cls, stream=False, **kwargs):
+        if stream:
+            async def generate():
+                for chunk in make_chunks(cls.chunks):
+                    yield chunk
+
+            return generate()
+        return completion()
+
+
+def fake_openai():
+    """ Returns a module that looks like the openai (0.28) module. """
+    module = types.ModuleType("openai")
+    module.ChatCompletion = FakeChatCompletion
+    module.api_key = "sk-bench"
+    return module
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.fast_executemany = False
+        self.rowcount = 0
+
+    def execute(self, sql, params=()):
+        self.connection.statements += 1
+        self.rowcount = 1
+
+    def executemany(self, sql, rows):
+        self.connection.statements += 1
+        self.rowcount = len(rows)
+
+    def fetchall(self):
+        return []
+
+
+class FakeConnection:
+    """ A pyodbc connection that accepts every statement. """
+
+    def __init__(self):
+        self.statements = 0
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+
+class FakePool:
+    """ Stands in for pool.ConnectionPool, with a single fake connection. """
+
+    def __init__(self):
+        self.cnxn = FakeConnection()
+        self._lock = threading.Lock()
+
+    def run(self, func, retries: int = 1):
+        with self._lock:
+            return func(self.cnxn)
+
+
+@contextlib.contextmanager
+def promptlayer_stand_in():
+    """ Serve a local PromptLayer track-request endpoint, yields its url and the number of events received. """
+    received = [0]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # The response headers and body are written separately, without this delayed ACKs add ~40ms per request
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            received[0] += 1
+            response = b'{"success": true}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}", received
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@contextlib.contextmanager
+def patched(target, **attributes):
+    """ Temporarily replace attributes of a module or object. """
+    originals = {name: getattr(target, name) for name in attributes}
+    for name, value in attributes.items():
+        setattr(target, name, value)
+    try:
+        yield
+    finally:
+        for name, value in originals.items():
+            setattr(target, name, value)
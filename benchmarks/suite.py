@@ -0,0 +1,278 @@
+'''The Wonkalytics benchmark suite: wrapper, stream and sink overhead, measured against local fakes.
+
+Every benchmark reports one or more metrics, written as JSON so runs can be compared:
+
+    python benchmarks/suite.py --output results.json
+    python benchmarks/suite.py --baseline results.json --tolerance 0.25   # exits with 1 on a regression
+    python benchmarks/suite.py --only wrapper_call stream_chunk --scale 0.1
+
+Time metrics are the best of --repeat runs, so background noise inflates them as little as possible.
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakes  # noqa: E402
+import wonkalytics  # noqa: E402
+from wonkalytics import analytics, config, generator_wrapper, openai_wrapper, promptlayer, utils  # noqa: E402
+from wonkalytics.generator_wrapper import GeneratorWrapper  # noqa: E402
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__.removeprefix("bench_")] = func
+    return func
+
+
+def metric(value, unit, better="lower"):
+    return {"value": round(value, 3), "unit": unit, "better": better}
+
+
+def best_of(repeat, func, n):
+    """ Returns the lowest seconds per operation of 'repeat' runs of func(n). """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(n)
+        best = min(best, (time.perf_counter() - start) / n)
+    return best
+
+
+def _noop_log(*args, **kwargs):
+    return "wl_bench"
+
+
+@benchmark
+def bench_wrapper_call(n, repeat):
+    """ Overhead of OpenAIWrapper.__call__ on openai.ChatCompletion.create, logging excluded. """
+    openai = openai_wrapper.OpenAIWrapper(fakes.fake_openai(), function_name="openai")
+    messages = fakes.MESSAGES
+
+    def direct(n):
+        for _ in range(n):
+            fakes.FakeChatCompletion.create(model="gpt-4", messages=messages)
+
+    def wrapped(n):
+        for _ in range(n):
+            openai.ChatCompletion.create(model="gpt-4", messages=messages)
+
+    with fakes.patched(utils, wonkalytics_and_promptlayer_api_request=_noop_log):
+        overhead = best_of(repeat, wrapped, n) - best_of(repeat, direct, n)
+    return {"overhead": metric(overhead * 1e6, "us/call")}
+
+
+@benchmark
+def bench_async_wrapper_call(n, repeat):
+    """ Overhead of OpenAIWrapper.__call__ on openai.ChatCompletion.acreate, logging excluded. """
+    openai = openai_wrapper.OpenAIWrapper(fakes.fake_openai(), function_name="openai")
+    messages = fakes.MESSAGES
+
+    async def direct(n):
+        for _ in range(n):
+            await fakes.FakeChatCompletion.acreate(model="gpt-4", messages=messages)
+
+    async def wrapped(n):
+        for _ in range(n):
+            await openai.ChatCompletion.acreate(model="gpt-4", messages=messages)
+
+    loop = asyncio.new_event_loop()
+    try:
+        with fakes.patched(utils, submit_analytics_request=_noop_log):
+            overhead = best_of(repeat, lambda n: loop.run_until_complete(wrapped(n)), n) - best_of(
+                repeat, lambda n: loop.run_until_complete(direct(n)), n
+            )
+    finally:
+        loop.close()
+    return {"overhead": metric(overhead * 1e6, "us/call")}
+
+
+@benchmark
+def bench_stream_chunk(n, repeat):
+    """ Overhead GeneratorWrapper adds per streamed chunk, logging excluded. """
+    chunks = fakes.make_chunks(1000)
+    runs = max(1, n // len(chunks))
+    arguments = {
+        "function_name": "openai.ChatCompletion.create",
+        "provider_type": "openai",
+        "request": None,
+        "args": (),
+        "kwargs": {"model": "gpt-4", "messages": fakes.MESSAGES},
+        "tags": None,
+        "request_start_time": time.time(),
+        "request_end_time": time.time(),
+        "return_pl_id": False,
+    }
+
+    def direct(runs):
+        for _ in range(runs):
+            for _ in iter(chunks):
+                pass
+
+    def wrapped(runs):
+        for _ in range(runs):
+            for _ in GeneratorWrapper(iter(chunks), arguments):
+                pass
+
+    with fakes.patched(generator_wrapper, wonkalytics_and_promptlayer_api_request=_noop_log, get_api_key=lambda: "bench"):
+        overhead = best_of(repeat, wrapped, runs) - best_of(repeat, direct, runs)
+    return {"overhead": metric(overhead / len(chunks) * 1e6, "us/chunk")}
+
+
+def _sql_item(i):
+    event = analytics._build_analytics_event(
+        "openai.ChatCompletion.create", "openai", [], {"model": "gpt-4", "temperature": 0.2, "messages": fakes.MESSAGES},
+        ["bench"], fakes.completion(), 1700000000.0, 1700000001.0, "pl-bench", None,
+    )
+    return dict(event, request={"auth_info": None}, id=f"wl_{i}")
+
+
+@benchmark
+def bench_projection(n, repeat):
+    """ Throughput of _item_to_analytics_log, projecting an event onto the table's columns. """
+    item = _sql_item(0)
+
+    def project(n):
+        for _ in range(n):
+            analytics._item_to_analytics_log(item, "server", "db", "user", "password", "analytics")
+
+    with fakes.patched(analytics, get_table_schema=fakes.table_schema):
+        seconds = best_of(repeat, project, n)
+    return {"events_per_sec": metric(1 / seconds, "events/s", better="higher")}
+
+
+@benchmark
+def bench_end_to_end(n, repeat):
+    """ Events per second through wonkalytics_and_promptlayer_api_request, to a local PromptLayer and a fake SQL pool. """
+    n = max(1, n // 20)
+    pool = fakes.FakePool()
+    config.configure(server="server", database="db", username="user", password="password", table_name="analytics")
+    response = fakes.completion()
+    kwargs = {"model": "gpt-4", "temperature": 0.2, "messages": fakes.MESSAGES}
+
+    def log(n):
+        for _ in range(n):
+            analytics.wonkalytics_and_promptlayer_api_request(
+                "openai.ChatCompletion.create", "openai", [], kwargs, ["bench"], {"auth_info": None},
+                response, 1700000000.0, 1700000001.0, "pl-bench",
+            )
+
+    try:
+        with fakes.promptlayer_stand_in() as (url, received):
+            promptlayer.configure_promptlayer(url)
+            with fakes.patched(analytics, get_table_schema=fakes.table_schema, get_pool=lambda *args: pool):
+                seconds = best_of(repeat, log, n)
+            assert received[0] == n * repeat, "not every event reached the PromptLayer stand-in"
+    finally:
+        config.reset_config()
+        promptlayer.configure_promptlayer()
+    return {"events_per_sec": metric(1 / seconds, "events/s", better="higher")}
+
+
+def _import_seconds(statement, repeat):
+    """ Returns the lowest wall time of 'repeat' fresh interpreters running 'statement'. """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")])))
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], check=True, env=environment)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+@benchmark
+def bench_import(n, repeat):
+    """ Cold start: the time 'import wonkalytics.openai_wrapper' adds to starting the interpreter. """
+    baseline = _import_seconds("pass", repeat)
+    package = max(0.0, _import_seconds("import wonkalytics", repeat) - baseline)
+    wrapper = max(0.0, _import_seconds("import wonkalytics.openai_wrapper", repeat) - baseline)
+    return {"package": metric(package * 1e3, "ms"), "openai_wrapper": metric(wrapper * 1e3, "ms")}
+
+
+def run(names=None, scale=1.0, repeat=5):
+    """
+    Run the benchmarks.
+
+    Args:
+        names (list, optional): The benchmarks to run, defaults to all of them.
+        scale (float): Multiplies the number of operations per run, lower is faster and noisier.
+        repeat (int): Number of runs per measurement, the best is reported.
+
+    Returns:
+        dict: The machine readable results.
+    """
+    n = max(1, int(20000 * scale))
+    # The PromptLayer api key the wrapper passes on, normally set by the application
+    openai_wrapper.api_key = "pl-bench"
+    results = {}
+    for name in names or BENCHMARKS:
+        results[name] = BENCHMARKS[name](n, repeat)
+    return {
+        "wonkalytics": wonkalytics.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    Compare results with a baseline run.
+
+    Returns:
+        list: A description of every metric that got worse by more than 'tolerance' (a fraction).
+    """
+    regressions = []
+    for name, metrics in results["results"].items():
+        for key, current in metrics.items():
+            previous = baseline.get("results", {}).get(name, {}).get(key)
+            if previous is None or not previous["value"]:
+                continue
+            change = (current["value"] - previous["value"]) / abs(previous["value"])
+            if current["better"] == "higher":
+                change = -change
+            if change > tolerance:
+                regressions.append(
+                    f"{name}.{key}: {previous['value']} -> {current['value']} {current['unit']} ({change:+.0%} worse)"
+                )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="Run only these benchmarks.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply the number of operations per run.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement, the best one is reported.")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare with the results in this JSON file.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown against the baseline, as a fraction.")
+    args = parser.parse_args(argv)
+
+    results = run(args.only, args.scale, args.repeat)
+    for name, metrics in results["results"].items():
+        print(name, " ".join(f"{key}={m['value']}{m['unit']}" for key, m in metrics.items()))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+# test_async_analytics.py
+import asyncio
+import threading
+import time
+import pytest
+from wonkalytics import analytics, async_analytics
+from wonkalytics.config import Config
+
+
+@pytest.mark.asyncio
+async def test_logging_does_not_block_the_event_loop(monkeypatch):
+    sent = []
+
+    async def slow_promptlayer(event):
+        await asyncio.sleep(0.2)
+        sent.append(("promptlayer", event.event["function_name"]))
+
+    def slow_sql(item):
+        time.sleep(0.2)
+        sent.append(("sql", item["id"], threading.current_thread().name))
+
+    monkeypatch.setattr(analytics, "get_dispatcher", lambda: None)
+    monkeypatch.setattr(async_analytics, "atrack_request", slow_promptlayer)
+    monkeypatch.setattr(async_analytics, "_write_to_azure_sql", slow_sql)
+
+    start = time.perf_counter()
+    uid = async_analytics.submit_analytics_request(
+        "openai.ChatCompletion.acreate", "openai", (), {"model": "gpt-4"}, None, None, {}, 0.0, 0.0, "key"
+    )
+    assert time.perf_counter() - start < 0.05
+    assert uid.startswith("wl_")
+
+    # The loop stays responsive while the event is sent
+    ticks = 0
+    while not await async_analytics.aflush(timeout=0.01):
+        ticks += 1
+    assert ticks > 10
+    assert sent[0] == ("promptlayer", "openai.ChatCompletion.acreate")
+    assert sent[1][:2] == ("sql", uid)
+    assert sent[1][2].startswith("wonkalytics-sql")
+
+
+@pytest.mark.asyncio
+async def test_hand_off_runs_on_the_executor_and_overflow_is_dropped(monkeypatch):
+    handed_off = []
+    dropped = []
+
+    def slow_hand_off(json_post_dict, request, uid, timestamp):
+        # Like a collector send that waits for its timeout
+        time.sleep(0.2)
+        handed_off.append((uid, threading.current_thread().name))
+        return True
+
+    monkeypatch.setattr(async_analytics, "_hand_off_event", slow_hand_off)
+    monkeypatch.setattr(async_analytics, "count_dropped", dropped.append)
+    monkeypatch.setattr(async_analytics, "get_config", lambda: Config(async_max_pending=2))
+
+    start = time.perf_counter()
+    uids = [
+        async_analytics.submit_analytics_request(
+            "openai.ChatCompletion.acreate", "openai", (), {"model": "gpt-4"}, None, None, {}, 0.0, 0.0, "key"
+        )
+        for _ in range(3)
+    ]
+    assert time.perf_counter() - start < 0.05
+    assert dropped == ["queue_full"]
+
+    assert await async_analytics.aflush(timeout=5)
+    assert sorted(uid for uid, _ in handed_off) == sorted(uids[:2])
+    assert all(name.startswith("wonkalytics-sql") for _, name in handed_off)
+    # The slots are free again
+    assert async_analytics._pending_events == 0
@@ -0,0 +1,97 @@
+# test_batch.py
+import pyodbc
+from wonkalytics.batch import BatchWriter
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.fast_executemany = False
+
+    def execute(self, sql, values):
+        self.executemany(sql, [values])
+
+    def executemany(self, sql, rows):
+        if "dropped" in sql:
+            raise pyodbc.ProgrammingError("42S22", "Invalid column name 'dropped'. (207) (SQLExecDirectW)")
+        for values in rows:
+            if "bad" in values:
+                raise ValueError("String data, right truncation")
+        self.connection.pending.append((sql, rows))
+
+
+class FakeConnection:
+    def __init__(self):
+        self.pending = []
+        self.committed = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.committed.append(self.pending)
+        self.pending = []
+
+
+class FakePool:
+    def __init__(self):
+        self.cnxn = FakeConnection()
+
+    def run(self, func):
+        self.cnxn.pending = []
+        return func(self.cnxn)
+
+
+def test_rows_are_grouped_by_column_set_and_written_per_batch():
+    pool = FakePool()
+    writer = BatchWriter(batch_size=10, max_latency=60)
+    for i in range(3):
+        writer.add(pool, "logs", {"id": f"wl_{i}", "model": "gpt-4"})
+    writer.add(pool, "logs", {"model": "gpt-4", "id": "wl_3", "score": 1})
+
+    assert writer.flush(timeout=5) == True
+    assert len(pool.cnxn.committed) == 2  # One transaction per column set
+    statements = sorted(sql for transaction in pool.cnxn.committed for sql, _ in transaction)
+    assert statements[0] == "INSERT INTO [logs] (id, model) VALUES (?, ?)"
+    assert writer.rows_written == 4
+    writer.close()
+
+
+def test_bad_row_does_not_drop_the_batch():
+    pool = FakePool()
+    writer = BatchWriter(batch_size=3, max_latency=60)
+    writer.add(pool, "logs", {"id": "wl_1"})
+    writer.add(pool, "logs", {"id": "bad"})
+    writer.add(pool, "logs", {"id": "wl_3"})
+
+    assert writer.flush(timeout=5) == True
+    assert writer.rows_written == 2
+    assert writer.rows_failed == 1
+    writer.close()
+
+
+def test_close_writes_rows_that_are_not_due_and_refuses_new_ones():
+    pool = FakePool()
+    writer = BatchWriter(batch_size=10, max_latency=60)
+    writer.add(pool, "logs", {"id": "wl_1"})
+    # The flush thread stops on its own once closed, without a flush() first
+    with writer._cond:
+        writer._closed = True
+        writer._cond.notify_all()
+    writer._thread.join(5)
+    assert writer.rows_written == 1
+    assert writer.add(pool, "logs", {"id": "wl_2"}) == False
+
+
+def test_rows_are_retried_with_the_reloaded_columns():
+    pool = FakePool()
+    failed = []
+    writer = BatchWriter(batch_size=2, max_latency=60, on_failure=lambda table, row, error: failed.append(row) or True)
+    writer.add(pool, "logs", {"id": "wl_1", "dropped": "x"}, lambda: {"id"})
+    writer.add(pool, "logs", {"id": "bad", "dropped": "y"}, lambda: {"id"})
+
+    assert writer.flush(timeout=5) == True
+    statements = [sql for transaction in pool.cnxn.committed for sql, _ in transaction]
+    assert statements == ["INSERT INTO [logs] (id) VALUES (?)"]
+    assert failed == [{"id": "bad"}]
+    writer.close()
@@ -0,0 +1,120 @@
+# test_breaker.py
+import time
+import pyodbc
+import pytest
+from wonkalytics import analytics, breaker, spool
+from wonkalytics.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+from wonkalytics.config import Config
+from wonkalytics.pool import ConnectionPool, is_transient_sql_error
+
+
+class FakeConnection:
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    monkeypatch.setattr(pyodbc, "connect", lambda connection_string: FakeConnection())
+
+
+@pytest.fixture
+def breakers():
+    yield breaker.enable_circuit_breakers(failure_threshold=2, reset_timeout=0.1)
+    breaker.disable_circuit_breakers()
+
+
+def failing(error):
+    def func(*args):
+        raise error
+    return func
+
+
+def test_breaker_opens_probes_and_closes():
+    transitions = []
+    circuit = CircuitBreaker("sql", failure_threshold=2, reset_timeout=0.1)
+    circuit.add_listener(lambda *transition: transitions.append(transition))
+
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            circuit.call(failing(ConnectionError("down")))
+    assert circuit.state == OPEN
+
+    start = time.perf_counter()
+    with pytest.raises(CircuitOpenError):
+        circuit.call(lambda: "not called")
+    assert time.perf_counter() - start < 0.001
+    assert circuit.rejected == 1
+
+    time.sleep(0.15)
+    assert circuit.state == HALF_OPEN
+    # A failed probe opens it again, for twice as long
+    with pytest.raises(ConnectionError):
+        circuit.call(failing(ConnectionError("still down")))
+    time.sleep(0.15)
+    with pytest.raises(CircuitOpenError):
+        circuit.call(lambda: "not called")
+    time.sleep(0.15)
+    assert circuit.call(lambda: "up") == "up"
+    assert circuit.state == CLOSED
+    assert transitions == [
+        ("sql", CLOSED, OPEN), ("sql", OPEN, HALF_OPEN), ("sql", HALF_OPEN, OPEN),
+        ("sql", OPEN, HALF_OPEN), ("sql", HALF_OPEN, CLOSED),
+    ]
+
+
+def test_rejected_rows_do_not_open_the_breaker():
+    circuit = CircuitBreaker("sql", failure_threshold=1)
+    with pytest.raises(pyodbc.IntegrityError):
+        circuit.call(failing(pyodbc.IntegrityError("23000", "Violation of PRIMARY KEY constraint")))
+    assert circuit.state == CLOSED
+
+
+def test_environment_enables_the_breakers_until_disabled(monkeypatch):
+    monkeypatch.setattr(breaker, "get_config", lambda: Config(circuit_breakers=True))
+    monkeypatch.setattr(breaker._breakers, "_disabled", False)
+    sql_breaker = breaker.get_breaker("sql")
+    assert sql_breaker is not None and breaker.get_breaker("sql") is sql_breaker
+    breaker.disable_circuit_breakers()
+    assert breaker.get_breaker("sql") is None
+
+
+def test_transient_sql_errors_are_retried(connections):
+    pool = ConnectionPool("fake", retry_delay=0.01)
+    attempts = []
+
+    def work(cnxn):
+        attempts.append(cnxn)
+        if len(attempts) < 3:
+            raise pyodbc.OperationalError("42000", "Database 'analytics' on server is not currently available. (40613) (SQLExecDirectW)")
+        return "ok"
+
+    assert pool.run(work) == "ok"
+    assert len(attempts) == 3
+    assert not is_transient_sql_error(pyodbc.ProgrammingError("42S22", "Invalid column name 'foo'. (207) (SQLExecDirectW)"))
+
+    with pytest.raises(pyodbc.OperationalError):
+        pool.run(failing(pyodbc.OperationalError("40001", "Transaction was deadlocked (1205)")))
+
+
+def test_open_sql_breaker_rejects_and_spools(connections, breakers, monkeypatch, tmp_path):
+    pool = ConnectionPool("fake")
+    timeout = failing(pyodbc.OperationalError("HYT00", "Login timeout expired"))
+    for _ in range(2):
+        with pytest.raises(pyodbc.OperationalError):
+            pool.run(timeout)
+    assert breaker.breaker_states() == {"sql": OPEN, "promptlayer": CLOSED}
+
+    spool.enable_spool(path=str(tmp_path / "spool.db"), replay_interval=60)
+    monkeypatch.setattr(analytics, "track_request", lambda event: None)
+    monkeypatch.setattr(analytics, "_write_to_azure_sql", lambda item: pool.run(lambda cnxn: None))
+    try:
+        start = time.perf_counter()
+        analytics._send_analytics_event({"function_name": "f"}, None, "wl_1")
+        assert time.perf_counter() - start < 0.05
+        assert spool.get_spool().stats()["events"] == {"sql": 1}
+    finally:
+        spool.disable_spool()
@@ -0,0 +1,182 @@
+# test_cache.py
+import asyncio
+import threading
+import time
+import types
+import pytest
+from openai.openai_object import OpenAIObject
+from wonkalytics import cache, generator_wrapper, openai_wrapper, utils
+from wonkalytics.cache import ResponseCache, SqliteResponseStore, cache_key
+from wonkalytics.config import Config
+from wonkalytics.generator_wrapper import STREAM_TIMING_COLUMNS
+from wonkalytics.openai_wrapper import OpenAIWrapper
+
+
+class FakeChatCompletion:
+    calls = 0
+    delay = 0.0
+
+    @classmethod
+    def create(cls, **kwargs):
+        cls.calls += 1
+        time.sleep(cls.delay)
+        if kwargs.get("stream"):
+            return cls._stream(kwargs["messages"][-1]["content"])
+        return OpenAIObject.construct_from({"id": f"chatcmpl-{cls.calls}", "choices": [{"message": {"content": "hi"}}]})
+
+    @classmethod
+    async def acreate(cls, **kwargs):
+        cls.calls += 1
+        await asyncio.sleep(cls.delay)
+        return OpenAIObject.construct_from({"id": f"chatcmpl-{cls.calls}", "choices": []})
+
+    @staticmethod
+    def _stream(content):
+        for delta, finish_reason in [({"role": "assistant"}, None), ({"content": content}, None), ({}, "stop")]:
+            yield OpenAIObject.construct_from({"id": "chatcmpl-s", "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]})
+
+
+@pytest.fixture
+def logged(monkeypatch):
+    logged = []
+
+    def log(*args, **kwargs):
+        metadata = {k: v for k, v in (kwargs.get("metadata") or {}).items() if k not in STREAM_TIMING_COLUMNS}
+        logged.append(metadata)
+        return "wl_test"
+
+    for module in (utils, generator_wrapper):
+        monkeypatch.setattr(module, "wonkalytics_and_promptlayer_api_request", log)
+        monkeypatch.setattr(module, "submit_analytics_request", log)
+    monkeypatch.setattr(openai_wrapper, "api_key", "test", raising=False)
+    FakeChatCompletion.calls = 0
+    FakeChatCompletion.delay = 0.0
+    yield logged
+    cache.disable_response_cache()
+
+
+def make_openai():
+    fake_openai = types.ModuleType("openai")
+    fake_openai.ChatCompletion = FakeChatCompletion
+    return OpenAIWrapper(fake_openai, function_name="openai")
+
+
+MESSAGES = [{"role": "user", "content": "Hello"}]
+
+
+def test_cache_key_is_canonical():
+    key = cache_key("f", "openai", (), {"model": "gpt-4", "messages": MESSAGES, "temperature": 0})
+    assert key == cache_key("f", "openai", (), {"temperature": 0, "messages": MESSAGES, "model": "gpt-4", "timeout": 5})
+    assert key != cache_key("f", "openai", (), {"model": "gpt-4", "messages": MESSAGES, "temperature": 0, "seed": 1})
+    assert cache_key("f", "openai", (), {"functions": [object()]}) is None
+
+    response_cache = ResponseCache()
+    assert response_cache.key("openai.ChatCompletion.create", "openai", (), {"temperature": 0.7}) is None
+    assert response_cache.key("openai.Embedding.create", "openai", (), {"input": "x"}) is not None
+
+
+def test_hits_are_served_from_memory_and_logged(logged):
+    cache.enable_response_cache()
+    openai = make_openai()
+    first = openai.ChatCompletion.create(model="gpt-4", messages=MESSAGES, temperature=0, pl_tags=["a"])
+    first["choices"][0]["message"]["content"] = "changed by the caller"
+    second = openai.ChatCompletion.create(model="gpt-4", messages=MESSAGES, temperature=0, pl_tags=["b"])
+    openai.ChatCompletion.create(model="gpt-4", messages=MESSAGES, temperature=1)
+
+    assert FakeChatCompletion.calls == 2
+    assert second["id"] == "chatcmpl-1" and second["choices"][0]["message"]["content"] == "hi"
+    assert logged == [{"cache_hit": False}, {"cache_hit": True}, {}]
+    assert cache.get_response_cache().stats() == {"hits": 1, "misses": 1, "coalesced": 0, "entries": 1}
+
+
+def test_concurrent_calls_share_one_upstream_call(logged):
+    cache.enable_response_cache()
+    openai = make_openai()
+    FakeChatCompletion.delay = 0.2
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(openai.ChatCompletion.create(model="gpt-4", messages=MESSAGES, temperature=0)))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert FakeChatCompletion.calls == 1
+    assert {result["id"] for result in results} == {"chatcmpl-1"}
+    assert sorted(metadata["cache_hit"] for metadata in logged) == [False] + [True] * 7
+
+
+def test_streams_are_replayed(logged):
+    cache.enable_response_cache()
+    openai = make_openai()
+    partial = openai.ChatCompletion.create(model="gpt-4", messages=MESSAGES, temperature=0, stream=True)
+    next(partial)
+    partial.close()  # Not cached, the stream did not finish
+
+    for _ in range(3):
+        stream = openai.ChatCompletion.create(model="gpt-4", messages=MESSAGES, temperature=0, stream=True)
+        assert [chunk["choices"][0]["delta"].get("content") for chunk in stream] == [None, "Hello", None]
+
+    assert FakeChatCompletion.calls == 2
+    assert [metadata["cache_hit"] for metadata in logged] == [False, False, True, True]
+    assert [metadata["stream_status"] for metadata in logged] == ["aborted", "completed", "completed", "completed"]
+
+
+def test_disk_tier_and_ttl(tmp_path):
+    store = SqliteResponseStore(str(tmp_path / "responses.db"))
+    ResponseCache(store=store).put("key", {"id": 1})
+    # A new process only has the disk tier
+    assert ResponseCache(store=store).get("key") == {"id": 1}
+
+    expiring = ResponseCache(ttl=0.05, store=store)
+    expiring.put("other", {"id": 2})
+    time.sleep(0.1)
+    assert expiring.get("other") is None
+    assert store.get("other") is None
+    store.close()
+
+
+@pytest.mark.asyncio
+async def test_async_calls_are_coalesced(logged):
+    cache.enable_response_cache()
+    openai = make_openai()
+    FakeChatCompletion.delay = 0.1
+    results = await asyncio.gather(
+        *(openai.ChatCompletion.acreate(model="gpt-4", messages=MESSAGES, temperature=0) for _ in range(5))
+    )
+    assert FakeChatCompletion.calls == 1
+    assert {result["id"] for result in results} == {"chatcmpl-1"}
+    assert sorted(metadata["cache_hit"] for metadata in logged) == [False] + [True] * 4
+
+
+@pytest.mark.asyncio
+async def test_sync_function_returning_a_coroutine_is_cached_as_async(logged):
+    cache.enable_response_cache()
+    fake_openai = types.ModuleType("openai")
+    # E.g. a client method that is not a coroutine function itself
+    fake_openai.acreate = lambda **kwargs: FakeChatCompletion.acreate(**kwargs)
+    openai = OpenAIWrapper(fake_openai, function_name="openai")
+
+    first = openai.acreate(model="gpt-4", messages=MESSAGES, temperature=0)
+    assert (await first)["id"] == "chatcmpl-1"
+    # The hit is awaitable too, like the call it was cached from
+    second = openai.acreate(model="gpt-4", messages=MESSAGES, temperature=0)
+    assert (await second)["id"] == "chatcmpl-1"
+    assert FakeChatCompletion.calls == 1
+    assert [metadata["cache_hit"] for metadata in logged] == [False, True]
+
+
+def test_environment_enables_one_cache_until_disabled(monkeypatch):
+    monkeypatch.setattr(cache, "get_config", lambda: Config(response_cache=True))
+    monkeypatch.setattr(cache._cache, "_disabled", False)
+    caches = []
+    threads = [threading.Thread(target=lambda: caches.append(cache.get_response_cache())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(response_cache) for response_cache in caches}) == 1
+    cache.disable_response_cache()
+    assert cache.get_response_cache() is None
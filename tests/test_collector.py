@@ -0,0 +1,99 @@
+# test_collector.py
+import io
+import os
+import socket
+import tempfile
+import threading
+import time
+from datetime import datetime
+import pytest
+from wonkalytics import analytics, collector
+from wonkalytics.collector import Collector, CollectorClient, encode_frame, read_frame
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="needs Unix domain sockets")
+
+
+@pytest.fixture
+def socket_path():
+    # Unix socket paths are limited to ~100 characters, pytest's tmp_path can be longer
+    with tempfile.TemporaryDirectory() as directory:
+        yield os.path.join(directory, "collector.sock")
+
+
+@pytest.fixture
+def running(socket_path, monkeypatch):
+    sent = []
+    monkeypatch.setattr(analytics, "_send_analytics_event", lambda *args: sent.append(args))
+    monkeypatch.setattr("wonkalytics.dispatcher.get_dispatcher", lambda: None)
+    server = Collector(socket_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, sent
+    server.shutdown()
+    thread.join(5)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_frames_round_trip():
+    timestamp = datetime(2024, 1, 2, 3, 4, 5)
+    stream = io.BytesIO(
+        encode_frame({"kwargs": {"model": "gpt-4"}}, {"auth_info": None}, "wl_1", timestamp)
+        + encode_frame({}, None, "wl_2", None)
+    )
+    first = read_frame(stream)
+    assert first == {"event": {"kwargs": {"model": "gpt-4"}}, "request": {"auth_info": None}, "id": "wl_1", "timestamp": timestamp}
+    assert read_frame(stream)["id"] == "wl_2"
+    assert read_frame(stream) is None
+
+    with pytest.raises(ValueError):
+        read_frame(io.BytesIO(encode_frame({}, None, "wl_3", None)[:-1]))
+
+
+def test_events_reach_the_collector(running, socket_path):
+    server, sent = running
+    client = CollectorClient(socket_path)
+    for i in range(50):
+        assert client.send({"function_name": "f"}, None, f"wl_{i}", None)
+    client.close()
+    assert wait_for(lambda: len(sent) == 50)
+    assert [args[2] for args in sent] == [f"wl_{i}" for i in range(50)]
+    assert server.received == 50
+
+
+def test_falls_back_to_direct_writes_without_collector(socket_path, monkeypatch):
+    sent = []
+    monkeypatch.setattr(analytics, "_send_analytics_event", lambda *args: sent.append(args))
+    monkeypatch.setattr(analytics, "get_dispatcher", lambda: None)
+    collector.enable_collector_client(socket_path, retry_interval=60)
+    try:
+        uid = analytics.wonkalytics_and_promptlayer_api_request(
+            "f", "openai", [], {}, None, None, {}, 0.0, 1.0, "key"
+        )
+        client = collector.get_collector_client()
+    finally:
+        collector.disable_collector_client()
+    assert len(sent) == 1 and sent[0][2] == uid
+    assert client.failed == 1 and client.sent == 0
+
+
+def test_refuses_to_replace_a_running_collector(running, socket_path):
+    with pytest.raises(RuntimeError):
+        Collector(socket_path)
+
+
+def test_oversized_events_are_written_directly(running, socket_path, monkeypatch):
+    server, sent = running
+    monkeypatch.setattr(collector, "MAX_FRAME_SIZE", 1024)
+    client = CollectorClient(socket_path)
+    assert client.send({"function_name": "f", "kwargs": {"prompt": "x" * 2048}}, None, "wl_big", None) == False
+    # The connection is not affected, the next event still reaches the collector
+    assert client.send({"function_name": "f"}, None, "wl_small", None)
+    client.close()
+    assert wait_for(lambda: len(sent) == 1)
+    assert sent[0][2] == "wl_small" and client.failed == 1
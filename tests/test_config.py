@@ -0,0 +1,97 @@
+# test_config.py
+import os
+import subprocess
+import sys
+import pytest
+from wonkalytics import config
+
+
+@pytest.fixture(autouse=True)
+def fresh_config():
+    config.reset_config()
+    yield
+    config.reset_config()
+
+
+def test_environment_is_read_once(monkeypatch):
+    monkeypatch.setenv("AZURE_TABLE_NAME", "analytics")
+    monkeypatch.setenv("WONKALYTICS_SAMPLE_RATE", "0.5")
+    first = config.get_config()
+    assert first.table_name == "analytics" and first.sample_rate == 0.5
+
+    monkeypatch.setenv("AZURE_TABLE_NAME", "other")
+    assert config.get_config() is first
+
+    updated = config.configure(server="tcp:example,1433")
+    assert updated.server == "tcp:example,1433" and updated.table_name == "analytics"
+    assert config.get_config() is updated
+    config.reset_config()
+    assert config.get_config().table_name == "other"
+    with pytest.raises(TypeError):
+        config.configure(tabel_name="typo")
+
+
+def test_configure_keeps_earlier_settings():
+    config.configure(table_name="analytics_staging")
+    updated = config.configure(schema_ttl=60.0)
+    assert updated.table_name == "analytics_staging" and updated.schema_ttl == 60.0
+
+
+def test_missing_sql_settings_are_named():
+    settings = config.Config(server="server", database="db", username="user")
+    with pytest.raises(EnvironmentError, match="AZURE_SQL_PASSWORD, AZURE_TABLE_NAME"):
+        settings.require_sql()
+
+
+def test_import_does_not_load_clients():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    statement = (
+        "import sys, wonkalytics, wonkalytics.openai_wrapper;"
+        "print(sorted(m for m in ('pyodbc', 'requests', 'httpx', 'dotenv') if m in sys.modules))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", statement], cwd=root, capture_output=True, text=True, check=True
+    ).stdout
+    assert output.strip() == "[]"
+
+
+def test_configure_rebuilds_the_promptlayer_client_and_projection_plans(monkeypatch):
+    from wonkalytics import projection, promptlayer
+    from wonkalytics.schema import ColumnInfo, TableSchema
+
+    monkeypatch.setattr(promptlayer, "_client", None)
+    first = promptlayer.get_promptlayer_client()
+    config.configure(promptlayer_read_timeout=1.5)
+    rebuilt = promptlayer.get_promptlayer_client()
+    assert rebuilt is not first and rebuilt.timeout[1] == 1.5
+    # Changing other settings keeps the client
+    config.configure(promptlayer_read_timeout=1.5, table_name="other")
+    assert promptlayer.get_promptlayer_client() is rebuilt
+
+    schema = TableSchema("logs", {"content": ColumnInfo("content", "nvarchar", -1)}, 0.0)
+    config.configure(max_text_length=100)
+    assert projection.get_projection_plan(schema).limits == {"content": 100}
+    config.configure(max_text_length=0)
+    assert projection.get_projection_plan(schema).limits == {}
+    promptlayer.get_promptlayer_client().close()
+
+
+def test_lazy_singleton_is_created_once_until_cleared():
+    created = []
+    singleton = None
+
+    def create():
+        created.append(object())
+        singleton.set(created[-1])
+        return created[-1]
+
+    singleton = config.LazySingleton(lambda: True, create)
+    assert singleton.value is None
+    first = singleton.get()
+    assert singleton.get() is first and created == [first]
+
+    assert singleton.clear() is first
+    # An explicit clear wins over the settings until the next set
+    assert singleton.get() is None and singleton.value is None
+    assert singleton.set("explicit") is None and singleton.get() == "explicit"
+    assert len(created) == 1
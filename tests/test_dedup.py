@@ -0,0 +1,60 @@
+# test_dedup.py
+from wonkalytics import dedup
+from wonkalytics.config import Config
+from wonkalytics.dedup import REFERENCE_PREFIX, ContentDeduplicator, SqliteBlobStore
+from wonkalytics.projection import AnalyticsRow
+
+
+class CountingStore(SqliteBlobStore):
+    def __init__(self, path):
+        super().__init__(path)
+        self.uploads = 0
+
+    def put_many(self, pool, blobs):
+        self.uploads += 1
+        super().put_many(pool, blobs)
+
+
+def test_repeated_system_prompt_is_stored_once(tmp_path):
+    store = CountingStore(str(tmp_path / "blobs.db"))
+    deduplicator = ContentDeduplicator(store, fields=("system_msg",), min_size=100)
+    system_msg = "You are a helpful assistant. " * 20
+
+    rows = [
+        deduplicator.dedup(AnalyticsRow(("id", "system_msg"), [f"wl_{i}", system_msg]))
+        for i in range(3)
+    ]
+
+    references = {row.values[1] for row in rows}
+    assert len(references) == 1
+    reference = references.pop()
+    assert reference.startswith(REFERENCE_PREFIX)
+    assert [row.values[0] for row in rows] == ["wl_0", "wl_1", "wl_2"]
+    assert store.uploads == 1
+    assert deduplicator.resolve(reference) == system_msg
+
+
+def test_small_and_other_values_are_kept():
+    deduplicator = ContentDeduplicator(SqliteBlobStore(":memory:"), fields=("system_msg",), min_size=100)
+    row = AnalyticsRow(("messages", "system_msg"), ["x" * 500, "short"])
+    assert deduplicator.dedup(row) is row
+    assert deduplicator.resolve("short") == "short"
+
+
+def test_forgotten_digests_are_stored_again(tmp_path):
+    store = CountingStore(str(tmp_path / "blobs.db"))
+    deduplicator = ContentDeduplicator(store, min_size=1, cache_size=1)
+    for text in ("a", "b", "a"):
+        deduplicator.dedup(AnalyticsRow(("system_msg",), [text]))
+    assert store.uploads == 3
+    assert store.get(None, deduplicator.dedup(AnalyticsRow(("system_msg",), ["b"])).values[0][len(REFERENCE_PREFIX):]) == "b"
+
+
+def test_environment_enables_dedup_until_disabled(monkeypatch):
+    monkeypatch.setattr(dedup, "get_config", lambda: Config(dedup=True, blob_table="blobs"))
+    monkeypatch.setattr(dedup._deduplicator, "_disabled", False)
+    deduplicator = dedup.get_deduplicator()
+    assert deduplicator.store.table_name == "blobs" and dedup.get_deduplicator() is deduplicator
+    dedup.disable_dedup()
+    # WONKALYTICS_DEDUP is still set, the explicit disable wins
+    assert dedup.get_deduplicator() is None
@@ -0,0 +1,61 @@
+# test_dispatcher.py
+import threading
+import time
+from wonkalytics import dispatcher as dispatcher_module
+from wonkalytics.config import Config
+from wonkalytics.dispatcher import BackgroundDispatcher
+
+
+def test_submit_returns_immediately_and_flush_drains():
+    dispatcher = BackgroundDispatcher(max_queue_size=10)
+    done = []
+
+    start = time.perf_counter()
+    dispatcher.submit(lambda: (time.sleep(0.2), done.append(1)))
+    assert time.perf_counter() - start < 0.1  # The slow work does not run on the caller
+
+    assert dispatcher.flush(timeout=5) == True
+    assert done == [1]
+    assert dispatcher.close(timeout=5) == True
+
+
+def test_full_queue_drops_instead_of_blocking():
+    dispatcher = BackgroundDispatcher(max_queue_size=1)
+    release = threading.Event()
+
+    dispatcher.submit(release.wait)  # Occupies the worker
+    time.sleep(0.05)
+    dispatcher.submit(lambda: None)  # Fills the queue
+    assert dispatcher.submit(lambda: None) == False
+    assert dispatcher.dropped == 1
+
+    release.set()
+    assert dispatcher.close(timeout=5) == True
+
+
+def test_worker_survives_failing_work():
+    dispatcher = BackgroundDispatcher()
+    done = []
+    dispatcher.submit(lambda: 1 / 0)
+    dispatcher.submit(lambda: done.append(1))
+    dispatcher.flush(timeout=5)
+    assert dispatcher.failed == 1
+    assert done == [1]
+    dispatcher.close()
+
+
+def test_environment_enables_one_dispatcher_until_disabled(monkeypatch):
+    monkeypatch.setattr(dispatcher_module, "get_config", lambda: Config(background_logging=True))
+    dispatcher_module.enable_background_logging()
+    dispatcher_module.disable_background_logging()
+    assert dispatcher_module.get_dispatcher() is None
+
+    monkeypatch.setattr(dispatcher_module._dispatcher, "_disabled", False)
+    dispatchers = []
+    threads = [threading.Thread(target=lambda: dispatchers.append(dispatcher_module.get_dispatcher())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(dispatcher) for dispatcher in dispatchers}) == 1
+    dispatcher_module.disable_background_logging()
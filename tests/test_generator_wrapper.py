@@ -0,0 +1,230 @@
+# test_generator_wrapper.py
+import gc
+import threading
+import time
+import weakref
+import pytest
+from openai.openai_object import OpenAIObject
+from wonkalytics import async_analytics, generator_wrapper
+from wonkalytics.generator_wrapper import STREAM_TIMING_COLUMNS, GeneratorWrapper
+
+
+def make_chunk(delta, finish_reason=None):
+    return OpenAIObject.construct_from(
+        {
+            "id": "chatcmpl-test",
+            "object": "chat.completion.chunk",
+            "model": "gpt-4-1106-preview",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+    )
+
+
+def make_chunks(*contents, finish_reason="stop"):
+    yield make_chunk({"role": "assistant", "content": ""})
+    for content in contents:
+        yield make_chunk({"content": content})
+    yield make_chunk({}, finish_reason)
+
+
+@pytest.fixture
+def logged(monkeypatch):
+    logged = []
+
+    def log(*args, **kwargs):
+        metadata = dict(kwargs.get("metadata"))
+        timing = {column: metadata.pop(column) for column in STREAM_TIMING_COLUMNS if column in metadata}
+        logged.append({
+            "response": args[6], "metadata": metadata, "timing": timing, "end_time": args[8],
+            "thread": threading.current_thread(), "uid": kwargs.get("uid"),
+        })
+        return kwargs.get("uid") or "wl_test"
+
+    monkeypatch.setattr(generator_wrapper, "wonkalytics_and_promptlayer_api_request", log)
+    monkeypatch.setattr(generator_wrapper, "submit_analytics_request", log)
+    # What queue_analytics_request runs on a worker
+    monkeypatch.setattr(async_analytics, "wonkalytics_and_promptlayer_api_request", log)
+    monkeypatch.setattr(generator_wrapper, "get_api_key", lambda: "test")
+    return logged
+
+
+def make_wrapper(generator, return_pl_id=False, **arguments):
+    return GeneratorWrapper(
+        generator,
+        {
+            "function_name": "openai.ChatCompletion.create",
+            "provider_type": "openai",
+            "request": None,
+            "args": (),
+            "kwargs": {},
+            "tags": None,
+            "request_start_time": 0.0,
+            "request_end_time": 0.0,
+            "return_pl_id": return_pl_id,
+            **arguments,
+        },
+    )
+
+
+def test_deltas_are_combined_into_one_response(logged):
+    chunks = list(make_wrapper(make_chunks("Hello", " world")))
+    assert len(chunks) == 4
+    [event] = logged
+    assert event["response"]["id"] == "chatcmpl-test"
+    assert event["response"]["choices"] == [{"role": "assistant", "content": "Hello world"}]
+    # The last chunk is not modified when the response is combined
+    assert chunks[-1].choices[0].finish_reason == "stop"
+
+
+def test_chunks_are_not_retained(logged):
+    seen = []
+    wrapper = make_wrapper(make_chunks("a", "b", "c"))
+    for chunk in wrapper:
+        seen.append(weakref.ref(chunk))
+        del chunk
+    gc.collect()
+    # Nothing is referenced by the wrapper once the stream was logged
+    assert all(ref() is None for ref in seen)
+
+
+@pytest.mark.parametrize("finish_reason", ["stop", "length", "tool_calls", "content_filter"])
+def test_every_finish_reason_is_logged_once_as_completed(logged, finish_reason):
+    list(make_wrapper(make_chunks("a", finish_reason=finish_reason)))
+    [event] = logged
+    assert event["metadata"] == {"stream_status": "completed", "finish_reason": finish_reason}
+
+
+def test_stream_without_finish_reason_is_logged_when_exhausted(logged):
+    def chunks():
+        yield make_chunk({"role": "assistant", "content": "partial"})
+
+    list(make_wrapper(chunks()))
+    [event] = logged
+    assert event["metadata"] == {"stream_status": "completed"}
+
+
+def test_closed_stream_is_logged_as_aborted_with_partial_content(logged):
+    generator = make_chunks("Hello", " world")
+    with make_wrapper(generator) as wrapper:
+        next(wrapper)
+        next(wrapper)
+    [event] = logged
+    assert event["metadata"] == {"stream_status": "aborted"}
+    assert event["response"]["choices"] == [{"role": "assistant", "content": "Hello"}]
+    assert generator.gi_frame is None  # The underlying stream was closed too
+
+    wrapper.close()
+    assert len(logged) == 1
+
+
+def wait_for(logged, count=1):
+    deadline = time.monotonic() + 5
+    while len(logged) < count and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return logged
+
+
+def test_abandoned_stream_is_logged_off_the_collecting_thread(logged):
+    wrapper = make_wrapper(make_chunks("Hello"))
+    next(wrapper)
+    del wrapper
+    gc.collect()
+    [event] = wait_for(logged)
+    assert event["metadata"] == {"stream_status": "aborted"}
+    assert event["thread"] is not threading.current_thread()
+
+
+def test_interrupted_stream_is_reraised_and_logged_in_the_background(logged):
+    def interrupted():
+        yield make_chunk({"role": "assistant", "content": "Hello"})
+        raise KeyboardInterrupt
+
+    wrapper = make_wrapper(interrupted())
+    next(wrapper)
+    with pytest.raises(KeyboardInterrupt):
+        next(wrapper)
+    [event] = wait_for(logged)
+    assert event["metadata"] == {"stream_status": "aborted"}
+    assert event["thread"] is not threading.current_thread()
+
+
+def test_return_pl_id_is_returned_with_the_finishing_chunk(logged):
+    results = list(make_wrapper(make_chunks("a"), return_pl_id=True))
+    request_ids = [request_id for _, request_id in results]
+    assert request_ids[:2] == [None, None] and request_ids[2].startswith("wl_")
+    # The stream is logged with the id that was handed out
+    [event] = logged
+    assert event["uid"] == request_ids[2]
+
+
+def test_usage_after_the_finish_reason_is_logged(logged, monkeypatch):
+    def chunks_with_usage():
+        yield from make_chunks("Hello", " world")
+        # Sent after the finishing chunk with stream_options={"include_usage": True}
+        yield OpenAIObject.construct_from(
+            {"id": "chatcmpl-test", "object": "chat.completion.chunk", "choices": [], "usage": {"completion_tokens": 7}}
+        )
+
+    clock = iter([100.5, 100.6, 100.8, 101.0, 101.5])
+    monkeypatch.setattr(generator_wrapper.time, "perf_counter", lambda: next(clock))
+    wrapper = make_wrapper(chunks_with_usage(), request_started=99.8)
+    for chunk in wrapper:
+        # Nothing is logged at the finish reason, the usage is still to come
+        assert not logged
+    [event] = logged
+    assert event["metadata"] == {"stream_status": "completed", "finish_reason": "stop"}
+    assert event["timing"]["tokens_per_sec"] == pytest.approx(7 / 1.0)
+
+
+def test_stream_closed_after_its_finish_reason_is_completed(logged):
+    with make_wrapper(make_chunks("Hello")) as wrapper:
+        for chunk in wrapper:
+            if chunk.choices[0].finish_reason:
+                break
+    [event] = logged
+    assert event["metadata"] == {"stream_status": "completed", "finish_reason": "stop"}
+
+
+@pytest.mark.asyncio
+async def test_async_stream_is_logged_once(logged):
+    async def chunks():
+        for chunk in make_chunks("Hello"):
+            yield chunk
+
+    async with make_wrapper(chunks()) as wrapper:
+        async for _ in wrapper:
+            pass
+    [event] = logged
+    assert event["metadata"] == {"stream_status": "completed", "finish_reason": "stop"}
+
+
+def test_stream_timing(logged, monkeypatch):
+    clock = iter([100.5, 100.6, 100.8, 101.0])
+    monkeypatch.setattr(generator_wrapper.time, "perf_counter", lambda: next(clock))
+    # The request started at 99.8 on the monotonic clock, the wall clock is only used for its start time
+    wrapper = make_wrapper(
+        make_chunks("Hello", " world"), request_start_time=1000.0, request_end_time=1042.0, request_started=99.8
+    )
+    list(wrapper)
+
+    timing = logged[0]["timing"]
+    # The first chunk arrived 0.7s after the request started
+    assert timing["time_to_first_token"] == pytest.approx(0.7)
+    assert timing["stream_duration"] == pytest.approx(0.5)
+    assert timing["chunk_count"] == 4
+    assert timing["chunk_gap_mean"] == pytest.approx(0.5 / 3)
+    assert timing["chunk_gap_max"] == pytest.approx(0.2)
+    assert timing["tokens_per_sec"] == pytest.approx(2 / 0.5)
+    assert logged[0]["end_time"] == pytest.approx(1001.2)
+
+
+def test_stream_timings_are_sent_to_promptlayer_as_strings():
+    from wonkalytics.analytics import _promptlayer_event
+
+    metadata = {"stream_status": "completed", "time_to_first_token": 0.7, "chunk_count": 4, "tokens_per_sec": None}
+    event = {"function_name": "openai.ChatCompletion.create", "metadata": metadata}
+    assert _promptlayer_event(event).event["metadata"] == {
+        "stream_status": "completed", "time_to_first_token": "0.7", "chunk_count": "4",
+    }
+    # The SQL row keeps the numbers
+    assert event["metadata"]["chunk_count"] == 4
@@ -0,0 +1,85 @@
+# test_metrics.py
+import pytest
+from wonkalytics import analytics, metrics, sampling
+from wonkalytics.metrics import NoopMetrics
+
+
+@pytest.fixture
+def recorded():
+    backend = metrics.enable_metrics(buckets=(0.1, 1.0))
+    yield backend
+    metrics.set_metrics_backend(None)
+
+
+def test_noop_by_default():
+    metrics.set_metrics_backend(None)
+    with metrics.time_stage("insert"):
+        pass
+    metrics.count_sink("sql", "success")
+    with pytest.raises(RuntimeError):
+        metrics.render_prometheus()
+
+
+def test_prometheus_text(recorded):
+    recorded.observe("wonkalytics_stage_seconds", 0.05, {"stage": "insert"})
+    recorded.observe("wonkalytics_stage_seconds", 0.5, {"stage": "insert"})
+    metrics.count_sink("sql", "success")
+    metrics.count_sink("sql", "success")
+    recorded.set_gauge("wonkalytics_backlog", 3)
+
+    text = metrics.render_prometheus()
+    assert "# TYPE wonkalytics_sink_events_total counter" in text
+    assert 'wonkalytics_sink_events_total{outcome="success",sink="sql"} 2' in text
+    assert "wonkalytics_backlog 3" in text
+    assert "# TYPE wonkalytics_stage_seconds histogram" in text
+    assert 'wonkalytics_stage_seconds_bucket{stage="insert",le="0.1"} 1' in text
+    assert 'wonkalytics_stage_seconds_bucket{stage="insert",le="1.0"} 2' in text
+    assert 'wonkalytics_stage_seconds_bucket{stage="insert",le="+Inf"} 2' in text
+    assert 'wonkalytics_stage_seconds_count{stage="insert"} 2' in text
+
+
+def test_pipeline_is_instrumented(recorded, monkeypatch):
+    monkeypatch.setattr(analytics, "get_dispatcher", lambda: None)
+    monkeypatch.setattr(analytics, "track_request", lambda event: None)
+
+    def fail(item):
+        raise ConnectionError("database unavailable")
+
+    monkeypatch.setattr(analytics, "_write_to_azure_sql", fail)
+    monkeypatch.setattr(analytics, "spool_failed_event", lambda sink, event, error: False)
+
+    sampling.enable_sampling(default_rate=0.0)
+    try:
+        analytics.wonkalytics_and_promptlayer_api_request("f", "openai", [], {}, None, None, {}, 0.0, 1.0, "key")
+        analytics.wonkalytics_and_promptlayer_api_request(
+            "f", "openai", [], {}, None, None, {}, 0.0, 1.0, "key", return_pl_id=True
+        )
+    finally:
+        sampling.disable_sampling()
+
+    assert recorded.get("wonkalytics_events_total", {"decision": "drop"}) == 1
+    assert recorded.get("wonkalytics_events_total", {"decision": "full"}) == 1
+    assert recorded.get("wonkalytics_events_dropped_total", {"reason": "sampled"}) == 1
+    assert recorded.get("wonkalytics_sink_events_total", {"sink": "promptlayer", "outcome": "success"}) == 1
+    assert recorded.get("wonkalytics_sink_events_total", {"sink": "sql", "outcome": "failure"}) == 1
+    assert recorded.get("wonkalytics_stage_seconds", {"stage": "build"})[0] == 1
+    assert recorded.get("wonkalytics_stage_seconds", {"stage": "promptlayer"})[0] == 1
+
+
+def test_custom_backend():
+    class Recorder(NoopMetrics):
+        enabled = True
+
+        def __init__(self):
+            self.calls = []
+
+        def increment(self, name, value=1, labels=None):
+            self.calls.append((name, value, labels))
+
+    backend = Recorder()
+    metrics.set_metrics_backend(backend)
+    try:
+        metrics.count_dropped("queue_full")
+    finally:
+        metrics.set_metrics_backend(None)
+    assert backend.calls == [("wonkalytics_events_dropped_total", 1, {"reason": "queue_full"})]
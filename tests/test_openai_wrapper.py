@@ -0,0 +1,70 @@
+# test_openai_wrapper.py
+import types
+import pytest
+from wonkalytics import openai_wrapper, utils
+from wonkalytics.openai_wrapper import OpenAIWrapper
+
+
+class FakeChatCompletion:
+    @classmethod
+    def create(cls, **kwargs):
+        return kwargs
+
+
+def make_wrapper():
+    fake_openai = types.ModuleType("openai")
+    fake_openai.ChatCompletion = FakeChatCompletion
+    fake_openai.api_key = "sk-test"
+    return OpenAIWrapper(fake_openai, function_name="openai"), fake_openai
+
+
+def test_child_wrappers_are_reused():
+    openai, _ = make_wrapper()
+    assert openai.ChatCompletion is openai.ChatCompletion
+    # Bound (class)methods are new objects on every access but still share one wrapper
+    assert openai.ChatCompletion.create is openai.ChatCompletion.create
+    assert object.__getattribute__(openai.ChatCompletion.create, "_function_name") == "openai.ChatCompletion.create"
+
+
+def test_primitives_are_not_wrapped():
+    openai, _ = make_wrapper()
+    assert openai.api_key == "sk-test"
+    assert type(openai.api_key) is str
+
+
+def test_setting_an_attribute_replaces_its_wrapper():
+    openai, fake_openai = make_wrapper()
+    old = openai.ChatCompletion
+
+    class OtherChatCompletion(FakeChatCompletion):
+        pass
+
+    openai.ChatCompletion = OtherChatCompletion
+    assert fake_openai.ChatCompletion is OtherChatCompletion
+    assert openai.ChatCompletion is not old
+    assert object.__getattribute__(openai.ChatCompletion, "_obj") is OtherChatCompletion
+
+
+class RateLimitError(Exception):
+    http_status = 429
+
+
+def test_failed_calls_are_logged_with_their_error(monkeypatch):
+    logged = []
+    # Only queued, the error is re-raised without waiting for the sinks
+    monkeypatch.setattr(utils, "queue_analytics_request", lambda *args, **kwargs: logged.append((args, kwargs)))
+    monkeypatch.setattr(openai_wrapper, "api_key", "test", raising=False)
+
+    def create(**kwargs):
+        raise RateLimitError("Rate limit reached for gpt-4")
+
+    openai, fake_openai = make_wrapper()
+    fake_openai.ChatCompletion = types.SimpleNamespace(create=create)
+    with pytest.raises(RateLimitError):
+        openai.ChatCompletion.create(model="gpt-4", messages=[])
+
+    [(args, kwargs)] = logged
+    assert args[0] == "openai.ChatCompletion.create" and args[6] is None
+    assert kwargs["metadata"] == {
+        "error_type": "RateLimitError", "error_message": "Rate limit reached for gpt-4", "error_status": 429,
+    }
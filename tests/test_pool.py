@@ -0,0 +1,85 @@
+# test_pool.py
+import pyodbc
+import pytest
+from wonkalytics import pool as pool_module
+from wonkalytics.pool import ConnectionPool
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    opened = []
+
+    def connect(connection_string):
+        opened.append(FakeConnection())
+        return opened[-1]
+
+    monkeypatch.setattr(pyodbc, "connect", connect)
+    return opened
+
+
+def test_connections_are_reused(connections):
+    pool = ConnectionPool("fake", max_size=2)
+    for _ in range(3):
+        with pool.connection():
+            pass
+    assert len(connections) == 1
+    assert pool.idle == 1
+
+
+def test_exhausted_pool_times_out(connections):
+    pool = ConnectionPool("fake", max_size=1, acquire_timeout=0.05)
+    with pool.connection():
+        with pytest.raises(TimeoutError):
+            with pool.connection():
+                pass
+
+
+def test_broken_connection_is_replaced(connections):
+    pool = ConnectionPool("fake", max_size=1)
+    calls = []
+
+    def work(cnxn):
+        calls.append(cnxn)
+        if len(calls) == 1:
+            raise pyodbc.OperationalError("08S01", "Communication link failure")
+        return "ok"
+
+    assert pool.run(work) == "ok"
+    assert connections[0].closed
+    assert calls == connections
+    assert pool.size == 1
+
+
+def test_other_errors_roll_back_and_keep_connection(connections):
+    pool = ConnectionPool("fake")
+    with pytest.raises(ValueError):
+        with pool.connection():
+            raise ValueError("bad row")
+    assert connections[0].rollbacks == 1
+    assert pool.idle == 1
+
+
+def test_failing_health_check_frees_its_slot(connections):
+    pool = ConnectionPool("fake", max_size=1, health_check_interval=0)
+    with pool.connection():
+        pass
+    connections[0].cursor = lambda: 1 / 0
+    with pytest.raises(ZeroDivisionError):
+        with pool.connection():
+            pass
+    assert connections[0].closed
+    assert pool.size == 0
+    with pool.connection() as cnxn:
+        assert cnxn is connections[1]
@@ -0,0 +1,132 @@
+# test_projection.py
+import logging
+from datetime import datetime
+import pytest
+from wonkalytics.projection import ProjectionPlan
+
+COLUMNS = [
+    "model", "temperature", "system_msg", "messages", "response", "response_id", "start_time",
+    "tags", "tenant_id", "username", "email", "timestamp", "id", "stream_status",
+]
+
+
+def make_event(**metadata):
+    return {
+        "function_name": "openai.ChatCompletion.create",
+        "provider_type": "openai",
+        "args": [],
+        "kwargs": {
+            "model": "gpt-4",
+            "temperature": 0.2,
+            "messages": [
+                {"role": "system", "content": "Be brief."},
+                {"role": "user", "content": "Hi"},
+            ],
+            "functions": {"lookup": {"parameters": {"type": "object"}}},
+        },
+        "tags": ["test"],
+        "request_response": {
+            "id": "chatcmpl-1",
+            "choices": [{"message": {"role": "assistant", "content": "Hello"}}],
+            "usage": {"total_tokens": 12},
+        },
+        "request_start_time": 1.5,
+        "metadata": metadata,
+        "request": {"auth_info": None},
+        "id": "wl_1",
+        "timestamp": datetime(2024, 1, 31, 12, 30),
+    }
+
+
+def test_event_is_projected_onto_the_columns():
+    row = ProjectionPlan(COLUMNS).project(make_event(stream_status="completed"))
+    assert row.columns == tuple(sorted(row.columns))
+    assert row.as_dict() == {
+        "model": "gpt-4",
+        "temperature": 0.2,
+        "system_msg": "Be brief.",
+        "messages": "user:\nHi\n\n",
+        "response": "Hello",
+        "response_id": "chatcmpl-1",
+        "start_time": 1.5,
+        "tags": ["test"],
+        "tenant_id": None,
+        "username": None,
+        "email": None,
+        "timestamp": datetime(2024, 1, 31, 12, 30),
+        "id": "wl_1",
+        "stream_status": "completed",
+    }
+
+
+def test_prefixed_keys_win_over_plain_keys():
+    event = {"id": "plain", "metadata": {"id": "from metadata"}, "kwargs": {"model": "a"}, "model": "b"}
+    row = ProjectionPlan(["id", "model"]).project(event)
+    assert row.as_dict() == {"id": "from metadata", "model": "a"}
+
+
+def test_unknown_keys_are_warned_about_once(caplog):
+    plan = ProjectionPlan(COLUMNS)
+    with caplog.at_level(logging.WARNING):
+        for _ in range(3):
+            plan.project(make_event(unknown="x"))
+    warnings = [r.getMessage() for r in caplog.records if "is not allowed" in r.getMessage()]
+    assert len(warnings) == len(set(warnings))
+    assert "Key 'unknown' is not allowed in SQL table and will be ignored." in warnings
+    # Subtrees without any column are skipped as a whole
+    assert "Key 'functions_*' is not allowed in SQL table and will be ignored." in warnings
+
+
+def test_event_without_columns_is_rejected():
+    with pytest.raises(ValueError):
+        ProjectionPlan(["action"]).project({"other": 1})
+
+
+def test_long_conversations_keep_head_and_tail():
+    from wonkalytics.projection import _map_messages_to_keyvals
+
+    messages = [{"role": "user", "content": f"turn {i} " + "x" * 100} for i in range(1000)]
+    rendered = _map_messages_to_keyvals(messages, {"messages": 2000})["messages"]
+    assert len(rendered) == 2000
+    assert rendered.startswith("user:\nturn 0 ")
+    assert rendered.endswith("turn 999 " + "x" * 100 + "\n\n")
+    assert "characters truncated ..." in rendered
+    # Without a limit the rendering is unchanged
+    assert _map_messages_to_keyvals(messages[:2])["messages"] == "".join(
+        f"user:\n{m['content']}\n\n" for m in messages[:2]
+    )
+
+
+def test_text_is_truncated_to_the_column_length():
+    from wonkalytics.schema import ColumnInfo
+
+    columns = {
+        "response": ColumnInfo("response", "nvarchar", 100),
+        "messages": ColumnInfo("messages", "nvarchar", -1),
+        "model": ColumnInfo("model", "nvarchar", 50),
+    }
+    event = make_event()
+    event["request_response"]["choices"][0]["message"]["content"] = "y" * 500
+    event["kwargs"]["messages"].append({"role": "user", "content": "z" * 500})
+    row = ProjectionPlan(columns, max_text_length=300).project(event).as_dict()
+    assert len(row["response"]) == 100
+    assert len(row["messages"]) == 300
+    assert row["model"] == "gpt-4"
+
+
+def test_text_columns_are_limited_to_the_max_text_length():
+    from wonkalytics.schema import ColumnInfo
+
+    # Like the README's table: TEXT and NTEXT report their capacity instead of -1
+    columns = {
+        "messages": ColumnInfo("messages", "text", 2147483647),
+        "system_msg": ColumnInfo("system_msg", "ntext", 1073741823),
+    }
+    event = make_event()
+    event["kwargs"]["messages"].append({"role": "user", "content": "z" * 50000})
+    event["kwargs"]["messages"][0]["content"] = "s" * 5000
+    row = ProjectionPlan(columns, max_text_length=1000).project(event).as_dict()
+    assert len(row["messages"]) == 1000
+    assert len(row["system_msg"]) == 1000
+    # Without a text limit the column capacity still applies
+    assert ProjectionPlan(columns, max_text_length=0).limits == {"messages": 2147483647, "system_msg": 1073741823}
@@ -0,0 +1,124 @@
+# test_promptlayer.py
+import gzip
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import requests
+from wonkalytics import spool
+from wonkalytics.promptlayer import PromptLayerBatcher, PromptLayerClient
+
+
+# A local stand-in for the PromptLayer API that records the events it receives
+@pytest.fixture
+def promptlayer_server():
+    received = []
+    delay = {"seconds": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            received.append((self.path, json.loads(body), self.client_address))
+            time.sleep(delay["seconds"])
+            response = b'{"success": true}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}", received, delay
+    server.shutdown()
+
+
+def test_events_are_posted_over_one_kept_alive_connection(promptlayer_server):
+    url, received, _ = promptlayer_server
+    client = PromptLayerClient(url)
+    for i in range(3):
+        client.track_request({"function_name": "openai.ChatCompletion.create", "i": i})
+
+    assert [event["i"] for _, event, _ in received] == [0, 1, 2]
+    assert all(path == "/track-request" for path, _, _ in received)
+    assert len({address for _, _, address in received}) == 1  # Same client port, so the connection was reused
+    client.close()
+
+
+def test_large_bodies_are_gzip_compressed(promptlayer_server):
+    url, received, _ = promptlayer_server
+    client = PromptLayerClient(url, compress=True, compress_min_bytes=10)
+    client.track_request({"kwargs": {"messages": [{"role": "user", "content": "x" * 5000}]}})
+    assert received[0][1]["kwargs"]["messages"][0]["content"] == "x" * 5000
+    client.close()
+
+
+def test_slow_promptlayer_times_out(promptlayer_server):
+    url, _, delay = promptlayer_server
+    delay["seconds"] = 1
+    client = PromptLayerClient(url, read_timeout=0.1)
+    with pytest.raises(requests.Timeout):
+        client.track_request({"i": 0})
+    client.close()
+
+
+def test_batcher_sends_buffered_events_on_flush(promptlayer_server):
+    url, received, _ = promptlayer_server
+    batcher = PromptLayerBatcher(PromptLayerClient(url), batch_size=100, max_latency=60)
+    for i in range(5):
+        assert batcher.add({"i": i}) == True
+    assert received == []
+
+    assert batcher.flush(timeout=5) == True
+    assert sorted(event["i"] for _, event, _ in received) == [0, 1, 2, 3, 4]
+    assert batcher.sent == 5
+    batcher.close()
+
+
+class UnreachableClient:
+    def track_request(self, event):
+        raise requests.ConnectionError("PromptLayer is down")
+
+
+def test_batcher_spools_undelivered_events(tmp_path):
+    spool.enable_spool(path=str(tmp_path / "spool.db"), replay_interval=60)
+    try:
+        batcher = PromptLayerBatcher(UnreachableClient(), batch_size=100, max_latency=60)
+        batcher.add({"i": 0})
+        # Closing sends what is still buffered before the thread stops
+        assert batcher.close(timeout=5) == True
+        assert batcher.add({"i": 1}) == False
+        assert batcher.spooled == 1 and batcher.failed == 0
+        assert spool.get_spool().stats()["events"] == {"promptlayer": 1}
+    finally:
+        spool.disable_spool()
+
+
+def test_spool_cli_replays_promptlayer_events(promptlayer_server, tmp_path):
+    url, received, _ = promptlayer_server
+    path = str(tmp_path / "spool.db")
+    spooled = spool.Spool(path)
+    spooled.append("promptlayer", {"function_name": "openai.ChatCompletion.create", "i": 1})
+    spooled.close()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, URL_API_PROMPTLAYER=url, PROMPTLAYER_API_KEY="pl_test")
+    output = subprocess.run(
+        [sys.executable, "-m", "wonkalytics.spool", "--path", path, "replay"],
+        cwd=root, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    assert json.loads(output) == {"delivered": 1, "failed": 0, "skipped": 0}
+    [(_, event, _)] = received
+    assert event["i"] == 1 and event["api_key"] == "pl_test"
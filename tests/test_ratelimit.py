@@ -0,0 +1,143 @@
+# test_ratelimit.py
+import asyncio
+import inspect
+import threading
+import time
+import pytest
+from wonkalytics import ratelimit
+from wonkalytics.config import Config
+from wonkalytics.ratelimit import ModelLimit, RateLimiter, RateLimitTimeout, Reservation, estimate_tokens, parse_duration
+
+
+class RateLimitError(Exception):
+    def __init__(self, headers):
+        super().__init__("Rate limit reached")
+        self.headers = headers
+
+
+class FakeResponse(dict):
+    def __init__(self, headers, usage=None):
+        super().__init__(usage=usage or {})
+        self.headers = headers
+
+
+def test_parsing():
+    assert parse_duration("6m0s") == 360.0
+    assert parse_duration("1.5s") == 1.5
+    assert parse_duration("20ms") == pytest.approx(0.02)
+    assert parse_duration("2") == 2.0
+    assert parse_duration("soon") is None
+    messages = [{"role": "user", "content": "x" * 400}]
+    assert estimate_tokens({"messages": messages, "max_tokens": 100, "n": 2}) == 100 + 4 + 200
+
+
+def test_calls_are_paced_under_the_quota():
+    limiter = RateLimiter({"gpt-4": ModelLimit(requests_per_minute=1200)}, headroom=1.0)
+    start = time.monotonic()
+    for _ in range(30):
+        limiter.acquire("gpt-4")
+    # A second of quota (20 calls) at once, then 20 calls per second
+    assert 0.4 < time.monotonic() - start < 1.5
+    assert limiter.acquire("gpt-3.5-turbo").waited == 0.0  # Not limited
+
+
+def test_tenants_take_turns():
+    limiter = RateLimiter({"gpt-4": ModelLimit(requests_per_minute=6000)})
+    limiter.observe_error(Reservation("gpt-4", 0, 0.0), RateLimitError({"retry-after": "0.3"}))
+    granted = []
+
+    def call(tenant):
+        limiter.acquire("gpt-4", tenant)
+        granted.append(tenant)
+
+    threads = []
+    for tenant in ["a"] * 6 + ["b"] * 2:
+        threads.append(threading.Thread(target=call, args=(tenant,)))
+        threads[-1].start()
+        # Queue them in this order
+        while limiter.stats()["gpt-4"]["queued"] < len(threads):
+            time.sleep(0.001)
+    for thread in threads:
+        thread.join()
+    assert granted == ["a", "b", "a", "b", "a", "a", "a", "a"]
+
+
+def test_quota_is_learned_from_the_headers():
+    limiter = RateLimiter()
+    headers = {"X-RateLimit-Limit-Requests": "600", "X-RateLimit-Remaining-Requests": "0", "X-RateLimit-Reset-Requests": "200ms"}
+    limiter.observe(Reservation("gpt-4", 0, 0.0), FakeResponse(headers))
+    assert limiter.stats()["gpt-4"]["requests_per_minute"] == 600
+    assert limiter.acquire("gpt-4").waited >= 0.15
+
+    strict = RateLimiter({"gpt-4": ModelLimit(requests_per_minute=1)}, max_wait=0.05)
+    strict.acquire("gpt-4")
+    with pytest.raises(RateLimitTimeout):
+        strict.acquire("gpt-4")
+    assert strict.stats()["gpt-4"]["queued"] == 0
+
+
+def test_wrapped_calls_reconcile_tokens():
+    limiter = RateLimiter({"gpt-4": ModelLimit(tokens_per_minute=60000)}, headroom=1.0)
+    kwargs = {"model": "gpt-4", "messages": [{"role": "user", "content": "hi"}], "max_tokens": 500}
+    call = limiter.wrap(lambda: {"usage": {"total_tokens": 10}}, kwargs)
+    call()
+    queue = limiter._queues["gpt-4"]
+    # The 500 tokens that were reserved but not used are available again
+    assert queue.tokens.level == pytest.approx(queue.tokens.capacity - 10, abs=5)
+
+    def throttled():
+        raise RateLimitError({"retry-after-ms": "100"})
+
+    with pytest.raises(RateLimitError):
+        limiter.wrap(throttled, kwargs)()
+    assert limiter.stats()["gpt-4"]["paused_for"] > 0.05
+
+
+@pytest.mark.asyncio
+async def test_async_calls_wait_without_blocking_the_loop():
+    limiter = RateLimiter({"gpt-4": ModelLimit(requests_per_minute=6000)})
+    limiter.observe_error(Reservation("gpt-4", 0, 0.0), RateLimitError({"retry-after": "0.1"}))
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.005)
+
+    ticker = asyncio.ensure_future(tick())
+    reservations = await asyncio.gather(*(limiter.aacquire("gpt-4", tenant) for tenant in "abc"))
+    ticker.cancel()
+    assert all(reservation.waited >= 0.09 for reservation in reservations)
+    assert ticks > 5
+
+
+@pytest.mark.asyncio
+async def test_sync_function_returning_a_coroutine_waits_on_the_loop():
+    limiter = RateLimiter({"gpt-4": ModelLimit(tokens_per_minute=60000)}, headroom=1.0)
+    limiter.observe_error(Reservation("gpt-4", 0, 0.0), RateLimitError({"retry-after": "0.1"}))
+    kwargs = {"model": "gpt-4", "max_tokens": 500}
+    sent = []
+
+    async def create():
+        sent.append(time.monotonic())
+        return {"usage": {"total_tokens": 10}}
+
+    # E.g. a client method that is not a coroutine function itself
+    call = limiter.wrap(lambda: create(), kwargs)
+    start = time.monotonic()
+    pending = call()
+    assert inspect.isawaitable(pending) and sent == []
+    assert await pending == {"usage": {"total_tokens": 10}}
+    assert sent[0] - start >= 0.09
+    queue = limiter._queues["gpt-4"]
+    assert queue.tokens.level == pytest.approx(queue.tokens.capacity - 10, abs=5)
+
+
+def test_environment_enables_rate_limiting_until_disabled(monkeypatch):
+    monkeypatch.setattr(ratelimit, "get_config", lambda: Config(rate_limit=True))
+    monkeypatch.setattr(ratelimit._limiter, "_disabled", False)
+    limiter = ratelimit.get_rate_limiter()
+    assert limiter is not None and ratelimit.get_rate_limiter() is limiter
+    ratelimit.disable_rate_limiting()
+    assert ratelimit.get_rate_limiter() is None
@@ -0,0 +1,73 @@
+# test_rollup.py
+import sqlite3
+from datetime import datetime, timedelta
+import pytest
+from wonkalytics import query
+from wonkalytics.rollup import RollupMaintainer
+
+T0 = datetime(2024, 3, 1, 22, 0)
+
+
+@pytest.fixture
+def db():
+    cnxn = sqlite3.connect(":memory:", check_same_thread=False)
+    cnxn.execute(
+        "CREATE TABLE analytics (id TEXT, timestamp DATETIME, tenant_id TEXT, model TEXT, score INT, "
+        "start_time FLOAT, end_time FLOAT, response_usage_total_tokens INT, messages TEXT)"
+    )
+    yield cnxn
+    cnxn.close()
+
+
+def log(db, id, timestamp, tenant, model="gpt-4", score=None, latency=1.0, tokens=10):
+    db.execute(
+        "INSERT INTO analytics VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'long text')",
+        (id, timestamp.isoformat(" "), tenant, model, score, 100.0, 100.0 + latency, tokens),
+    )
+    db.commit()
+
+
+def test_hourly_and_daily_rollups(db):
+    log(db, "a", T0 + timedelta(minutes=5), "t1", score=4, latency=1.0)
+    log(db, "b", T0 + timedelta(minutes=50), "t1", score=2, latency=3.0)
+    log(db, "c", T0 + timedelta(hours=1, minutes=10), "t2", model="gpt-3.5-turbo")
+    log(db, "d", T0 + timedelta(hours=2, minutes=30), "t1")  # The next day
+
+    maintainer = RollupMaintainer(db, "analytics", score_window=timedelta(0))
+    assert maintainer.run_once(now=T0 + timedelta(hours=3)) == 4
+    assert maintainer.dimensions == ["tenant_id", "model"]
+
+    hourly = query.aggregate(["calls", "avg_score", "avg_latency", "max_latency", "total_tokens"], ["tenant_id"], "hour", target=db, table_name="analytics")
+    assert hourly[0] == {
+        "bucket": T0, "tenant_id": "t1", "calls": 2, "avg_score": 3.0, "avg_latency": 2.0, "max_latency": 3.0, "total_tokens": 20,
+    }
+    assert [(row["bucket"].hour, row["tenant_id"]) for row in hourly] == [(22, "t1"), (23, "t2"), (0, "t1")]
+
+    daily = query.calls(group_by=["tenant_id"], target=db, table_name="analytics")
+    assert [(row["bucket"].day, row["tenant_id"], row["calls"]) for row in daily] == [(1, "t1", 2), (1, "t2", 1), (2, "t1", 1)]
+    totals = query.aggregate(["calls"], ["model"], by_bucket=False, filters={"tenant_id": "t1"}, target=db, table_name="analytics")
+    assert totals == [{"model": "gpt-4", "calls": 3}]
+
+
+def test_late_rows_and_scores_are_folded_in(db):
+    log(db, "a", T0 + timedelta(minutes=5), "t1")
+    maintainer = RollupMaintainer(db, "analytics", settle_lag=timedelta(minutes=10), score_interval=timedelta(hours=1))
+    maintainer.run_once(now=T0 + timedelta(minutes=30))
+
+    # A row inserted late, within the settle lag, and a score of an older row
+    log(db, "b", T0 + timedelta(minutes=25), "t1")
+    db.execute("UPDATE analytics SET score = 5 WHERE id = 'a'")
+    db.commit()
+    maintainer.run_once(now=T0 + timedelta(hours=1, minutes=40))
+
+    [row] = query.aggregate(["calls", "avg_score", "scored"], by_bucket=False, target=db, table_name="analytics")
+    assert row == {"calls": 2, "avg_score": 5.0, "scored": 1}
+
+
+def test_unknown_columns_are_rejected(db):
+    log(db, "a", T0, "t1")
+    RollupMaintainer(db, "analytics").run_once(now=T0)
+    with pytest.raises(ValueError):
+        query.aggregate(["calls"], ["email; DROP TABLE analytics"], target=db, table_name="analytics")
+    with pytest.raises(ValueError):
+        query.aggregate(["avg_time_to_first_token"], target=db, table_name="analytics")
@@ -0,0 +1,76 @@
+# test_sampling.py
+from wonkalytics import analytics, sampling
+from wonkalytics.config import Config
+from wonkalytics.sampling import DROP, FULL, SLIM, SamplingPolicy, SamplingRule
+
+
+def test_first_matching_rule_applies():
+    policy = SamplingPolicy(
+        [SamplingRule(tags=["healthcheck"], rate=0.0), SamplingRule(model="gpt-4", rate=1.0)],
+        default_rate=0.0,
+    )
+    assert policy.decide("f", tags=["healthcheck", "x"], model="gpt-4") == DROP
+    assert policy.decide("f", tags=["x"], model="gpt-4") == FULL
+    assert policy.decide("f", tags=None, model="gpt-3.5-turbo") == DROP
+    assert policy.stats() == {
+        "tags=['healthcheck']": {"drop": 1},
+        "model=gpt-4": {"full": 1},
+        "default": {"drop": 1},
+    }
+
+
+def test_rate_cap_and_always_log():
+    policy = SamplingPolicy(
+        [SamplingRule(tags=["eval"], always_log=True), SamplingRule(tenant="t1", max_per_second=2)]
+    )
+    decisions = [policy.decide("f", tenant="t1") for _ in range(10)]
+    assert decisions.count(FULL) == 2
+    assert policy.decide("f", tags=["eval"], tenant="t1") == FULL
+    # Calls whose id is returned (e.g. to score them), aborted streams and failed calls are always logged
+    assert policy.decide_event("f", {}, None, {"auth_info": None}, return_pl_id=True) == FULL
+    assert policy.decide_event("f", {}, None, None, {"stream_status": "aborted"}) == FULL
+    assert policy.decide_event("f", {}, None, None, {"error_type": "RateLimitError"}) == FULL
+
+
+def test_payloads_are_shed_under_backlog(monkeypatch):
+    backlog = [0]
+    policy = SamplingPolicy(shed_backlog=100, backlog=lambda: backlog[0])
+    assert policy.decide("f") == FULL
+    backlog[0] = 100
+    assert policy.decide("f") == SLIM
+
+    event = analytics._build_analytics_event(
+        "f", "openai", [], {"model": "gpt-4", "messages": [{"role": "user", "content": "Hi"}]}, None,
+        {"id": "chatcmpl-1", "choices": [{"message": {"content": "Hello"}}], "usage": {"total_tokens": 3}},
+        0.0, 1.0, "key", {"stream_status": "completed"}, slim=True,
+    )
+    assert event["kwargs"] == {"model": "gpt-4"}
+    assert event["request_response"] == {"id": "chatcmpl-1", "usage": {"total_tokens": 3}}
+    assert event["metadata"] == {"stream_status": "completed", "sampling": "shed"}
+
+
+def test_dropped_calls_are_not_sent(monkeypatch):
+    sent = []
+    monkeypatch.setattr(analytics, "get_dispatcher", lambda: None)
+    monkeypatch.setattr(analytics, "_send_analytics_event", lambda *args: sent.append(args))
+    sampling.enable_sampling(default_rate=0.0)
+    try:
+        assert analytics.wonkalytics_and_promptlayer_api_request(
+            "f", "openai", [], {}, None, None, {}, 0.0, 1.0, "key"
+        ) is None
+        uid = analytics.wonkalytics_and_promptlayer_api_request(
+            "f", "openai", [], {}, None, None, {}, 0.0, 1.0, "key", return_pl_id=True
+        )
+    finally:
+        sampling.disable_sampling()
+    assert len(sent) == 1 and sent[0][2] == uid
+
+
+def test_environment_enables_sampling_until_disabled(monkeypatch):
+    monkeypatch.setattr(sampling, "get_config", lambda: Config(sample_rate=0.25, shed_backlog=100))
+    monkeypatch.setattr(sampling._policy, "_disabled", False)
+    policy = sampling.get_sampling_policy()
+    assert policy.shed_backlog == 100 and sampling.get_sampling_policy() is policy
+    sampling.disable_sampling()
+    # The environment variables are still set, the explicit disable wins
+    assert sampling.get_sampling_policy() is None
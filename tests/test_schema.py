@@ -0,0 +1,122 @@
+# test_schema.py
+import threading
+import time
+from types import SimpleNamespace
+import pyodbc
+import pytest
+from wonkalytics import analytics, schema
+from wonkalytics.config import Config
+from wonkalytics.schema import SchemaCache, TableSchema
+
+SETTINGS = Config(server="server", database="db", username="user", password="secret", table_name="logs")
+
+
+class FakeCursor:
+    def __init__(self, database):
+        self.database = database
+        self.rows = []
+
+    def execute(self, sql, *params):
+        if "INFORMATION_SCHEMA" in sql:
+            self.database.schema_loads += 1
+            columns = self.database.reported_columns or self.database.columns
+            self.rows = [SimpleNamespace(COLUMN_NAME=name, DATA_TYPE="NVARCHAR", CHARACTER_MAXIMUM_LENGTH=-1) for name in columns]
+            return self
+        columns = sql[sql.index("(") + 1:sql.index(")")].split(", ")
+        missing = [column for column in columns if column not in self.database.columns]
+        if missing:
+            raise pyodbc.ProgrammingError("42S22", f"[42S22] Invalid column name '{missing[0]}'. (207) (SQLExecDirectW)")
+        self.database.inserted.append(dict(zip(columns, params[0])))
+        return self
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeDatabase:
+    def __init__(self, columns):
+        self.columns = columns
+        # Reported by INFORMATION_SCHEMA instead of the actual columns when set
+        self.reported_columns = None
+        self.schema_loads = 0
+        self.inserted = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = FakeDatabase(["id", "function_name", "model"])
+    monkeypatch.setattr(pyodbc, "connect", lambda connection_string: database)
+    monkeypatch.setattr(analytics, "get_config", lambda: SETTINGS)
+    schema.invalidate_table_schema()
+    yield database
+    schema.invalidate_table_schema()
+
+
+def test_schemas_expire_after_the_ttl():
+    loads = []
+    cache = SchemaCache(ttl=0.05)
+
+    def loader():
+        loads.append(1)
+        return TableSchema("logs", {}, time.monotonic())
+
+    cache.get(("server", "db", "logs"), loader)
+    cache.get(("server", "db", "logs"), loader)
+    assert len(loads) == 1
+    time.sleep(0.06)
+    cache.get(("server", "db", "logs"), loader)
+    assert len(loads) == 2
+    cache.get(("server", "db", "logs"), loader, refresh=True)
+    assert len(loads) == 3
+
+
+def test_a_slow_load_only_holds_up_its_own_table():
+    cache = SchemaCache(ttl=60)
+    release = threading.Event()
+    loads = []
+
+    def slow_loader():
+        loads.append("slow")
+        release.wait(5)
+        return TableSchema("slow", {}, time.monotonic())
+
+    threads = [threading.Thread(target=cache.get, args=(("server", "db", "slow"), slow_loader)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    cache.get(("server", "db", "fast"), lambda: TableSchema("fast", {}, time.monotonic()))
+    assert time.perf_counter() - start < 0.5
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert loads == ["slow"]  # The waiting callers got the schema of the one load
+
+
+def test_dropped_column_reloads_the_schema_and_retries_once(database):
+    analytics._write_to_azure_sql({"function_name": "f", "kwargs": {"model": "gpt-4"}, "id": "wl_1"})
+    assert database.schema_loads == 1
+
+    # The model column is dropped after the schema was cached
+    database.columns = ["id", "function_name"]
+    analytics._write_to_azure_sql({"function_name": "f", "kwargs": {"model": "gpt-4"}, "id": "wl_2"})
+    assert database.schema_loads == 2
+    assert database.inserted[-1] == {"id": "wl_2", "function_name": "f"}
+
+    # The retry is not repeated when the reloaded schema is still wrong
+    database.columns = ["id"]
+    database.reported_columns = ["id", "function_name"]
+    with pytest.raises(pyodbc.ProgrammingError, match="Invalid column name"):
+        analytics._write_to_azure_sql({"function_name": "f", "id": "wl_3"})
+    assert database.schema_loads == 3
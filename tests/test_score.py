@@ -1,7 +1,111 @@
-from wonkalytics.analytics import score
+# test_score.py
+from types import SimpleNamespace
+import pyodbc
 import pytest
+from wonkalytics import analytics, batch, pool, schema, scoring
+from wonkalytics.analytics import score
+from wonkalytics.config import Config
+
+SETTINGS = Config(server="server", database="db", username="user", password="secret", table_name="logs")
+
+
+class FakeCursor:
+    def __init__(self, database):
+        self.database = database
+        self.rows = []
+        self.rowcount = -1
+        self.fast_executemany = False
+
+    def execute(self, sql, params=()):
+        if "INFORMATION_SCHEMA" in sql:
+            self.rows = [
+                SimpleNamespace(COLUMN_NAME=name, DATA_TYPE="NVARCHAR", CHARACTER_MAXIMUM_LENGTH=-1)
+                for name in ("id", "function_name", "score")
+            ]
+        elif sql.startswith("UPDATE"):
+            # UPDATE [logs] SET score = ? WHERE id = ?
+            value, row_id = params
+            row = self.database.rows.get(row_id)
+            self.rowcount = 0 if row is None else 1
+            if row is not None:
+                row["score"] = value
+        else:
+            self.executemany(sql, [params])
+        return self
+
+    def executemany(self, sql, rows):
+        columns = sql[sql.index("(") + 1:sql.index(")")].split(", ")
+        for values in rows:
+            row = dict(zip(columns, values))
+            if row["function_name"] == "bad":
+                raise ValueError("String data, right truncation")
+            self.database.pending.append(row)
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.rows = {}
+        self.pending = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        for row in self.pending:
+            self.rows[row["id"]] = row
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(pyodbc, "connect", lambda connection_string: database)
+    monkeypatch.setattr(analytics, "get_config", lambda: SETTINGS)
+    pool.close_all_pools()
+    schema.invalidate_table_schema()
+    yield database
+    scoring.disable_score_batching()
+    batch.disable_batch_writes()
+    pool.close_all_pools()
+    schema.invalidate_table_schema()
+
+
+def test_score_reports_the_updated_rows(database):
+    database.rows["wl_1"] = {"id": "wl_1", "function_name": "f"}
+    result = score("wl_1", 100)
+    assert (result.id, result.rows_updated, result.with_insert) == ("wl_1", 1, False)
+    assert database.rows["wl_1"]["score"] == 100
+
+    result = score("wl_missing", 100)
+    assert not result and result.rows_updated == 0
+
+
+def test_score_of_a_queued_row_resolves_once_its_batch_is_committed(database):
+    scoring.enable_score_batching(max_latency=60)
+    writer = batch.enable_batch_writes(max_latency=60, on_failure=lambda table, row, error: True)
+
+    future = score("wl_1", 4)
+    analytics._write_to_azure_sql({"function_name": "f", "id": "wl_1"})
+    # The score is merged into the queued INSERT, which is not committed yet
+    assert not future.done() and database.rows == {}
 
-def test_write_to_azure_sql():
-    response_id = "chatcmpl-8jnIJAkEKBQJn5cs7QCJ1wIcBaII2"
-    assert score(response_id, 100) == True  # Returns true if no errors
+    assert writer.flush(timeout=5)
+    result = future.result(timeout=1)
+    assert (result.id, result.rows_updated, result.with_insert) == ("wl_1", 1, True)
+    assert database.rows["wl_1"]["score"] == 4
 
+    # When the row cannot be written the score fails with it
+    future = score("wl_2", 1)
+    analytics._write_to_azure_sql({"function_name": "bad", "id": "wl_2"})
+    assert writer.flush(timeout=5)
+    with pytest.raises(ValueError, match="right truncation"):
+        future.result(timeout=1)
@@ -0,0 +1,95 @@
+# test_scoring.py
+from wonkalytics import scoring
+from wonkalytics.config import Config
+from wonkalytics.projection import AnalyticsRow
+from wonkalytics.scoring import ScoreWriter, resolve_with_insert
+
+
+class FakeCursor:
+    def __init__(self, table, statements):
+        self.table = table
+        self.statements = statements
+        self._updated = []
+
+    def execute(self, sql, params):
+        # UPDATE t SET ... FROM [table] AS t JOIN (VALUES (?, ?), ...) AS v (id, [col], ...) ON t.id = v.id
+        self.statements.append(sql)
+        columns = sql.split(" AS v (id, ")[1].split(")")[0].replace("[", "").replace("]", "").split(", ")
+        width = len(columns) + 1
+        self._updated = []
+        for start in range(0, len(params), width):
+            row_id, *values = params[start : start + width]
+            if row_id in self.table:
+                self.table[row_id].update(zip(columns, values))
+                self._updated.append((row_id,))
+
+    def fetchall(self):
+        return self._updated
+
+
+class FakePool:
+    def __init__(self, table):
+        self.table = table
+        self.statements = []
+
+    def run(self, func):
+        cnxn = self
+
+        class Connection:
+            def cursor(self):
+                return FakeCursor(cnxn.table, cnxn.statements)
+
+            def commit(self):
+                pass
+
+        return func(Connection())
+
+
+def test_updates_are_coalesced_and_applied_in_one_statement():
+    pool = FakePool({"wl_1": {}, "wl_2": {}})
+    writer = ScoreWriter(max_latency=60)
+    futures = [
+        writer.submit(pool, "analytics", "wl_1", {"score": 1}),
+        writer.submit(pool, "analytics", "wl_1", {"score": 5}),
+        writer.submit(pool, "analytics", "wl_2", {"score": 3}),
+    ]
+    assert writer.flush(timeout=5)
+    assert len(pool.statements) == 1
+    assert pool.table == {"wl_1": {"score": 5}, "wl_2": {"score": 3}}
+    assert [future.result(timeout=1).rows_updated for future in futures] == [1, 1, 1]
+    writer.close()
+
+
+def test_updates_of_rows_not_written_yet_are_held():
+    pool = FakePool({})
+    writer = ScoreWriter(max_latency=60, retry_interval=60)
+    future = writer.submit(pool, "analytics", "wl_1", {"score": 4})
+    assert writer.flush(timeout=5)
+    assert not future.done()
+
+    # The row's INSERT picks up the held update
+    row, merged = writer.merge_pending(pool, "analytics", AnalyticsRow(("id", "model"), ["wl_1", "gpt-4"]))
+    assert row.as_dict() == {"id": "wl_1", "model": "gpt-4", "score": 4}
+    resolve_with_insert(merged)
+    result = future.result(timeout=1)
+    assert result.rows_updated == 1 and result.with_insert
+    writer.close()
+
+
+def test_updates_of_missing_rows_expire():
+    pool = FakePool({})
+    writer = ScoreWriter(max_latency=0.05, retry_interval=0.01, pending_ttl=0.2)
+    future = writer.submit(pool, "analytics", "wl_missing", {"score": 1})
+    result = future.result(timeout=5)
+    assert not result and result.rows_updated == 0
+    assert writer.expired == 1
+    writer.close()
+
+
+def test_environment_enables_score_batching_until_disabled(monkeypatch):
+    monkeypatch.setattr(scoring, "get_config", lambda: Config(score_batching=True))
+    monkeypatch.setattr(scoring._writer, "_disabled", False)
+    writer = scoring.get_score_writer()
+    assert writer is not None and scoring.get_score_writer() is writer
+    scoring.disable_score_batching()
+    assert scoring.get_score_writer() is None
@@ -0,0 +1,42 @@
+# test_serialization.py
+import json
+from datetime import datetime
+import pytest
+from wonkalytics.serialization import EncodedEvent, decode_event, dumps, encode_event, is_json_serializable
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        "text",
+        3,
+        0.5,
+        None,
+        [{"role": "user", "content": "Hi"}],
+        {"nested": {"list": [1, 2.0, True]}},
+        {1: "int keys are allowed by json.dumps"},
+        object(),
+        [lambda: None],
+        {"client": object()},
+        {("tuple", "key"): 1},
+    ],
+)
+def test_serializable_check_agrees_with_json_dumps(value):
+    try:
+        json.dumps(value)
+        expected = True
+    except Exception:
+        expected = False
+    assert is_json_serializable(value) == expected
+
+
+def test_encoded_event_is_encoded_once():
+    event = EncodedEvent({"kwargs": {"messages": [{"role": "user", "content": "Hi"}]}})
+    assert event.body is event.body
+    assert json.loads(event.body) == event.event
+
+
+def test_stored_events_keep_datetimes():
+    event = {"timestamp": datetime(2024, 1, 31, 12, 30), "id": "wl_1"}
+    assert decode_event(encode_event(event)) == event
+    assert json.loads(dumps({"id": "wl_1"})) == {"id": "wl_1"}
@@ -0,0 +1,89 @@
+# test_spool.py
+from datetime import datetime
+from wonkalytics import spool as spool_module
+from wonkalytics.serialization import EncodedEvent
+from wonkalytics.spool import Spool, register_sink
+
+
+def test_events_survive_reopening_and_keep_datetimes(tmp_path):
+    path = str(tmp_path / "spool.db")
+    timestamp = datetime(2024, 1, 31, 12, 30)
+    spool = Spool(path)
+    spool.append("sql", {"id": "wl_1", "timestamp": timestamp}, TimeoutError("Login timeout expired"))
+    spool.close()
+
+    spool = Spool(path)
+    [(_, sink, event, attempts)] = spool.due()
+    assert sink == "sql"
+    assert event == {"id": "wl_1", "timestamp": timestamp}
+    assert attempts == 0
+    assert spool.list()[0]["last_error"] == "Login timeout expired"
+    spool.close()
+
+
+def test_replay_delivers_and_backs_off_failing_sinks(tmp_path):
+    delivered = []
+    register_sink("test_up", delivered.append)
+    register_sink("test_down", lambda event: (_ for _ in ()).throw(ConnectionError("down")))
+
+    spool = Spool(str(tmp_path / "spool.db"))
+    spool.append("test_up", {"i": 1})
+    spool.append("test_down", {"i": 2})
+    spool.append("test_down", {"i": 3})
+
+    assert spool.replay(base_delay=60) == {"delivered": 1, "failed": 1, "skipped": 1}
+    assert delivered == [{"i": 1}]
+    # The failed event is postponed, the skipped one is still due
+    assert [event for _, _, event, _ in spool.due()] == [{"i": 3}]
+    assert spool.stats()["events"] == {"test_down": 2}
+    spool.close()
+
+
+def test_size_cap_drops_oldest_events(tmp_path):
+    spool = Spool(str(tmp_path / "spool.db"), max_bytes=100)
+    for i in range(10):
+        spool.append("sql", {"i": i, "pad": "x" * 20})
+    assert spool.stats()["bytes"] <= 100
+    assert spool.dropped > 0
+    assert spool.due()[-1][2]["i"] == 9
+    spool.close()
+
+
+def test_cli_stats(tmp_path, capsys):
+    path = str(tmp_path / "spool.db")
+    spool = Spool(path)
+    spool.append("promptlayer", {"i": 1})
+    spool.close()
+
+    spool_module.main(["--path", path, "stats"])
+    assert '"promptlayer": 1' in capsys.readouterr().out
+
+
+def test_processes_sharing_a_spool_claim_different_events(tmp_path):
+    path = str(tmp_path / "spool.db")
+    first, second = Spool(path), Spool(path)
+    for i in range(5):
+        first.append("sql", {"i": i})
+
+    claimed = first.claim(limit=3)
+    assert [event["i"] for _, _, event, _ in claimed] == [0, 1, 2]
+    assert [event["i"] for _, _, event, _ in second.claim()] == [3, 4]
+    assert second.claim() == []
+
+    # Released events can be claimed again, the size is read from the shared database
+    first.release([event_id for event_id, _, _, _ in claimed])
+    assert len(second.claim()) == 3
+    second.ack(claimed[0][0])
+    assert first.stats()["events"] == {"sql": 4}
+    assert first.stats()["bytes"] == second.stats()["bytes"]
+    first.close()
+    second.close()
+
+
+def test_api_key_is_not_written_to_disk(tmp_path):
+    path = str(tmp_path / "spool.db")
+    spool = Spool(path)
+    spool.append("promptlayer", EncodedEvent({"function_name": "f", "api_key": "pl_secret"}))
+    spool.close()
+    with open(path, "rb") as f:
+        assert b"pl_secret" not in f.read()
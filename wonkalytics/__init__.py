@@ -1,6 +1,53 @@
-# Import necessary modules from your package
-from .analytics import _write_to_azure_sql, score
-from .openai_wrapper import OpenAIWrapper  # Example of another import
+# The public API is imported on first use, so 'import wonkalytics' stays cheap on a cold start
+import importlib
+
+# Public names mapped to the module that defines them
+_EXPORTS = {
+    "_write_to_azure_sql": "analytics",
+    "score": "analytics",
+    "OpenAIWrapper": "openai_wrapper",
+    "enable_background_logging": "dispatcher",
+    "disable_background_logging": "dispatcher",
+    "flush": "dispatcher",
+    "enable_batch_writes": "batch",
+    "disable_batch_writes": "batch",
+    "enable_dedup": "dedup",
+    "disable_dedup": "dedup",
+    "enable_sampling": "sampling",
+    "disable_sampling": "sampling",
+    "enable_score_batching": "scoring",
+    "disable_score_batching": "scoring",
+    "enable_response_cache": "cache",
+    "disable_response_cache": "cache",
+    "enable_rate_limiting": "ratelimit",
+    "disable_rate_limiting": "ratelimit",
+    "enable_circuit_breakers": "breaker",
+    "disable_circuit_breakers": "breaker",
+    "add_breaker_listener": "breaker",
+    "enable_metrics": "metrics",
+    "render_prometheus": "metrics",
+    "configure": "config",
+    "get_config": "config",
+    "aflush": "async_analytics",
+    "aclose": "async_analytics",
+    "ascore": "async_analytics",
+}
+
+__all__ = sorted(_EXPORTS)
 
 # Optionally, define any package-level constants or variables
-__version__ = '0.1.0'
\ No newline at end of file
+__version__ = '0.1.0'
+
+
+def __getattr__(name):
+    module_name = _EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module_name}", __name__), name)
+    # Cached, later lookups do not go through __getattr__
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
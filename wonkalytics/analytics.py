@@ -1,28 +1,32 @@
-import os
-import pyodbc
 import logging
+import os
 from datetime import datetime
 from .authinfo import extract_auth_info_pl_tags
-from dotenv import load_dotenv
-import json
-import requests
+from .breaker import CircuitOpenError
+from .dedup import get_deduplicator
+from .dispatcher import get_dispatcher
+from .batch import get_batch_writer
+from .collector import get_collector_client
+from .config import get_config
+from .metrics import count_dropped, count_event, count_sink, set_backlog, time_stage
+from .pool import get_pool
+from .promptlayer import get_promptlayer_client, track_request
+from .serialization import EncodedEvent, is_json_serializable
+from .projection import get_projection_plan
+from .sampling import DROP, FULL, SLIM, get_sampling_policy
+from .scoring import ScoreResult, get_score_writer, merge_into_row, resolve_with_insert
+from .schema import get_table_schema, refresh_table_schema, is_invalid_column_error
+from .spool import register_sink, spool_failed_event
 import sys
 import uuid
 
-load_dotenv()
 
-
-URL_API_PROMPTLAYER = os.environ.setdefault(
-    "URL_API_PROMPTLAYER", "https://api.promptlayer.com"
-)
+# Arguments that hold the prompt, left out of slim events
+_PAYLOAD_KWARGS = frozenset(("messages", "prompt", "functions", "tools", "input"))
 
 
 def _check_if_json_serializable(value):
-    try:
-        json.dumps(value)
-        return True
-    except Exception:
-        return False
+    return is_json_serializable(value)
 
 
 def get_uid():
@@ -42,6 +46,7 @@ def wonkalytics_and_promptlayer_api_request(
     api_key,
     return_pl_id=False,
     metadata=None,
+    uid=None,
 ):
     """
     Send analytics data to both Wonkalytics and PromptLayer APIs and log requests to an Azure SQL database.
@@ -63,44 +68,40 @@ def wonkalytics_and_promptlayer_api_request(
         api_key (str): API key for authenticating the request.
         return_pl_id (bool, optional): Flag to determine if the PromptLayer request ID should be returned. Defaults to False.
         metadata (dict, optional): Additional metadata to include in the analytics data.
+        uid (str, optional): The Wonkalytics id to log the event with, when it was handed out before. Generated by default.
 
     Returns:
-        str or None: The request ID from PromptLayer if 'return_pl_id' is True; otherwise, None.
+        str: The Wonkalytics id of the event. It is generated up front, so it is returned right away
+             even when the event is sent by the background dispatcher (see dispatcher.enable_background_logging).
+             None when the event was not logged by the sampling policy (see sampling.enable_sampling).
 
     Raises:
         ValueError: If 'kwargs' contains non-JSON-serializable values.
         Exception: For any issues encountered during the POST request or Azure SQL logging.
     """
-    request_response = None
+    # The id is generated up front so it can be returned before the event is sent
+    uid = uid or get_uid()
     try:
-        # value for both promptlayer and wonkalytics
-        json_post_dict = {
-            "function_name": function_name,
-            "provider_type": provider_type,
-            "args": args,
-            "kwargs": {
-                k: v for k, v in kwargs.items() if _check_if_json_serializable(v)
-            },
-            "api_key": api_key,
-            "tags": tags,
-            "request_response": response,
-            "request_start_time": request_start_time,
-            "request_end_time": request_end_time,
-            "metadata": metadata,
-        }
-
-        request_response = requests.post(
-            f"{URL_API_PROMPTLAYER}/track-request",
-            json=json_post_dict,
+        json_post_dict = _sample_and_build_event(
+            function_name,
+            provider_type,
+            args,
+            kwargs,
+            tags,
+            request,
+            response,
+            request_start_time,
+            request_end_time,
+            api_key,
+            return_pl_id,
+            metadata,
         )
+        if json_post_dict is None:
+            return None
 
-        # For us this is valuable but promptlayer can't handle this
-        json_post_dict["request"] = request
-        uid = get_uid()
-        json_post_dict["id"] = uid
-
-        # Wonkalytics
-        _write_to_azure_sql(json_post_dict)
+        timestamp = datetime.now()
+        if not _hand_off_event(json_post_dict, request, uid, timestamp):
+            _send_analytics_event(json_post_dict, request, uid, timestamp)
 
     except Exception as e:
         print(
@@ -111,6 +112,217 @@ def wonkalytics_and_promptlayer_api_request(
     return uid
 
 
+def _sample_and_build_event(
+    function_name,
+    provider_type,
+    args,
+    kwargs,
+    tags,
+    request,
+    response,
+    request_start_time,
+    request_end_time,
+    api_key,
+    return_pl_id,
+    metadata,
+):
+    """
+    Apply the sampling policy and build the event, the first steps of both the sync and the async logging path.
+
+    Returns:
+        dict: The event, see _build_analytics_event. None when the sampling policy dropped it.
+    """
+    decision = FULL
+    policy = get_sampling_policy()
+    if policy is not None:
+        decision = policy.decide_event(function_name, kwargs, tags, request, metadata, return_pl_id)
+    count_event(decision)
+    if decision == DROP:
+        count_dropped("sampled")
+        return None
+
+    with time_stage("build"):
+        return _build_analytics_event(
+            function_name,
+            provider_type,
+            args,
+            kwargs,
+            tags,
+            response,
+            request_start_time,
+            request_end_time,
+            api_key,
+            metadata,
+            slim=decision == SLIM,
+        )
+
+
+def _hand_off_event(json_post_dict, request, uid, timestamp) -> bool:
+    """
+    Hand an event to the collector or the background dispatcher when one of them is enabled.
+
+    Returns:
+        bool: True if the event was handed off (or dropped by a full queue), False when the caller sends it.
+    """
+    if _forward_to_collector(json_post_dict, request, uid, timestamp):
+        return True
+    dispatcher = get_dispatcher()
+    if dispatcher is None:
+        return False
+    _submit_to_dispatcher(dispatcher, json_post_dict, request, uid, timestamp)
+    return True
+
+
+def _forward_to_collector(json_post_dict, request, uid, timestamp):
+    """
+    Hand an event to the node's collector process (see collector.enable_collector_client).
+
+    Returns:
+        bool: True if the collector took the event, False when it is sent from this process.
+    """
+    client = get_collector_client()
+    if client is None:
+        return False
+    if client.send(json_post_dict, request, uid, timestamp):
+        count_sink("collector", "success")
+        return True
+    count_sink("collector", "failure")
+    return False
+
+
+def _submit_to_dispatcher(dispatcher, json_post_dict, request, uid, timestamp):
+    """ Queue an event on the background dispatcher, counting it as dropped when the queue is full. """
+    if not dispatcher.submit(_send_analytics_event, json_post_dict, request, uid, timestamp):
+        count_dropped("queue_full")
+    set_backlog(dispatcher)
+
+
+def _build_analytics_event(
+    function_name,
+    provider_type,
+    args,
+    kwargs,
+    tags,
+    response,
+    request_start_time,
+    request_end_time,
+    api_key,
+    metadata=None,
+    slim=False,
+):
+    """
+    Build the event that is sent to PromptLayer and, with the request and id added, to Wonkalytics.
+
+    A slim event (logged while shedding load, see sampling.SamplingPolicy) leaves out the prompt
+    arguments and the response choices, but keeps e.g. the model, the usage and the timing.
+    """
+    if slim:
+        kwargs = {k: v for k, v in kwargs.items() if k not in _PAYLOAD_KWARGS}
+        response = _slim_response(response)
+        metadata = dict(metadata or {}, sampling="shed")
+    # value for both promptlayer and wonkalytics
+    return {
+        "function_name": function_name,
+        "provider_type": provider_type,
+        "args": args if not slim else [],
+        # Lists are copied so the caller can keep appending to e.g. its messages while the event is queued
+        "kwargs": {
+            k: list(v) if isinstance(v, list) else v
+            for k, v in kwargs.items()
+            if _check_if_json_serializable(v)
+        },
+        "api_key": api_key,
+        "tags": tags,
+        "request_response": response,
+        "request_start_time": request_start_time,
+        "request_end_time": request_end_time,
+        "metadata": metadata,
+    }
+
+
+def _slim_response(response):
+    if hasattr(response, "model_dump"):
+        return response.model_dump(exclude={"choices"})
+    if isinstance(response, dict):
+        return {k: v for k, v in response.items() if k != "choices"}
+    return None
+
+
+def _send_analytics_event(json_post_dict, request, uid, timestamp=None):
+    """
+    Send a prepared analytics event to PromptLayer and write it to the Azure SQL database.
+
+    Runs inline or on a background dispatcher worker, so errors are reported rather than raised.
+
+    Args:
+        json_post_dict (dict): The event as sent to PromptLayer.
+        request (dict): The request variables, only logged to Wonkalytics.
+        uid (str): The Wonkalytics id for the row.
+        timestamp (datetime, optional): When the event happened, defaults to when it is written.
+    """
+    # The sinks are independent, PromptLayer being unavailable should not stop the SQL log and vice versa
+    # Encoded once, the same bytes are sent to PromptLayer and, if that fails, spooled
+    pl_event = _promptlayer_event(json_post_dict)
+    try:
+        with time_stage("promptlayer"):
+            track_request(pl_event)
+        count_sink("promptlayer", "success")
+    except Exception as e:
+        _report_sink_failure("promptlayer", e, spool_failed_event("promptlayer", pl_event, e))
+
+    sql_item = _sql_item(json_post_dict, request, uid, timestamp)
+    try:
+        # Wonkalytics
+        _write_to_azure_sql(sql_item)
+        count_sink("sql", "success")
+    except Exception as e:
+        # Connection problems and timeouts are spooled to disk and replayed once the database is back
+        _report_sink_failure("sql", e, spool_failed_event("sql", sql_item, e))
+
+
+def _promptlayer_event(json_post_dict) -> EncodedEvent:
+    """
+    The event as sent to PromptLayer, encoded once for the request and the spool.
+
+    PromptLayer only accepts string metadata values, so e.g. the stream timings and 'cache_hit' are sent
+    as strings. The SQL row keeps them as numbers.
+    """
+    metadata = json_post_dict.get("metadata")
+    if metadata and any(not isinstance(value, str) for value in metadata.values()):
+        metadata = {
+            key: value if isinstance(value, str) else str(value) for key, value in metadata.items() if value is not None
+        }
+        json_post_dict = dict(json_post_dict, metadata=metadata)
+    return EncodedEvent(json_post_dict)
+
+
+def _sql_item(json_post_dict, request, uid, timestamp=None) -> dict:
+    """ The event as written to Azure SQL, with the request variables PromptLayer can't handle and the id. """
+    sql_item = dict(json_post_dict, request=request, id=uid)
+    if timestamp is not None:
+        sql_item["timestamp"] = timestamp
+    return sql_item
+
+
+def _report_sink_failure(sink: str, error: Exception, spooled: bool):
+    """
+    Count the outcome of an event a sink did not take, shared by the sync and async logging paths.
+
+    Events that were spooled, or rejected by an open circuit breaker (which reported that it opened), are not printed.
+    """
+    if spooled:
+        count_sink(sink, "spooled")
+    elif isinstance(error, CircuitOpenError):
+        count_sink(sink, "rejected")
+    else:
+        count_sink(sink, "failure")
+        destination = " to PromptLayer" if sink == "promptlayer" else ""
+        print(
+            f"WARNING: While logging your request{destination} Wonkalytics had the following error: {error}",
+            file=sys.stderr,
+        )
+
+
 def _write_to_azure_sql(
     item: dict,
     encrypt: str = "yes",
@@ -149,14 +361,12 @@ def _write_to_azure_sql(
     if not isinstance(item, dict):
         raise ValueError("Wonkalytics, analytics log item should be a dict.")
 
-    # Check if all environment variables are set
-    server = os.getenv("AZURE_SQL_SERVER")
-    database = os.getenv("AZURE_SQL_DB")
-    username = os.getenv("AZURE_SQL_USER")
-    password = os.getenv("AZURE_SQL_PASSWORD")
-    table_name = os.getenv("AZURE_TABLE_NAME")
-
-    _check_required_env_variables(server, database, username, password, table_name)
+    # The settings are resolved once, see config.configure to change them
+    config = get_config()
+    config.require_sql()
+    server, database, username, password, table_name = (
+        config.server, config.database, config.username, config.password, config.table_name
+    )
 
     # Filter the item for allowed keys
     proc_item = _item_to_analytics_log(
@@ -171,21 +381,130 @@ def _write_to_azure_sql(
         trust_server_certificate,
     )
 
-    # Build connection string from vars
-    cnxn_str = f"DRIVER={{ODBC Driver 18 for SQL Server}};SERVER={server};DATABASE={database};Uid={username};Pwd={password};Encrypt={encrypt};TrustServerCertificate={trust_server_certificate};Connection Timeout={connection_timeout};"
+    pool = get_pool(
+        server,
+        database,
+        username,
+        password,
+        encrypt,
+        connection_timeout,
+        trust_server_certificate,
+    )
 
-    # Perform the actual log addition in the SQL table
-    with pyodbc.connect(cnxn_str) as cnxn:
-        cursor = cnxn.cursor()
-        columns = ", ".join(proc_item.keys())
+    # Large repeated texts are stored once and referenced by their hash
+    deduplicator = get_deduplicator()
+    if deduplicator is not None:
+        proc_item = deduplicator.dedup(proc_item, pool)
+
+    # Scores that arrived before the row are written with it
+    merged_scores = None
+    score_writer = get_score_writer()
+    if score_writer is not None:
+        proc_item, merged_scores = score_writer.merge_pending(pool, table_name, proc_item)
+
+    # In batch mode the row is inserted together with other rows by the batch writer,
+    # the merged scores are resolved once its batch is committed (or failed)
+    batch_writer = get_batch_writer()
+    if batch_writer is not None and batch_writer.add(
+        pool,
+        table_name,
+        proc_item,
+        lambda: refresh_table_schema(
+            table_name,
+            server,
+            database,
+            username,
+            password,
+            encrypt,
+            connection_timeout,
+            trust_server_certificate,
+        ).column_names,
+        None if merged_scores is None else lambda error: resolve_with_insert(merged_scores, error),
+    ):
+        return True
+
+    def insert(cnxn):
+        columns = ", ".join(proc_item.columns)
         placeholders = ", ".join(["?"] * len(proc_item))
         sql = f"INSERT INTO [{table_name}] ({columns}) VALUES ({placeholders})"
-        cursor.execute(sql, list(proc_item.values()))
+        cursor = cnxn.cursor()
+        cursor.execute(sql, proc_item.values)
         cnxn.commit()
 
+    # Perform the actual log addition in the SQL table
+    try:
+        with time_stage("insert"):
+            pool.run(insert)
+    except Exception as e:
+        if not is_invalid_column_error(e):
+            if merged_scores is not None:
+                resolve_with_insert(merged_scores, e)
+            raise
+        # A column was dropped or renamed since the schema was cached, reload it and retry once
+        logging.warning(f"Wonkalytics table schema changed, reloading it: {e}")
+        proc_item = _item_to_analytics_log(
+            item,
+            server,
+            database,
+            username,
+            password,
+            table_name,
+            encrypt,
+            connection_timeout,
+            trust_server_certificate,
+            refresh=True,
+        )
+        if deduplicator is not None:
+            proc_item = deduplicator.dedup(proc_item, pool)
+        if merged_scores is not None:
+            proc_item = merge_into_row(proc_item, merged_scores.values)
+        try:
+            pool.run(insert)
+        except Exception as retry_error:
+            if merged_scores is not None:
+                resolve_with_insert(merged_scores, retry_error)
+            raise
+
+    if merged_scores is not None:
+        resolve_with_insert(merged_scores)
     return True
 
 
+def _insert_analytics_row(
+    event: dict,
+    encrypt: str = "yes",
+    connection_timeout: int = 30,
+    trust_server_certificate: str = "no",
+):
+    """
+    Insert an already processed row, used to replay rows of a failed batch from the spool.
+
+    Args:
+        event (dict): A dict with the 'table_name' and the 'row' mapping column names to values.
+    """
+    config = get_config()
+    config._replace(table_name=event["table_name"]).require_sql()
+    server, database, username, password = config.server, config.database, config.username, config.password
+
+    row = event["row"]
+    sql = f"INSERT INTO [{event['table_name']}] ({', '.join(row)}) VALUES ({', '.join(['?'] * len(row))})"
+
+    def insert(cnxn):
+        cursor = cnxn.cursor()
+        cursor.execute(sql, list(row.values()))
+        cnxn.commit()
+
+    get_pool(
+        server,
+        database,
+        username,
+        password,
+        encrypt,
+        connection_timeout,
+        trust_server_certificate,
+    ).run(insert)
+
+
 def score(
     response_id: str,
     score: int,
@@ -201,9 +520,10 @@ def score(
         score (float): The new score value to set in the 'score' column.
 
     Returns:
-        bool: True if the update was successful, False otherwise.
+        ScoreResult: The number of rows updated, truthy if the row was found. When score batching is
+                     enabled (see scoring.enable_score_batching) a Future that resolves to the ScoreResult.
     """
-    update_row_property(
+    return update_row_property(
         response_id,
         "score",
         score,
@@ -230,34 +550,46 @@ def update_row_property(
         property_value : The new value to set in the column
 
     Returns:
-        bool: True if the update was successful, False otherwise.
+        ScoreResult: The number of rows updated, truthy if the row was found. When score batching is
+                     enabled a Future that resolves to the ScoreResult, also for rows that are still queued.
     """
-    # Check if all environment variables are set
-    server = os.getenv("AZURE_SQL_SERVER")
-    database = os.getenv("AZURE_SQL_DB")
-    username = os.getenv("AZURE_SQL_USER")
-    password = os.getenv("AZURE_SQL_PASSWORD")
-    table_name = os.getenv("AZURE_TABLE_NAME")
+    # The settings are resolved once, see config.configure to change them
+    config = get_config()
+    config.require_sql()
+    server, database, username, password, table_name = (
+        config.server, config.database, config.username, config.password, config.table_name
+    )
 
-    _check_required_env_variables(server, database, username, password, table_name)
+    pool = get_pool(
+        server,
+        database,
+        username,
+        password,
+        encrypt,
+        connection_timeout,
+        trust_server_certificate,
+    )
 
-    # Build connection string from vars
-    cnxn_str = f"DRIVER={{ODBC Driver 18 for SQL Server}};SERVER={server};DATABASE={database};Uid={username};Pwd={password};Encrypt={encrypt};TrustServerCertificate={trust_server_certificate};Connection Timeout={connection_timeout};"
+    # Buffered updates are applied in bulk, and held until the row exists
+    score_writer = get_score_writer()
+    if score_writer is not None:
+        return score_writer.submit(pool, table_name, response_id, {property_name: property_value})
 
-    # Perform the actual log addition in the SQL table
-    with pyodbc.connect(cnxn_str) as cnxn:
-        cursor = cnxn.cursor()
+    # Construct the SQL UPDATE statement with parameterized query
+    sql = f"UPDATE [{table_name}] SET {property_name} = ? WHERE id = ?"
 
-        # Construct the SQL UPDATE statement with parameterized query
-        sql = f"UPDATE [{table_name}] SET {property_name} = ? WHERE id = ?"
+    def update(cnxn):
+        cursor = cnxn.cursor()
 
         # Execute the UPDATE statement with the provided score and response_id as parameters
         cursor.execute(sql, (property_value, response_id))
+        rows_updated = cursor.rowcount
 
         # Commit the transaction
         cnxn.commit()
+        return rows_updated
 
-    return True
+    return ScoreResult(response_id, pool.run(update))
 
 
 def _item_to_analytics_log(
@@ -270,17 +602,19 @@ def _item_to_analytics_log(
     encrypt: str = "yes",
     connection_timeout: int = 30,
     trust_server_certificate: str = "no",
+    refresh: bool = False,
 ):
     """
     Process an item for logging in the analytics SQL database.
 
-    This function handles several preprocessing steps:
+    The item is projected onto the table's columns by the table's projection plan (see
+    projection.ProjectionPlan), which handles the preprocessing steps:
     - Flattens nested dictionaries in the item.
     - Processes and extracts specific data from ChatGPT messages.
     - Extracts and elevates a response message to the top level.
-    - Removes specific prefixes ('kwargs_' and 'request_') from keys.
+    - Removes specific prefixes ('kwargs_', 'request_' and 'metadata_') from keys.
     - Extracts authentication information and adds tenant ID, username, and email to the item.
-    - Timestamps the item with the current datetime.
+    - Timestamps the item with the current datetime, unless it was stamped when it was queued.
     - Filters the item's keys to match the allowed columns in the SQL table.
 
     Args:
@@ -293,260 +627,49 @@ def _item_to_analytics_log(
         encrypt (str): Encryption option for SQL connection.
         connection_timeout (int): Timeout for SQL connection.
         trust_server_certificate (str): Option to trust the SQL server certificate.
+        refresh (bool): Reload the table schema instead of using the cached one.
 
     Returns:
-        dict: Processed dictionary item ready for SQL logging.
-    """
-    # Get authinfo (may be None) must be done BEFORE flattening
-    auth_info = item.get("request", {}).get("auth_info", None)
-    tenantid, user_name, user_mail = extract_auth_info_pl_tags(auth_info)
-    item["tenant_id"] = tenantid
-    item["username"] = user_name
-    item["email"] = user_mail
-
-    flattened_item = _flatten_dict(item)
-
-    # After flattening raise the chatgpt messages to the top level
-    proc_item = _process_chatgpt_msgs(flattened_item)
-
-    # After flattening raise the response message to the top level
-    proc_item = _extract_response_msg(flattened_item)
-
-    # Remove prefixes
-    _remove_prefix_from_keys(proc_item, "kwargs_")
-    _remove_prefix_from_keys(proc_item, "request_")
-
-    # Timestamp the item
-    proc_item["timestamp"] = datetime.now()
-
-    # Filter for allowed column keys in SQL table
-    allowed_keys = _get_allowed_keys(
-        table_name,
-        server,
-        database,
-        username,
-        password,
-        encrypt,
-        connection_timeout,
-        trust_server_certificate,
-    )
-    filtered_item = _filter_allowed_keys(proc_item, allowed_keys)
-
-    logging.info("Wonkalytics item to log after processing and key filtering")
-    logging.info(filtered_item)
-
-    return filtered_item
-
-
-def _remove_prefix_from_keys(original_dict, prefix):
-    """
-    Remove a specified prefix from the keys in a dictionary.
-    If removing a prefix results in overwriting an existing key, a warning is logged.
-
-    Args:
-        original_dict (dict): Dictionary whose keys are to be modified.
-        prefix (str): The prefix to be removed from the keys.
-
-    Returns:
-        None: The function modifies the dictionary in place.
-    """
-    for key in list(original_dict.keys()):
-        if key.startswith(prefix):
-            new_key = key.removeprefix(prefix)
-            if new_key in original_dict:
-                logging.warning(
-                    f"Removing prefix: {prefix} overwrites existing key: {new_key}"
-                )
-            original_dict[new_key] = original_dict.pop(key)
-
-
-def _extract_response_msg(item: dict) -> dict:
-    """
-    Extract the response message from a nested structure within the given dictionary and
-    add it to the top level of the dictionary.
-
-    Assumes the response message is located at item['request_response_choices'][0]['content'].
-    Adds this message under the key 'response'.
-    """
-    if "request_response_choices" in item:
-        if "content" in item["request_response_choices"][0].keys():
-            item["response"] = item["request_response_choices"][0]["content"]
-        if "message" in item["request_response_choices"][0].keys():
-            item["response"] = item["request_response_choices"][0]["message"]["content"]
-    return item
-
-
-def _process_chatgpt_msgs(item: dict) -> dict:
-    """
-    Extract and process ChatGPT messages from the given dictionary,
-    specifically handling 'system' messages and other roles like 'user' and 'assistant'.
-
-    The function pops the 'kwargs_messages' from the item, processes them, and then updates
-    the original item with these messages. 'System' messages are logged under 'system_msg',
-    while other messages are concatenated and logged under 'messages'.
-
-    Args:
-        item (dict): The dictionary containing ChatGPT messages under 'kwargs_messages'.
-
-    Returns:
-        dict: The original dictionary updated with processed ChatGPT messages.
+        AnalyticsRow: The processed row ready for SQL logging.
     """
-    # There might be logging requests without ChatGPT messages
-    messages = item.pop("kwargs_messages", [])
-
-    if len(messages) == 0:
-        logging.warning(
-            "The item that you want to log with Wonkalytics has no ChatGPT messages. If this is intentional you can ignore this warning."
+    with time_stage("schema_lookup"):
+        schema = get_table_schema(
+            table_name,
+            server,
+            database,
+            username,
+            password,
+            encrypt,
+            connection_timeout,
+            trust_server_certificate,
+            refresh=refresh,
         )
+    with time_stage("projection"):
+        row = get_projection_plan(schema).project(item)
 
-    analytics_key_vals = _map_messages_to_keyvals(messages)
-
-    # Update the item to log with the messages
-    for key, val in analytics_key_vals.items():
-        item[key] = val
-
-    return item
-
-
-def _map_messages_to_keyvals(messages: list[dict]) -> dict:
-    """
-    Converts a list of ChatGPT message dictionaries into a format suitable for analytics.
-    This function segregates 'system' messages and compiles other messages into a single string.
-
-    Each message in the list is examined for its 'role'. Messages with the 'system' role are
-    stored under the 'system_msg' key. Other messages are concatenated into a single string,
-    separated by their roles and line breaks, and stored under the 'messages' key. This allows
-    for easy distinction between system-generated messages and user/assistant interactions in the analytics.
-
-    Args:
-        messages (list[dict]): A list of message dictionaries, each containing 'role' and 'content' keys.
-
-    Returns:
-        dict: A dictionary with two keys, 'system_msg' and 'messages', containing the processed messages.
-              'system_msg' contains the content of the last 'system' role message. 'messages' contains
-              a concatenated string of all other messages.
-    """
-    analytics_key_vals = {}
-    non_system_msgs = ""
-
-    for msg in messages:
-        if msg["role"] == "system":
-            analytics_key_vals["system_msg"] = msg["content"]
-        # There might be situations where 'user' and 'assistent' messages are pre-given (before the response) to give examples to the model. These should be separately logged from the "actual" user and assistent messages.
-        else:
-            non_system_msgs += msg["role"] + ":\n"
-            non_system_msgs += msg["content"] + "\n\n"
-
-    analytics_key_vals["messages"] = non_system_msgs
-
-    return analytics_key_vals
-
-
-def _get_allowed_keys(
-    table_name: str,
-    server: str,
-    database: str,
-    username: str,
-    password: str,
-    encrypt: str = "yes",
-    connection_timeout: int = 30,
-    trust_server_certificate: str = "no",
-) -> set:
-    """
-    Retrieves the column names from a specified table in the Azure SQL database.
-
-    Parameters:
-    table_name (str): The name of the table to retrieve column names from.
-
-    Returns:
-    set: A set of strings representing the column names in the table.
-
-    Raises:
-    Exception: Propagates any exceptions that occur during the database operation.
-    """
-    cnxn_str = f"DRIVER={{ODBC Driver 18 for SQL Server}};SERVER={server};DATABASE={database};Uid={username};Pwd={password};Encrypt={encrypt};TrustServerCertificate={trust_server_certificate};Connection Timeout={connection_timeout};"
-    query = f"SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = '{table_name}'"
-
-    with pyodbc.connect(cnxn_str) as cnxn:
-        cursor = cnxn.cursor()
-        cursor.execute(query)
-        columns = {row.COLUMN_NAME for row in cursor.fetchall()}
-
-    logging.debug(f"Table {table_name} has allowed columns: {columns}")
-    return columns
-
-
-def _filter_allowed_keys(item: dict, allowed_keys: set) -> dict:
-    """
-    Filters a dictionary to include only keys that are in a specified set of allowed keys.
-    Logs a warning for any keys in the item that are not allowed and raises an error if
-    the filtered dictionary is empty.
-
-    Parameters:
-    item (dict): The dictionary to be filtered.
-    allowed_keys (set): A set of strings representing allowed keys.
+    logging.info("Wonkalytics item to log after processing and key filtering")
+    logging.info(row)
 
-    Returns:
-    dict: A dictionary containing only the allowed keys and values.
+    return row
 
-    Raises:
-    ValueError: If the filtered dictionary is empty.
-    """
-    filtered_item = {}
-    for k, v in item.items():
-        if k in allowed_keys:
-            filtered_item[k] = v
-        else:
-            logging.warning(
-                f"Key '{k}' is not allowed in SQL table and will be ignored."
-            )
-
-    if not filtered_item:
-        raise ValueError("Filtered dictionary is empty. None of the keys are allowed.")
-
-    return filtered_item
-
-
-def _check_required_env_variables(server, database, username, password, table_name):
-    env_vars = {
-        "AZURE_SQL_SERVER": server,
-        "AZURE_SQL_DB": database,
-        "AZURE_SQL_USER": username,
-        "AZURE_SQL_PASSWORD": password,
-        "AZURE_TABLE_NAME": table_name,
-    }
-    missing_vars = [key for key, value in env_vars.items() if value is None]
-    if missing_vars:
-        raise EnvironmentError(
-            f"Missing environment variables: {', '.join(missing_vars)}"
-        )
 
+def _replay_to_promptlayer(event):
+    """ Send a spooled PromptLayer event, which was stored without its api key. """
+    if "api_key" not in event:
+        from . import openai_wrapper
 
-def _flatten_dict(item: dict, parent_key="", sep="_") -> dict:
-    """
-    Flattens a nested dictionary into a single-level dictionary with compound keys.
+        event["api_key"] = getattr(openai_wrapper, "api_key", None) or os.getenv("PROMPTLAYER_API_KEY")
+    get_promptlayer_client().track_request(event)
 
-    Parameters:
-    item (dict): The dictionary to be flattened.
-    parent_key (str, optional): The base key to use for compound key names. Defaults to ''.
-    sep (str, optional): The separator to use between compound key names. Defaults to '_'.
 
-    Returns:
-    dict: A flattened dictionary.
+# The spool replays failed events through these sinks, PromptLayer directly so replays are not buffered again
+register_sink("promptlayer", _replay_to_promptlayer)
+register_sink("sql", _write_to_azure_sql)
+register_sink("sql_row", _insert_analytics_row)
 
-    Example Usage:
-    >>> flatten_dict({'a': 1, 'b': {'c': 2, 'd': {'e': 3}}})
-    {'a': 1, 'b_c': 2, 'b_d_e': 3}
 
-    Notes:
-    - Nested dictionaries are combined into one with compound keys.
-    - Lists and other iterable types within the dictionary are not flattened.
-    """
-    items = []
-    for k, v in item.items():
-        new_key = f"{parent_key}{sep}{k}" if parent_key else k
-        if isinstance(v, dict):
-            items.extend(_flatten_dict(v, new_key, sep=sep).items())
-        else:
-            items.append((new_key, v))
-    return dict(items)
+def __getattr__(name):
+    # Kept for code that read the url from here, it is resolved with the other settings now
+    if name == "URL_API_PROMPTLAYER":
+        return get_config().promptlayer_url
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,254 @@
+import asyncio
+import functools
+import sys
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from .analytics import (
+    _hand_off_event,
+    _promptlayer_event,
+    _report_sink_failure,
+    _sample_and_build_event,
+    _send_analytics_event,
+    _sql_item,
+    _write_to_azure_sql,
+    get_uid,
+    update_row_property,
+    wonkalytics_and_promptlayer_api_request,
+)
+from .config import get_config
+from .dispatcher import get_dispatcher
+from .metrics import count_dropped, count_sink, time_stage
+from .promptlayer import atrack_request, close_async_promptlayer_client
+from .spool import spool_failed_event
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending_tasks = set()
+# Events being handed off or sent, by tasks or on the SQL executor, bounded by Config.async_max_pending
+_pending_events = 0
+_pending_lock = threading.Lock()
+
+
+def get_sql_executor() -> ThreadPoolExecutor:
+    """
+    Returns the dedicated executor for blocking SQL work from async code.
+
+    It is separate from the event loop's default executor, so logging cannot starve other
+    run_in_executor users. The number of threads is WONKALYTICS_SQL_WORKERS (default 4).
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=get_config().sql_workers,
+                    thread_name_prefix="wonkalytics-sql",
+                )
+    return _executor
+
+
+async def run_in_sql_executor(func, *args, **kwargs):
+    """ Run a blocking function on the dedicated SQL executor, keeping the caller's context variables. """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        get_sql_executor(), functools.partial(context.run, func, *args, **kwargs)
+    )
+
+
+def submit_analytics_request(
+    function_name,
+    provider_type,
+    args,
+    kwargs,
+    tags,
+    request,
+    response,
+    request_start_time,
+    request_end_time,
+    api_key,
+    return_pl_id=False,
+    metadata=None,
+    uid=None,
+):
+    """
+    Log a request without blocking the calling thread or event loop.
+
+    Takes the same arguments as wonkalytics_and_promptlayer_api_request. The event is handed to the
+    collector or the background dispatcher from the dedicated SQL executor when one of them is enabled.
+    Otherwise it is sent by a task on the running event loop, using an async HTTP client for PromptLayer
+    and the SQL executor for Azure SQL. Without a running loop (e.g. when a stream is garbage collected)
+    it is sent from the SQL executor. At most WONKALYTICS_ASYNC_MAX_PENDING events are pending at once,
+    more are dropped and counted as 'queue_full'.
+
+    Returns:
+        str: The Wonkalytics id of the event, available right away. None when the sampling policy did not log it.
+    """
+    uid = uid or get_uid()
+    try:
+        # The same steps as analytics.wonkalytics_and_promptlayer_api_request, only the sending differs
+        json_post_dict = _sample_and_build_event(
+            function_name,
+            provider_type,
+            args,
+            kwargs,
+            tags,
+            request,
+            response,
+            request_start_time,
+            request_end_time,
+            api_key,
+            return_pl_id,
+            metadata,
+        )
+        if json_post_dict is None:
+            return None
+
+        timestamp = datetime.now()
+        if not _acquire_pending():
+            count_dropped("queue_full")
+            return uid
+        try:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                future = get_sql_executor().submit(_hand_off_or_send, json_post_dict, request, uid, timestamp)
+                future.add_done_callback(_release_pending)
+                return uid
+
+            task = loop.create_task(_asend_analytics_event(json_post_dict, request, uid, timestamp))
+        except BaseException:
+            _release_pending()
+            raise
+        _pending_tasks.add(task)
+        task.add_done_callback(_task_done)
+
+    except Exception as e:
+        print(
+            f"WARNING: While logging your request Wonkalytics had the following error: {e}",
+            file=sys.stderr,
+        )
+
+    return uid
+
+
+def queue_analytics_request(*args, **kwargs):
+    """
+    Log a request without ever sending it on the calling thread, e.g. for a failed call that is re-raised
+    or a stream that is garbage collected.
+
+    Takes the arguments of wonkalytics_and_promptlayer_api_request. The event is queued on the background
+    dispatcher, or on the SQL executor when background logging is disabled or its queue is full. It
+    shares the WONKALYTICS_ASYNC_MAX_PENDING bound of submit_analytics_request.
+    """
+    dispatcher = get_dispatcher()
+    if dispatcher is not None and dispatcher.submit(wonkalytics_and_promptlayer_api_request, *args, **kwargs):
+        return
+    if not _acquire_pending():
+        count_dropped("queue_full")
+        return
+    try:
+        future = get_sql_executor().submit(wonkalytics_and_promptlayer_api_request, *args, **kwargs)
+    except BaseException:
+        _release_pending()
+        raise
+    future.add_done_callback(_release_pending)
+
+
+def _acquire_pending() -> bool:
+    global _pending_events
+    with _pending_lock:
+        if _pending_events >= get_config().async_max_pending:
+            return False
+        _pending_events += 1
+        return True
+
+
+def _release_pending(_=None):
+    global _pending_events
+    with _pending_lock:
+        _pending_events -= 1
+
+
+def _task_done(task):
+    _pending_tasks.discard(task)
+    _release_pending()
+
+
+def _hand_off_or_send(json_post_dict, request, uid, timestamp):
+    if not _hand_off_event(json_post_dict, request, uid, timestamp):
+        _send_analytics_event(json_post_dict, request, uid, timestamp)
+
+
+async def _asend_analytics_event(json_post_dict, request, uid, timestamp):
+    """ The asyncio counterpart of analytics._send_analytics_event, after offering the event to the collector or the dispatcher. """
+    # The collector's socket send blocks for up to its timeout, so the hand-off runs on the executor too
+    if await run_in_sql_executor(_hand_off_event, json_post_dict, request, uid, timestamp):
+        return
+    pl_event = _promptlayer_event(json_post_dict)
+    try:
+        with time_stage("promptlayer"):
+            await atrack_request(pl_event)
+        count_sink("promptlayer", "success")
+    except Exception as e:
+        _report_sink_failure("promptlayer", e, await run_in_sql_executor(spool_failed_event, "promptlayer", pl_event, e))
+
+    sql_item = _sql_item(json_post_dict, request, uid, timestamp)
+    try:
+        await run_in_sql_executor(_write_to_azure_sql, sql_item)
+        count_sink("sql", "success")
+    except Exception as e:
+        _report_sink_failure("sql", e, await run_in_sql_executor(spool_failed_event, "sql", sql_item, e))
+
+
+async def ascore(response_id: str, score: int, **kwargs):
+    """
+    The async counterpart of analytics.score, the update runs on the dedicated SQL executor.
+
+    Returns:
+        ScoreResult: The number of rows updated. With score batching enabled the result is awaited
+                     until the buffered update is applied.
+    """
+    return await aupdate_row_property(response_id, "score", score, **kwargs)
+
+
+async def aupdate_row_property(response_id: str, property_name: str, property_value, **kwargs):
+    """ The async counterpart of analytics.update_row_property, see ascore. """
+    result = await run_in_sql_executor(update_row_property, response_id, property_name, property_value, **kwargs)
+    if isinstance(result, Future):
+        result = await asyncio.wrap_future(result)
+    return result
+
+
+async def aflush(timeout=None) -> bool:
+    """
+    Wait until the events logged so far are sent, without blocking the event loop.
+
+    Returns:
+        bool: True if everything was sent before the timeout.
+    """
+    loop = asyncio.get_running_loop()
+    tasks = [task for task in _pending_tasks if task.get_loop() is loop]
+    if tasks:
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            return False
+    dispatcher = get_dispatcher()
+    if dispatcher is not None:
+        # On the dedicated executor, not the loop's default one
+        return await run_in_sql_executor(dispatcher.flush, timeout)
+    return True
+
+
+async def aclose(timeout=None) -> bool:
+    """
+    Flush the pending events and close the async HTTP client of the running loop, e.g. in a FastAPI shutdown handler.
+
+    Returns:
+        bool: True if everything was sent before the timeout.
+    """
+    flushed = await aflush(timeout)
+    await close_async_promptlayer_client()
+    return flushed
@@ -0,0 +1,302 @@
+import atexit
+import logging
+import sys
+import threading
+import time
+from .config import LazySingleton, get_config
+from .projection import AnalyticsRow
+from .schema import is_invalid_column_error
+from .spool import is_retryable_error, spool_failed_event
+
+
+class _RowGroup:
+    """ Rows waiting to be inserted into the same table with the same set of columns. """
+
+    __slots__ = ("pool", "table_name", "columns", "rows", "callbacks", "first_added", "refresh_columns")
+
+    def __init__(self, pool, table_name, columns, refresh_columns):
+        self.pool = pool
+        self.table_name = table_name
+        self.columns = columns
+        self.rows = []
+        # The on_written callback of every row, None for most
+        self.callbacks = []
+        self.first_added = time.monotonic()
+        self.refresh_columns = refresh_columns
+
+
+class BatchWriter:
+    """
+    Buffers analytics rows and inserts them in batches, one transaction per batch.
+
+    Rows are grouped by table and by their resolved column set, so every group can be written with a
+    single parameterized INSERT through 'cursor.executemany' with 'fast_executemany' enabled. A group
+    is flushed by a background thread once it holds 'batch_size' rows or its oldest row has waited
+    'max_latency' seconds. When a batch fails its rows are retried one by one, so a single bad row
+    only loses itself.
+    """
+
+    def __init__(self, batch_size: int = 100, max_latency: float = 1.0, on_failure=None):
+        """
+        Initializes the writer and starts its flush thread.
+
+        Args:
+            batch_size (int): Number of rows in a group that triggers a flush.
+            max_latency (float): Maximum seconds a row waits before its group is flushed.
+            on_failure (callable, optional): Called with (table_name, row, error) for every row that could
+                not be written, returns True if it took care of the row (e.g. spooled it).
+        """
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.on_failure = on_failure
+        self.rows_written = 0
+        self.rows_failed = 0
+        self._groups = {}
+        self._cond = threading.Condition()
+        self._flushing = 0
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="wonkalytics-batch-writer", daemon=True
+        )
+        self._thread.start()
+
+    def add(self, pool, table_name: str, row: dict, refresh_columns=None, on_written=None):
+        """
+        Queue a processed row for insertion.
+
+        Args:
+            pool (ConnectionPool): The pool of the database the row belongs to.
+            table_name (str): The table to insert into.
+            row (AnalyticsRow or dict): The row's values, already filtered to the table's columns.
+            refresh_columns (callable, optional): Returns the reloaded column names of the table,
+                used when the batch fails because the table schema changed.
+            on_written (callable, optional): Called on the flush thread once the row is committed, with
+                None, or with the error when the row could not be written.
+
+        Returns:
+            bool: True if the row was queued, False if the writer is closed and the row should be written directly.
+        """
+        if isinstance(row, AnalyticsRow):
+            columns, values = row.columns, row.values
+        else:
+            columns = tuple(sorted(row))
+            values = [row[column] for column in columns]
+        key = (id(pool), table_name, columns)
+        with self._cond:
+            if self._closed:
+                return False
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = _RowGroup(pool, table_name, columns, refresh_columns)
+            group.rows.append(values)
+            group.callbacks.append(on_written)
+            if len(group.rows) >= self.batch_size:
+                self._cond.notify()
+        return True
+
+    def flush(self, timeout=None) -> bool:
+        """
+        Write all buffered rows now.
+
+        Args:
+            timeout (float, optional): Maximum seconds to wait for the flush to finish.
+
+        Returns:
+            bool: True if every buffered row was handled before the timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            for group in self._groups.values():
+                group.first_added = float("-inf")
+            self._cond.notify()
+            while self._groups or self._flushing:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=None) -> bool:
+        """
+        Stop accepting rows, write the buffered ones and stop the flush thread.
+
+        Rows added after close() starts are refused (add returns False), so they are written directly.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        drained = self.flush(timeout)
+        self._thread.join(timeout)
+        return drained
+
+    def _due_groups(self):
+        now = time.monotonic()
+        due = [
+            key
+            for key, group in self._groups.items()
+            if len(group.rows) >= self.batch_size
+            or now - group.first_added >= self.max_latency
+        ]
+        return [self._groups.pop(key) for key in due]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due = self._due_groups()
+                while not due:
+                    if self._closed:
+                        # Every buffered row is written before the thread stops, due or not
+                        due = list(self._groups.values())
+                        self._groups.clear()
+                        if not due:
+                            return
+                        break
+                    self._cond.wait(self.max_latency / 2)
+                    due = self._due_groups()
+                self._flushing += 1
+            try:
+                for group in due:
+                    for start in range(0, len(group.rows), self.batch_size):
+                        end = start + self.batch_size
+                        self._write_group(group, group.rows[start:end], group.callbacks[start:end])
+            finally:
+                with self._cond:
+                    self._flushing -= 1
+                    self._cond.notify_all()
+
+    def _write_group(self, group, rows, callbacks):
+        columns = group.columns
+        try:
+            group.pool.run(lambda cnxn: _insert_many(cnxn, group.table_name, columns, rows))
+            self._written(len(rows), callbacks)
+            return
+        except Exception as e:
+            error = e
+
+        if group.refresh_columns is not None and is_invalid_column_error(error):
+            logging.warning(f"Wonkalytics table schema changed, reloading it: {error}")
+            try:
+                columns, rows = self._project_on_refreshed_columns(group, rows)
+                group.pool.run(lambda cnxn: _insert_many(cnxn, group.table_name, columns, rows))
+                self._written(len(rows), callbacks)
+                return
+            except Exception as e:
+                error = e
+
+        if is_retryable_error(error):
+            # The database is unreachable, retrying row by row would only wait out more timeouts
+            for values, callback in zip(rows, callbacks):
+                self._row_failed(group.table_name, columns, values, error, callback)
+            return
+
+        # Isolate the bad rows, every row gets its own transaction
+        logging.warning(
+            f"Wonkalytics batch insert of {len(rows)} rows failed, retrying them one by one: {error}"
+        )
+        for values, callback in zip(rows, callbacks):
+            try:
+                group.pool.run(lambda cnxn: _insert_many(cnxn, group.table_name, columns, [values]))
+            except Exception as e:
+                self._row_failed(group.table_name, columns, values, e, callback)
+            else:
+                self._written(1, [callback])
+
+    def _written(self, count, callbacks):
+        self.rows_written += count
+        for callback in callbacks:
+            _notify(callback)
+
+    def _row_failed(self, table_name, columns, values, error, callback=None):
+        self.rows_failed += 1
+        _notify(callback, error)
+        if self.on_failure is not None and self.on_failure(table_name, dict(zip(columns, values)), error):
+            return
+        print(
+            f"WARNING: While logging your request Wonkalytics had the following error: {error}",
+            file=sys.stderr,
+        )
+
+    def _project_on_refreshed_columns(self, group, rows):
+        """ Returns the columns and rows without the columns that are no longer in the reloaded table schema. """
+        allowed = group.refresh_columns()
+        keep = [i for i, column in enumerate(group.columns) if column in allowed]
+        if not keep:
+            return group.columns, rows
+        columns = tuple(group.columns[i] for i in keep)
+        return columns, [[values[i] for i in keep] for values in rows]
+
+
+def _notify(callback, error=None):
+    if callback is None:
+        return
+    try:
+        callback(error)
+    except Exception as e:
+        logging.warning(f"Wonkalytics batch row callback failed: {e}")
+
+
+def _insert_many(cnxn, table_name, columns, rows):
+    sql = f"INSERT INTO [{table_name}] ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})"
+    cursor = cnxn.cursor()
+    if len(rows) > 1:
+        cursor.fast_executemany = True
+        cursor.executemany(sql, rows)
+    else:
+        cursor.execute(sql, rows[0])
+    cnxn.commit()
+
+
+_writer = LazySingleton(lambda: get_config().batch_writes, lambda: enable_batch_writes())
+_atexit_registered = False
+
+
+def enable_batch_writes(batch_size: int = 100, max_latency: float = 1.0, drain_timeout: float = 10.0, on_failure=None):
+    """
+    Enable batched SQL inserts: rows are buffered and written in groups instead of one transaction per event.
+
+    Args:
+        batch_size (int): Number of rows per INSERT batch.
+        max_latency (float): Maximum seconds a row is buffered before it is written.
+        drain_timeout (float): Seconds to wait for buffered rows when the interpreter exits.
+        on_failure (callable, optional): See BatchWriter, defaults to spooling rows that failed on a retryable error.
+
+    Returns:
+        BatchWriter: The active batch writer.
+    """
+    global _atexit_registered
+    writer = BatchWriter(batch_size, max_latency, on_failure or _spool_failed_row)
+    with _writer.lock:
+        old_writer = _writer.set(writer)
+        if not _atexit_registered:
+            atexit.register(lambda: disable_batch_writes(drain_timeout))
+            _atexit_registered = True
+    if old_writer is not None:
+        old_writer.close(drain_timeout)
+    return writer
+
+
+def _spool_failed_row(table_name, row, error):
+    return spool_failed_event("sql_row", {"table_name": table_name, "row": row}, error)
+
+
+def disable_batch_writes(timeout=None) -> bool:
+    """
+    Write the buffered rows and go back to one insert per event.
+
+    Returns:
+        bool: True if all buffered rows were handled before stopping.
+    """
+    writer = _writer.clear()
+    if writer is None:
+        return True
+    return writer.close(timeout)
+
+
+def get_batch_writer():
+    """
+    Returns the active batch writer, or None when batched inserts are disabled.
+
+    Batched inserts can also be enabled by setting the WONKALYTICS_BATCH_WRITES environment variable to 1,
+    unless they were disabled with disable_batch_writes.
+    """
+    return _writer.get()
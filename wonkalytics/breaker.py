@@ -0,0 +1,288 @@
+import logging
+import random
+import threading
+import time
+from .config import LazySingleton, get_config
+from .metrics import increment, set_gauge
+
+# States of a CircuitBreaker
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Reported as wonkalytics_breaker_state{sink=...}
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# The sinks that have a breaker once they are enabled
+SINKS = ("sql", "promptlayer")
+
+
+class CircuitOpenError(ConnectionError):
+    """
+    Raised instead of calling a sink whose breaker is open.
+
+    It is a ConnectionError, so the event is spooled (when spooling is enabled) like any other event
+    that could not be delivered.
+    """
+
+
+def is_unavailable_error(error: Exception) -> bool:
+    """ The default failure check of a breaker: errors that mean the sink is down, see spool.is_retryable_error. """
+    # spool imports pool, which imports this module
+    from .spool import is_retryable_error
+
+    return is_retryable_error(error)
+
+
+class CircuitBreaker:
+    """
+    Stops calling a sink after 'failure_threshold' consecutive failures, so calls fail right away
+    instead of each waiting for a connection or request timeout.
+
+    closed: calls go through, failures are counted.
+    open: calls are rejected with CircuitOpenError for 'reset_timeout' seconds (with jitter), doubling
+        up to 'max_reset_timeout' every time the sink is still down.
+    half_open: 'half_open_calls' calls are let through to probe the sink, a success closes the breaker
+        and a failure opens it again.
+
+    Errors for which 'is_failure' returns False (e.g. a rejected row) show the sink is up and count as a success.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        max_reset_timeout: float = 300.0,
+        half_open_calls: int = 1,
+        is_failure=is_unavailable_error,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.half_open_calls = half_open_calls
+        self.is_failure = is_failure
+        self.rejected = 0
+        self._state = CLOSED
+        self._failures = 0
+        self._trips = 0
+        self._open_until = 0.0
+        self._probes = 0
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """ The current state, an open breaker whose timeout passed reports half_open. """
+        if self._state == OPEN and time.monotonic() >= self._open_until:
+            return HALF_OPEN
+        return self._state
+
+    def add_listener(self, func):
+        """ Call func(name, old_state, new_state) on every state transition, e.g. to alert on them. """
+        self._listeners.append(func)
+
+    def before_call(self):
+        """
+        Check whether a call may go through, call after_call with its outcome when it does.
+
+        Raises:
+            CircuitOpenError: When the breaker is open, or half open with its probes in flight.
+        """
+        # Closed is checked without the lock, it costs an attribute lookup
+        if self._state == CLOSED:
+            return
+        if self._state == OPEN and time.monotonic() < self._open_until:
+            self._reject()
+        with self._lock:
+            if self._state == OPEN:
+                if time.monotonic() < self._open_until:
+                    self._reject()
+                transition = self._transition(HALF_OPEN)
+            else:
+                transition = None
+            if self._state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    self._reject()
+                self._probes += 1
+        self._notify(transition)
+
+    def after_call(self, error: Exception = None):
+        """ Record the outcome of a call that before_call let through. """
+        failed = error is not None and self.is_failure(error)
+        if self._state == CLOSED and not failed and not self._failures:
+            return
+        with self._lock:
+            transition = None
+            if self._state == HALF_OPEN:
+                self._probes = max(self._probes - 1, 0)
+                transition = self._trip() if failed else self._close()
+            elif failed:
+                self._failures += 1
+                if self._state == CLOSED and self._failures >= self.failure_threshold:
+                    transition = self._trip()
+            elif self._state == CLOSED:
+                self._failures = 0
+        self._notify(transition)
+
+    def call(self, func, *args, **kwargs):
+        """ Call func through the breaker. """
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.after_call(e)
+            raise
+        except BaseException:
+            self._release_probe()
+            raise
+        self.after_call()
+        return result
+
+    async def acall(self, func, *args, **kwargs):
+        """ Await func through the breaker. """
+        self.before_call()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            self.after_call(e)
+            raise
+        except BaseException:
+            # E.g. asyncio.CancelledError, which says nothing about the sink
+            self._release_probe()
+            raise
+        self.after_call()
+        return result
+
+    def reset(self):
+        """ Close the breaker, e.g. after the sink was fixed. """
+        with self._lock:
+            self._probes = 0
+            transition = self._close()
+        self._notify(transition)
+
+    def _reject(self):
+        self.rejected += 1
+        increment("wonkalytics_breaker_rejected_total", 1, {"sink": self.name})
+        raise CircuitOpenError(f"Wonkalytics stopped calling {self.name} for now, it failed {self.failure_threshold} times in a row")
+
+    def _release_probe(self):
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes = max(self._probes - 1, 0)
+
+    def _trip(self):
+        timeout = min(self.max_reset_timeout, self.reset_timeout * 2**self._trips)
+        self._trips += 1
+        # Jittered, so processes that tripped together do not probe together
+        self._open_until = time.monotonic() + timeout * random.uniform(0.8, 1.2)
+        self._failures = 0
+        return self._transition(OPEN)
+
+    def _close(self):
+        self._trips = 0
+        self._failures = 0
+        return self._transition(CLOSED)
+
+    def _transition(self, state):
+        old_state, self._state = self._state, state
+        if old_state == state:
+            return None
+        return old_state, state
+
+    def _notify(self, transition):
+        if transition is None:
+            return
+        old_state, new_state = transition
+        set_gauge("wonkalytics_breaker_state", _STATE_VALUES[new_state], {"sink": self.name})
+        increment("wonkalytics_breaker_transitions_total", 1, {"sink": self.name, "state": new_state})
+        log = logging.warning if new_state == OPEN else logging.info
+        log(f"Wonkalytics circuit breaker of {self.name} went from {old_state} to {new_state}.")
+        for listener in list(self._listeners):
+            try:
+                listener(self.name, old_state, new_state)
+            except Exception as e:
+                logging.warning(f"Wonkalytics circuit breaker listener failed: {e}")
+
+
+_breakers = LazySingleton(lambda: get_config().circuit_breakers, lambda: enable_circuit_breakers())
+# Added to every breaker, also to those enabled later, under _breakers.lock
+_listeners = []
+
+
+def enable_circuit_breakers(
+    failure_threshold: int = 5,
+    reset_timeout: float = 30.0,
+    max_reset_timeout: float = 300.0,
+    half_open_calls: int = 1,
+) -> dict:
+    """
+    Fail fast while Azure SQL or PromptLayer are down, instead of waiting for a timeout on every call.
+
+    Rejected events are spooled when spooling is enabled (see spool.enable_spool), and dropped otherwise.
+
+    Args:
+        failure_threshold (int): Consecutive failures after which a sink's breaker opens.
+        reset_timeout (float): Seconds the breaker stays open before a call probes the sink.
+        max_reset_timeout (float): Maximum seconds the breaker stays open, the timeout doubles while the sink stays down.
+        half_open_calls (int): Calls let through at once to probe the sink.
+
+    Returns:
+        dict: The breakers by sink name.
+    """
+    breakers = {
+        name: CircuitBreaker(name, failure_threshold, reset_timeout, max_reset_timeout, half_open_calls)
+        for name in SINKS
+    }
+    with _breakers.lock:
+        for breaker in breakers.values():
+            for listener in _listeners:
+                breaker.add_listener(listener)
+        _breakers.set(breakers)
+    return breakers
+
+
+def disable_circuit_breakers():
+    """ Call the sinks regardless of their failures again. """
+    _breakers.clear()
+
+
+def get_breaker(sink: str):
+    """
+    Returns the circuit breaker of a sink ('sql' or 'promptlayer'), or None when breakers are disabled.
+
+    Breakers can also be enabled by setting the WONKALYTICS_CIRCUIT_BREAKERS environment variable to 1,
+    unless they were disabled with disable_circuit_breakers.
+    """
+    breakers = _breakers.get()
+    return None if breakers is None else breakers.get(sink)
+
+
+def add_breaker_listener(func):
+    """
+    Call func(sink, old_state, new_state) whenever a breaker changes state, also for breakers enabled later.
+
+    Example:
+    ```
+    def alert(sink, old_state, new_state):
+        if new_state == "open":
+            pager.trigger(f"Wonkalytics stopped logging to {sink}")
+
+    wonkalytics.add_breaker_listener(alert)
+    ```
+    """
+    with _breakers.lock:
+        _listeners.append(func)
+        breakers = _breakers.value
+    if breakers is not None:
+        for breaker in breakers.values():
+            breaker.add_listener(func)
+
+
+def breaker_states() -> dict:
+    """ Returns the state of every breaker, e.g. {'sql': 'open', 'promptlayer': 'closed'}. """
+    breakers = _breakers.value
+    if breakers is None:
+        return {}
+    return {name: breaker.state for name, breaker in breakers.items()}
@@ -0,0 +1,514 @@
+import asyncio
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import types
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from .config import LazySingleton, get_config
+from .metrics import increment
+from .serialization import is_json_serializable
+
+# Keyword arguments that do not change the response, they are left out of the cache key
+IGNORED_KWARGS = frozenset({"timeout", "request_timeout"})
+
+# A flight whose leader did not produce a cacheable response, its followers call the API themselves
+_UNCOALESCED = object()
+
+
+def is_deterministic(function_name: str, kwargs: dict) -> bool:
+    """
+    The default cache policy: embeddings, and completions requested with temperature 0.
+
+    Responses sampled at a higher temperature are expected to differ between calls, so they are not cached.
+    """
+    if kwargs.get("temperature") == 0:
+        return True
+    return "embedding" in function_name.lower()
+
+
+def is_stream(response) -> bool:
+    """ Check whether a response is a stream of chunks, like utils.wonkalytics_api_handler does. """
+    return isinstance(response, (types.GeneratorType, types.AsyncGeneratorType)) or type(response).__name__ in ("Stream", "AsyncStream")
+
+
+def cache_key(function_name: str, provider: str, args, kwargs: dict):
+    """
+    Returns the sha256 of the canonical JSON of a request, or None when it has values that are not JSON (e.g. a client).
+
+    Keys are sorted, so the order in which the arguments were passed does not matter.
+    """
+    kwargs = {name: value for name, value in kwargs.items() if name not in IGNORED_KWARGS}
+    request = [function_name, provider, list(args), kwargs]
+    if not is_json_serializable(request):
+        return None
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class SqliteResponseStore:
+    """
+    The on-disk tier of the response cache, a local SQLite database shared by the processes of a node.
+
+    Responses are stored pickled, only point it at a file that no one else can write.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024):
+        """
+        Args:
+            path (str): Path of the SQLite database file, created when missing.
+            max_bytes (int): Maximum total size of the stored responses, the oldest are removed beyond it.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                expires REAL,
+                created REAL NOT NULL
+            )"""
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_created ON responses (created)")
+        self._purge_expired()
+
+    def get(self, key: str):
+        """ Returns the stored value of a key and when it expires, or None when it is missing or expired. """
+        with self._lock:
+            row = self._db.execute("SELECT value, expires FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return row
+
+    def put(self, key: str, value: bytes, expires: float = None):
+        """ Store a value, replacing an existing one. """
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, expires, created) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), expires, time.time()),
+            )
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                self._purge_expired_locked()
+                self._make_room_locked()
+
+    def clear(self):
+        """ Remove every stored response. """
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+
+    def close(self):
+        """ Close the database. """
+        with self._lock:
+            self._db.close()
+
+    def _purge_expired(self):
+        with self._lock:
+            self._purge_expired_locked()
+
+    def _purge_expired_locked(self):
+        self._db.execute("DELETE FROM responses WHERE expires IS NOT NULL AND expires <= ?", (time.time(),))
+
+    def _make_room_locked(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY created").fetchall():
+            if total <= self.max_bytes:
+                return
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+
+
+class ResponseCache:
+    """
+    An exact-match cache of API responses, with an in-memory LRU tier and an optional on-disk tier.
+
+    Concurrent identical calls are coalesced: the first one calls the API and the others wait for its
+    response (single-flight). Streamed responses are recorded as they are consumed and cached once the
+    stream is exhausted, later calls get the chunks replayed. Streams are not coalesced, the waiting
+    calls could only start once the first stream ended.
+
+    Responses are stored pickled, so every hit returns a fresh copy that the caller is free to change.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: float = 3600.0,
+        store: SqliteResponseStore = None,
+        policy=is_deterministic,
+        wait_timeout: float = 120.0,
+    ):
+        """
+        Args:
+            max_entries (int): Maximum number of responses in memory, the least recently used are evicted.
+            ttl (float): Seconds a response stays valid, None to keep it until it is evicted.
+            store (SqliteResponseStore, optional): The on-disk tier.
+            policy (callable): Called with the function name and kwargs, returns whether the call may be cached.
+            wait_timeout (float): Seconds a coalesced call waits for the first one before calling the API itself.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store = store
+        self.policy = policy
+        self.wait_timeout = wait_timeout
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def key(self, function_name: str, provider: str, args, kwargs: dict):
+        """ Returns the cache key of a call, or None when the call should not be cached. """
+        if not self.policy(function_name, kwargs):
+            return None
+        return cache_key(function_name, provider, args, kwargs)
+
+    def get(self, key: str):
+        """ Returns the cached response of a key (a replaying iterator for streams), or None. """
+        value = self._lookup(key)
+        return None if value is None else self._load(value)
+
+    def _lookup(self, key):
+        with self._lock:
+            value = self._get_memory(key)
+        if value is None and self.store is not None:
+            stored = self.store.get(key)
+            if stored is not None:
+                value, expires = stored
+                with self._lock:
+                    self._put_memory(key, value, expires)
+        return value
+
+    def put(self, key: str, response):
+        """ Cache a response, or a list of chunks recorded from a stream. """
+        self._store(key, self._dump(response))
+
+    def _store(self, key, value):
+        if value is None:
+            return
+        expires = self._expires()
+        with self._lock:
+            self._put_memory(key, value, expires)
+        if self.store is not None:
+            try:
+                self.store.put(key, value, expires)
+            except sqlite3.Error as e:
+                logging.warning(f"Wonkalytics could not store a response in the cache: {e}")
+
+    def clear(self):
+        """ Remove every cached response, from memory and disk. """
+        with self._lock:
+            self._entries.clear()
+        if self.store is not None:
+            self.store.clear()
+
+    def stats(self) -> dict:
+        """ Returns the number of hits, misses, coalesced calls and responses in memory. """
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "entries": len(self._entries)}
+
+    def call(self, key: str, func):
+        """
+        Returns the cached response of 'key', or calls 'func' for it, coalescing concurrent calls.
+
+        Whether the call is async is decided by what 'func' returns: when it is an awaitable, the call
+        and the later hits of 'key' return an awaitable of the tuple instead, and waiting for a coalesced
+        call does not block the event loop.
+
+        Returns:
+            tuple: The response and whether it was served without calling the API.
+        """
+        value = self._lookup(key)
+        if value is not None:
+            self._count("hit")
+            response, is_async = self._unpack(value)
+            return _resolved(response, True) if is_async else (response, True)
+        flight, leader = self._join(key)
+        if not leader:
+            if getattr(flight, "is_async", False):
+                return self._afollow(key, flight, func)
+            try:
+                value = flight.result(self.wait_timeout)
+            except FutureTimeoutError:
+                value = _UNCOALESCED
+            if value is not _UNCOALESCED:
+                self._count("coalesced")
+                response, is_async = self._unpack(value)
+                return _resolved(response, True) if is_async else (response, True)
+            self._count("miss")
+            response = func()
+            if inspect.isawaitable(response):
+                return self._awaited(key, response)
+            return (self._recorder(key, response), False) if is_stream(response) else (response, False)
+
+        self._count("miss")
+        try:
+            response = func()
+        except Exception as e:
+            self._land(key, flight, error=e)
+            raise
+        except BaseException:
+            self._land(key, flight)
+            raise
+        if inspect.isawaitable(response):
+            # Set before the first await, so the calls that join the flight wait without blocking the loop
+            flight.is_async = True
+            return self._alead(key, flight, response)
+        if is_stream(response):
+            self._land(key, flight)
+            return self._recorder(key, response), False
+        value = self._dump(response)
+        self._store(key, value)
+        self._land(key, flight, value)
+        return response, False
+
+    async def acall(self, key: str, func):
+        """ Like call, for a 'func' that returns an awaitable. """
+        result = self.call(key, func)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def _alead(self, key, flight, awaitable):
+        try:
+            response = await awaitable
+        except Exception as e:
+            self._land(key, flight, error=e)
+            raise
+        except BaseException:
+            # E.g. asyncio.CancelledError, the waiting calls should not be cancelled with it
+            self._land(key, flight)
+            raise
+        if is_stream(response):
+            self._land(key, flight)
+            return self._recorder(key, response, awaited=True), False
+        value = self._dump(_Awaited(response))
+        self._store(key, value)
+        self._land(key, flight, value)
+        return response, False
+
+    async def _afollow(self, key, flight, func):
+        try:
+            value = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(flight)), self.wait_timeout)
+        except asyncio.TimeoutError:
+            value = _UNCOALESCED
+        if value is not _UNCOALESCED:
+            self._count("coalesced")
+            return self._unpack(value)[0], True
+        self._count("miss")
+        return await self._awaited(key, func())
+
+    async def _awaited(self, key, response):
+        """ An async call that was not coalesced, only its stream is cached. """
+        if inspect.isawaitable(response):
+            response = await response
+        return (self._recorder(key, response, awaited=True), False) if is_stream(response) else (response, False)
+
+    def _join(self, key):
+        """ Returns the flight of a key and whether this call leads it, i.e. has to call the API. """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = Future()
+            # The previous leader may have cached the response since the lookup
+            value = self._get_memory(key)
+            if value is not None:
+                flight.set_result(value)
+                return flight, False
+            self._flights[key] = flight
+            return flight, True
+
+    def _land(self, key, flight, value=_UNCOALESCED, error=None):
+        with self._lock:
+            self._flights.pop(key, None)
+        if error is not None:
+            flight.set_exception(error)
+        else:
+            flight.set_result(_UNCOALESCED if value is None else value)
+
+    def _recorder(self, key, stream, awaited=False):
+        """ Wraps a stream so its chunks are cached once it is exhausted, 'awaited' when the call returned an awaitable. """
+        if hasattr(stream, "__anext__"):
+            return self._arecord(key, stream, awaited)
+        return self._record(key, stream, awaited)
+
+    def _record(self, key, stream, awaited=False):
+        chunks = []
+        try:
+            for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+        self.put(key, _Awaited(_Chunks(chunks)) if awaited else _Chunks(chunks))
+
+    async def _arecord(self, key, stream, awaited=False):
+        chunks = []
+        try:
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            close = getattr(stream, "aclose", None) or getattr(stream, "close", None)
+            if close is not None:
+                result = close()
+                if inspect.isawaitable(result):
+                    await result
+        chunks = _Chunks(chunks, is_async=True)
+        self.put(key, _Awaited(chunks) if awaited else chunks)
+
+    def _get_memory(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _put_memory(self, key, value, expires):
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _expires(self):
+        return None if self.ttl is None else time.time() + self.ttl
+
+    def _dump(self, response):
+        try:
+            return pickle.dumps(response, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logging.debug(f"Wonkalytics cannot cache a response of type {type(response).__name__}: {e}")
+            return None
+
+    def _load(self, value):
+        return self._unpack(value)[0]
+
+    def _unpack(self, value):
+        """ Returns the response of a cached value and whether it came from an async call. """
+        response = pickle.loads(value)
+        is_async = isinstance(response, _Awaited)
+        if is_async:
+            response = response.response
+        if isinstance(response, _Chunks):
+            response = response.replay()
+        return response, is_async
+
+    def _count(self, result):
+        if result == "hit":
+            self.hits += 1
+        elif result == "miss":
+            self.misses += 1
+        else:
+            self.coalesced += 1
+        increment("wonkalytics_cache_requests_total", 1, {"result": result})
+
+
+class _Awaited:
+    """ The response of a call that returned an awaitable, its hits are returned as awaitables too. """
+
+    def __init__(self, response):
+        self.response = response
+
+
+async def _resolved(response, cache_hit):
+    return response, cache_hit
+
+
+class _Chunks:
+    """ The chunks of a cached stream, replayed as a new (async) generator on every hit. """
+
+    def __init__(self, chunks, is_async=False):
+        self.chunks = chunks
+        self.is_async = is_async
+
+    def replay(self):
+        if self.is_async:
+            return _areplay(self.chunks)
+        return _replay(self.chunks)
+
+
+def _replay(chunks):
+    yield from chunks
+
+
+async def _areplay(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+_cache = LazySingleton(
+    lambda: get_config().response_cache, lambda: enable_response_cache(path=get_config().response_cache_path)
+)
+
+
+def enable_response_cache(
+    max_entries: int = 1024,
+    ttl: float = 3600.0,
+    path: str = None,
+    max_bytes: int = 512 * 1024 * 1024,
+    policy=is_deterministic,
+    wait_timeout: float = 120.0,
+) -> ResponseCache:
+    """
+    Serve repeated deterministic calls through OpenAIWrapper from a cache instead of the API.
+
+    Cache hits are still logged, with 'cache_hit' set to True.
+
+    Args:
+        max_entries (int): Maximum number of responses in memory.
+        ttl (float): Seconds a response stays valid, None to keep it until it is evicted.
+        path (str, optional): Path of the on-disk tier, without it responses are only kept in memory.
+        max_bytes (int): Maximum total size of the on-disk tier.
+        policy (callable): Called with the function name and kwargs, returns whether the call may be
+            cached. Defaults to is_deterministic: embeddings and calls with temperature 0.
+        wait_timeout (float): Seconds a coalesced call waits for the identical call in flight.
+
+    Returns:
+        ResponseCache: The active cache.
+    """
+    # The old on-disk tier is closed first, it may be the same file
+    disable_response_cache()
+    store = SqliteResponseStore(path, max_bytes) if path else None
+    cache = ResponseCache(max_entries, ttl, store, policy, wait_timeout)
+    _cache.set(cache)
+    return cache
+
+
+def disable_response_cache():
+    """ Stop caching, the on-disk tier is kept for the next start. """
+    cache = _cache.clear()
+    if cache is not None and cache.store is not None:
+        cache.store.close()
+
+
+def get_response_cache():
+    """
+    Returns the active response cache, or None when caching is disabled.
+
+    Caching can also be enabled by setting the WONKALYTICS_RESPONSE_CACHE environment variable to 1,
+    with an on-disk tier when WONKALYTICS_RESPONSE_CACHE_PATH is set, unless it was disabled with
+    disable_response_cache.
+    """
+    return _cache.get()
@@ -0,0 +1,349 @@
+import argparse
+import logging
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from .config import LazySingleton, get_config
+from .serialization import decode_event, encode_event
+
+# A frame is a version byte and the payload length (big endian), followed by the encode_event payload
+FRAME_VERSION = 1
+_HEADER = struct.Struct("!BI")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def encode_frame(json_post_dict: dict, request, uid: str, timestamp) -> bytes:
+    """ Encode an event, with the arguments of analytics._send_analytics_event, as a collector frame. """
+    payload = encode_event({"event": json_post_dict, "request": request, "id": uid, "timestamp": timestamp})
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ValueError(f"Wonkalytics event of {len(payload)} bytes exceeds the collector's maximum frame size.")
+    return _HEADER.pack(FRAME_VERSION, len(payload)) + payload
+
+
+def read_frame(stream):
+    """
+    Read the next frame from a binary stream.
+
+    Returns:
+        dict: The decoded message, None at the end of the stream.
+
+    Raises:
+        ValueError: On an unknown frame version, a frame that is too large or a truncated frame.
+    """
+    header = stream.read(_HEADER.size)
+    if not header:
+        return None
+    if len(header) < _HEADER.size:
+        raise ValueError("Truncated Wonkalytics collector frame header.")
+    version, length = _HEADER.unpack(header)
+    if version != FRAME_VERSION:
+        raise ValueError(f"Unknown Wonkalytics collector frame version {version}.")
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Wonkalytics collector frame of {length} bytes is too large.")
+    payload = stream.read(length)
+    if len(payload) < length:
+        raise ValueError("Truncated Wonkalytics collector frame.")
+    return decode_event(payload)
+
+
+class CollectorClient:
+    """
+    Sends events to a local collector over a Unix domain socket, fire-and-forget.
+
+    The connection is opened on first use and kept, one per process (it is reopened after a fork).
+    A send never waits longer than 'send_timeout'. When the collector cannot be reached the event is
+    not sent (send returns False, so the caller can write it directly) and connecting is retried
+    after 'retry_interval' seconds.
+    """
+
+    def __init__(self, path: str, send_timeout: float = 0.05, retry_interval: float = 5.0):
+        """
+        Args:
+            path (str): The collector's socket path.
+            send_timeout (float): Seconds a send may block, e.g. when the collector is not reading.
+            retry_interval (float): Seconds before connecting again after the collector was unreachable.
+        """
+        self.path = path
+        self.send_timeout = send_timeout
+        self.retry_interval = retry_interval
+        self.sent = 0
+        self.failed = 0
+        self._socket = None
+        self._pid = None
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def send(self, json_post_dict: dict, request, uid: str, timestamp) -> bool:
+        """
+        Send an event to the collector.
+
+        Returns:
+            bool: True if the collector received the event, False if it should be written directly
+                  (also when it is larger than MAX_FRAME_SIZE).
+        """
+        try:
+            frame = encode_frame(json_post_dict, request, uid, timestamp)
+        except ValueError as e:
+            logging.warning(f"{e} Writing it directly.")
+            self.failed += 1
+            return False
+        with self._lock:
+            sock = self._connect()
+            if sock is None:
+                self.failed += 1
+                return False
+            try:
+                sock.sendall(frame)
+            except OSError as e:
+                # A partially sent frame cannot be continued, the collector drops it with the connection
+                logging.warning(f"Wonkalytics lost the connection to the collector at {self.path}, writing directly: {e}")
+                self._disconnect()
+                self.failed += 1
+                return False
+            self.sent += 1
+            return True
+
+    def close(self):
+        """ Close the connection to the collector. """
+        with self._lock:
+            self._disconnect()
+
+    def _connect(self):
+        if self._socket is not None and self._pid == os.getpid():
+            return self._socket
+        # A socket inherited from the parent process is not shared, the frames would interleave
+        self._socket = None
+        if time.monotonic() < self._retry_at:
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.send_timeout)
+        try:
+            sock.connect(self.path)
+        except OSError as e:
+            sock.close()
+            self._retry_at = time.monotonic() + self.retry_interval
+            logging.info(f"Wonkalytics collector at {self.path} is not available, writing directly: {e}")
+            return None
+        self._socket, self._pid = sock, os.getpid()
+        return sock
+
+    def _disconnect(self):
+        if self._socket is not None and self._pid == os.getpid():
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+        self._socket = None
+        self._retry_at = time.monotonic() + self.retry_interval
+
+
+class _FrameHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        collector = self.server.collector
+        while True:
+            try:
+                message = read_frame(self.rfile)
+            except (ValueError, OSError) as e:
+                collector.malformed += 1
+                logging.warning(f"Wonkalytics collector dropped a connection: {e}")
+                return
+            if message is None:
+                return
+            collector.submit(message)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Collector:
+    """
+    Receives events from the worker processes on a node and sends them through one set of sinks.
+
+    Events are handed to the background dispatcher, so with batched inserts and PromptLayer batching
+    enabled (see run_collector) all workers share a few SQL connections and PromptLayer requests.
+    """
+
+    def __init__(self, path: str, mode: int = 0o660):
+        """
+        Binds the socket, removing a stale socket file left by a collector that is no longer running.
+
+        Args:
+            path (str): The socket path, e.g. '/run/wonkalytics/collector.sock'.
+            mode (int): Permissions of the socket file, workers need write access.
+
+        Raises:
+            RuntimeError: When another collector is listening on 'path'.
+        """
+        self.path = path
+        self.received = 0
+        self.malformed = 0
+        if os.path.exists(path):
+            if _is_listening(path):
+                raise RuntimeError(f"A Wonkalytics collector is already listening on {path}.")
+            os.unlink(path)
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._server = _Server(path, _FrameHandler)
+        self._server.collector = self
+        os.chmod(path, mode)
+
+    def submit(self, message: dict):
+        """ Send a received event, in the background when the dispatcher is enabled. """
+        from .analytics import _send_analytics_event
+        from .dispatcher import get_dispatcher
+
+        self.received += 1
+        arguments = (message["event"], message["request"], message["id"], message["timestamp"])
+        dispatcher = get_dispatcher()
+        if dispatcher is not None:
+            dispatcher.submit(_send_analytics_event, *arguments)
+        else:
+            _send_analytics_event(*arguments)
+
+    def serve_forever(self):
+        """ Accept connections until shutdown() is called. """
+        self._server.serve_forever()
+
+    def shutdown(self):
+        """ Stop accepting events and remove the socket file. Call from another thread than serve_forever. """
+        self._server.shutdown()
+        self._server.server_close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _is_listening(path: str) -> bool:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+_client = LazySingleton(
+    lambda: bool(get_config().collector_socket) and hasattr(socket, "AF_UNIX"), lambda: enable_collector_client()
+)
+
+
+def enable_collector_client(path: str = None, send_timeout: float = 0.05, retry_interval: float = 5.0) -> CollectorClient:
+    """
+    Send the events of this process to a local collector instead of writing them directly.
+
+    Args:
+        path (str, optional): The collector's socket path, defaults to the WONKALYTICS_COLLECTOR_SOCKET setting.
+
+    Returns:
+        CollectorClient: The active client.
+    """
+    path = path or get_config().collector_socket
+    if not path:
+        raise ValueError("No collector socket path given and WONKALYTICS_COLLECTOR_SOCKET is not set.")
+    client = CollectorClient(path, send_timeout, retry_interval)
+    old_client = _client.set(client)
+    if old_client is not None:
+        old_client.close()
+    return client
+
+
+def disable_collector_client():
+    """ Write the events of this process directly again. """
+    client = _client.clear()
+    if client is not None:
+        client.close()
+
+
+def get_collector_client():
+    """
+    Returns the active collector client, or None when events are written directly.
+
+    The client is also enabled by setting the WONKALYTICS_COLLECTOR_SOCKET environment variable to the socket path,
+    unless it was disabled with disable_collector_client.
+    """
+    return _client.get()
+
+
+def run_collector(
+    path: str,
+    batch_writes: bool = True,
+    promptlayer_batching: bool = True,
+    max_connections: int = 2,
+    num_workers: int = 2,
+    max_queue_size: int = 100000,
+    drain_timeout: float = 30.0,
+):
+    """
+    Run a collector until SIGTERM or SIGINT, then send the queued events and exit.
+
+    Args:
+        path (str): The socket path.
+        batch_writes (bool): Insert the rows of all workers in batches.
+        promptlayer_batching (bool): Send the PromptLayer events of all workers in batches.
+        max_connections (int): Maximum number of SQL connections per database.
+        num_workers (int): Threads sending the received events.
+        max_queue_size (int): Maximum number of queued events before new events are dropped.
+        drain_timeout (float): Seconds to wait for the queued events on shutdown.
+    """
+    from .batch import disable_batch_writes, enable_batch_writes
+    from .dispatcher import disable_background_logging, enable_background_logging
+    from .pool import configure_pools
+    from .promptlayer import disable_promptlayer_batching, enable_promptlayer_batching
+
+    configure_pools(max_size=max_connections)
+    enable_background_logging(max_queue_size=max_queue_size, num_workers=num_workers, drain_timeout=drain_timeout)
+    if batch_writes:
+        enable_batch_writes(drain_timeout=drain_timeout)
+    if promptlayer_batching:
+        enable_promptlayer_batching(drain_timeout=drain_timeout)
+
+    collector = Collector(path)
+
+    def stop(signum, frame):
+        threading.Thread(target=collector.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logging.info(f"Wonkalytics collector listening on {path}")
+    try:
+        collector.serve_forever()
+    finally:
+        # Received events are sent before exiting, the dispatcher first as it feeds the batchers
+        disable_background_logging(drain_timeout)
+        disable_batch_writes(drain_timeout)
+        disable_promptlayer_batching(drain_timeout)
+        logging.info(f"Wonkalytics collector stopped after {collector.received} events")
+
+
+def main(argv=None):
+    """ Run the collector: python -m wonkalytics.collector --socket /run/wonkalytics/collector.sock """
+    parser = argparse.ArgumentParser(prog="python -m wonkalytics.collector", description=main.__doc__)
+    parser.add_argument("--socket", default=get_config().collector_socket, required=not get_config().collector_socket,
+                        help="Path of the Unix domain socket, defaults to WONKALYTICS_COLLECTOR_SOCKET.")
+    parser.add_argument("--max-connections", type=int, default=2, help="Maximum SQL connections per database.")
+    parser.add_argument("--workers", type=int, default=2, help="Threads sending the received events.")
+    parser.add_argument("--no-batch-writes", action="store_true", help="Insert every row on its own.")
+    parser.add_argument("--no-promptlayer-batching", action="store_true", help="Send every PromptLayer event on its own.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    run_collector(
+        args.socket,
+        batch_writes=not args.no_batch_writes,
+        promptlayer_batching=not args.no_promptlayer_batching,
+        max_connections=args.max_connections,
+        num_workers=args.workers,
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,241 @@
+import os
+import threading
+from typing import NamedTuple, Optional
+
+
+class Config(NamedTuple):
+    """
+    The settings of Wonkalytics, resolved once from the environment (and a .env file).
+
+    Logging calls read the settings from here instead of the environment. Use configure() to change them.
+    """
+
+    server: Optional[str] = None
+    database: Optional[str] = None
+    username: Optional[str] = None
+    password: Optional[str] = None
+    table_name: Optional[str] = None
+    schema_ttl: float = 300.0
+    # Maximum number of characters logged for (MAX) text columns, 0 for no limit
+    max_text_length: int = 1000000
+    promptlayer_url: str = "https://api.promptlayer.com"
+    promptlayer_connect_timeout: float = 3.05
+    promptlayer_read_timeout: float = 10.0
+    promptlayer_gzip: bool = False
+    # Features that are enabled on first use, see e.g. dispatcher.get_dispatcher
+    background_logging: bool = False
+    batch_writes: bool = False
+    score_batching: bool = False
+    dedup: bool = False
+    blob_table: str = "wonkalytics_blobs"
+    spool: bool = False
+    spool_path: Optional[str] = None
+    metrics: bool = False
+    sample_rate: Optional[float] = None
+    shed_backlog: Optional[int] = None
+    sql_workers: int = 4
+    # Maximum number of events the async path is sending at once, more are dropped
+    async_max_pending: int = 10000
+    collector_socket: Optional[str] = None
+    response_cache: bool = False
+    response_cache_path: Optional[str] = None
+    rate_limit: bool = False
+    circuit_breakers: bool = False
+
+    def require_sql(self):
+        """
+        Check that the Azure SQL settings are set.
+
+        Raises:
+            EnvironmentError: Naming the environment variables that are missing.
+        """
+        missing = [variable for field, variable in _SQL_VARIABLES.items() if getattr(self, field) is None]
+        if missing:
+            raise EnvironmentError(f"Missing environment variables: {', '.join(missing)}")
+
+
+_SQL_VARIABLES = {
+    "server": "AZURE_SQL_SERVER",
+    "database": "AZURE_SQL_DB",
+    "username": "AZURE_SQL_USER",
+    "password": "AZURE_SQL_PASSWORD",
+    "table_name": "AZURE_TABLE_NAME",
+}
+
+
+def _flag(name):
+    return os.getenv(name) == "1"
+
+
+def _optional(name, convert):
+    value = os.getenv(name)
+    return convert(value) if value else None
+
+
+def load_config(**overrides) -> Config:
+    """
+    Read the settings from the environment, after loading a .env file if python-dotenv is installed.
+
+    Args:
+        **overrides: Settings that take precedence over the environment, e.g. table_name='analytics'.
+
+    Returns:
+        Config: The resolved settings.
+    """
+    try:
+        from dotenv import load_dotenv
+    except ImportError:
+        pass
+    else:
+        load_dotenv()
+
+    settings = {field: os.getenv(variable) for field, variable in _SQL_VARIABLES.items()}
+    settings.update(
+        schema_ttl=float(os.getenv("WONKALYTICS_SCHEMA_TTL", "300")),
+        max_text_length=int(os.getenv("WONKALYTICS_MAX_TEXT_LENGTH", "1000000")),
+        promptlayer_url=os.getenv("URL_API_PROMPTLAYER", Config._field_defaults["promptlayer_url"]),
+        promptlayer_connect_timeout=float(os.getenv("WONKALYTICS_PL_CONNECT_TIMEOUT", "3.05")),
+        promptlayer_read_timeout=float(os.getenv("WONKALYTICS_PL_READ_TIMEOUT", "10")),
+        promptlayer_gzip=_flag("WONKALYTICS_PL_GZIP"),
+        background_logging=_flag("WONKALYTICS_BACKGROUND_LOGGING"),
+        batch_writes=_flag("WONKALYTICS_BATCH_WRITES"),
+        score_batching=_flag("WONKALYTICS_SCORE_BATCHING"),
+        dedup=_flag("WONKALYTICS_DEDUP"),
+        blob_table=os.getenv("WONKALYTICS_BLOB_TABLE", Config._field_defaults["blob_table"]),
+        spool=_flag("WONKALYTICS_SPOOL"),
+        spool_path=os.getenv("WONKALYTICS_SPOOL_PATH") or None,
+        metrics=_flag("WONKALYTICS_METRICS"),
+        sample_rate=_optional("WONKALYTICS_SAMPLE_RATE", float),
+        shed_backlog=_optional("WONKALYTICS_SHED_BACKLOG", int),
+        sql_workers=int(os.getenv("WONKALYTICS_SQL_WORKERS", "4")),
+        async_max_pending=int(os.getenv("WONKALYTICS_ASYNC_MAX_PENDING", "10000")),
+        collector_socket=os.getenv("WONKALYTICS_COLLECTOR_SOCKET") or None,
+        response_cache=_flag("WONKALYTICS_RESPONSE_CACHE"),
+        response_cache_path=os.getenv("WONKALYTICS_RESPONSE_CACHE_PATH") or None,
+        rate_limit=_flag("WONKALYTICS_RATE_LIMIT"),
+        circuit_breakers=_flag("WONKALYTICS_CIRCUIT_BREAKERS"),
+    )
+    settings.update(overrides)
+    return Config(**settings)
+
+
+_config = None
+_lock = threading.Lock()
+# Called with the old and the new settings by configure, see on_configure
+_listeners = []
+
+
+def get_config() -> Config:
+    """ Returns the settings, read from the environment on first use. """
+    global _config
+    config = _config
+    if config is None:
+        with _lock:
+            if _config is None:
+                _config = load_config()
+            config = _config
+    return config
+
+
+def configure(**settings) -> Config:
+    """
+    Change the settings, e.g. to log to another table.
+
+    The other settings keep their current values, also those set by an earlier configure call. The
+    environment is only read again after reset_config.
+
+    Settings that are read on every call (the table, the schema TTL, the text length limit, ...) apply
+    right away, and the shared PromptLayer client is rebuilt when its settings changed. New Azure SQL
+    settings get their own connection pool. Objects that already exist otherwise keep the settings they
+    were created with: features enabled from the environment (e.g. background logging or the spool at
+    WONKALYTICS_SPOOL_PATH) keep running until their disable function is called.
+
+    Example:
+    ```
+    wonkalytics.configure(table_name="analytics_staging")
+    ```
+
+    Args:
+        **settings: The settings to change.
+
+    Returns:
+        Config: The new settings.
+    """
+    global _config
+    unknown = set(settings) - set(Config._fields)
+    if unknown:
+        raise TypeError(f"Unknown Wonkalytics settings: {', '.join(sorted(unknown))}")
+    with _lock:
+        old_config = _config
+        config = _config = (old_config or load_config())._replace(**settings)
+    for listener in list(_listeners):
+        listener(old_config, config)
+    return config
+
+
+def on_configure(listener):
+    """
+    Register a function that is called with the old settings (None when they were not resolved yet)
+    and the new ones whenever configure changes them, e.g. to rebuild a client.
+    """
+    _listeners.append(listener)
+
+
+def reset_config():
+    """ Forget the resolved and configured settings, the environment is read again on next use. """
+    global _config
+    with _lock:
+        _config = None
+
+
+class LazySingleton:
+    """
+    Holds the active object of an opt-in feature, e.g. the background dispatcher.
+
+    The object is set by the feature's enable function, or created on first get() when the settings
+    enable the feature. Concurrent first calls create it once. After clear() the settings do not create
+    it again, until the enable function sets a new object.
+    """
+
+    def __init__(self, enabled, create):
+        """
+        Args:
+            enabled (callable): Returns whether the settings enable the feature.
+            create (callable): Enables the feature from the settings and returns the object, it is called
+                while holding 'lock' and usually calls set().
+        """
+        self._enabled = enabled
+        self._create = create
+        self._value = None
+        self._disabled = False
+        # Reentrant, get() holds it while create() calls set()
+        self.lock = threading.RLock()
+
+    @property
+    def value(self):
+        """ The active object, or None. Unlike get() it is never created from the settings. """
+        return self._value
+
+    def get(self):
+        """ Returns the active object, created when the settings enable the feature and it was not cleared. """
+        value = self._value
+        if value is None and not self._disabled and self._enabled():
+            with self.lock:
+                if self._value is None and not self._disabled:
+                    return self._create()
+                return self._value
+        return value
+
+    def set(self, value):
+        """ Make 'value' the active object. Returns the object it replaces, for the caller to close. """
+        with self.lock:
+            old, self._value = self._value, value
+            self._disabled = False
+        return old
+
+    def clear(self):
+        """ Disable the feature until the next set(). Returns the object that was active, for the caller to close. """
+        with self.lock:
+            old, self._value = self._value, None
+            self._disabled = True
+        return old
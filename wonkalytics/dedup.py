@@ -0,0 +1,212 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from .config import LazySingleton, get_config
+from .projection import AnalyticsRow
+
+# Column values replaced by a blob are logged as this prefix followed by the sha256 of the text
+REFERENCE_PREFIX = "blob:sha256:"
+
+
+class SqlBlobStore:
+    """
+    Stores deduplicated texts in a side table of the analytics database.
+
+    The table is expected to exist:
+
+        CREATE TABLE wonkalytics_blobs (
+            hash CHAR(64) NOT NULL PRIMARY KEY,
+            body NVARCHAR(MAX) NOT NULL,
+            created_at DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME()
+        )
+    """
+
+    def __init__(self, table_name: str = "wonkalytics_blobs"):
+        self.table_name = table_name
+
+    def put_many(self, pool, blobs: dict):
+        """
+        Store the blobs that are not stored yet, in one transaction.
+
+        Args:
+            pool (ConnectionPool): The pool of the analytics database.
+            blobs (dict): Hex sha256 digests mapped to their texts.
+        """
+        sql = (
+            f"INSERT INTO [{self.table_name}] (hash, body) SELECT ?, ? "
+            f"WHERE NOT EXISTS (SELECT 1 FROM [{self.table_name}] WITH (UPDLOCK, HOLDLOCK) WHERE hash = ?)"
+        )
+
+        def insert(cnxn):
+            cursor = cnxn.cursor()
+            for digest, body in blobs.items():
+                cursor.execute(sql, (digest, body, digest))
+            cnxn.commit()
+
+        pool.run(insert)
+
+    def get(self, pool, digest: str):
+        """ Returns the text stored for a digest, or None. """
+
+        def select(cnxn):
+            cursor = cnxn.cursor()
+            cursor.execute(f"SELECT body FROM [{self.table_name}] WHERE hash = ?", (digest,))
+            row = cursor.fetchone()
+            return None if row is None else row[0]
+
+        return pool.run(select)
+
+
+class SqliteBlobStore:
+    """ Stores deduplicated texts in a local SQLite database, e.g. for development or next to a local collector. """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): Path of the SQLite database file, created when missing.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, body TEXT NOT NULL, created_at REAL DEFAULT (julianday('now')))"
+        )
+
+    def put_many(self, pool, blobs: dict):
+        """ Store the blobs that are not stored yet, 'pool' is not used. """
+        with self._lock:
+            self._db.executemany("INSERT OR IGNORE INTO blobs (hash, body) VALUES (?, ?)", blobs.items())
+
+    def get(self, pool, digest: str):
+        """ Returns the text stored for a digest, or None. """
+        with self._lock:
+            row = self._db.execute("SELECT body FROM blobs WHERE hash = ?", (digest,)).fetchone()
+        return None if row is None else row[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class ContentDeduplicator:
+    """
+    Replaces large, repeated texts in analytics rows by a reference to a content-addressed blob.
+
+    Texts of at least 'min_size' characters in one of 'fields' are hashed with sha256 and stored once
+    in the blob store, the row gets 'blob:sha256:<hex digest>' instead. The digests known to be stored
+    are kept in an LRU of 'cache_size' entries, so a repeated system prompt is only hashed, not
+    uploaded again. Blobs are stored before the row is returned, so a logged reference always resolves.
+    """
+
+    def __init__(self, store=None, fields=("system_msg",), min_size: int = 1024, cache_size: int = 10000):
+        """
+        Args:
+            store (SqlBlobStore or SqliteBlobStore, optional): Where the texts are stored, defaults to a
+                SqlBlobStore in the analytics database.
+            fields (Iterable[str]): The columns to deduplicate.
+            min_size (int): Texts shorter than this are logged as they are.
+            cache_size (int): Number of digests remembered as stored.
+        """
+        self.store = store or SqlBlobStore()
+        self.fields = frozenset(fields)
+        self.min_size = min_size
+        self.cache_size = cache_size
+        self.blobs_written = 0
+        self._known = OrderedDict()
+        self._lock = threading.Lock()
+
+    def dedup(self, row: AnalyticsRow, pool=None) -> AnalyticsRow:
+        """
+        Replace the large texts of a row by blob references, storing the blobs that are not known yet.
+
+        Args:
+            row (AnalyticsRow): The projected row.
+            pool (ConnectionPool, optional): The pool of the analytics database, used by a SqlBlobStore.
+
+        Returns:
+            AnalyticsRow: The row with references, or the row itself when nothing was replaced.
+
+        Raises:
+            Exception: When the blobs could not be stored, the row should not be written with dangling references.
+        """
+        values = None
+        new_blobs = {}
+        for i, column in enumerate(row.columns):
+            value = row.values[i]
+            if column not in self.fields or not isinstance(value, str) or len(value) < self.min_size:
+                continue
+            digest = hashlib.sha256(value.encode("utf-8")).hexdigest()
+            if not self._is_known(digest):
+                new_blobs[digest] = value
+            if values is None:
+                values = list(row.values)
+            values[i] = REFERENCE_PREFIX + digest
+
+        if values is None:
+            return row
+        if new_blobs:
+            self.store.put_many(pool, new_blobs)
+            self.blobs_written += len(new_blobs)
+            self._remember(new_blobs)
+        return AnalyticsRow(row.columns, values)
+
+    def resolve(self, value, pool=None):
+        """
+        Returns the original text of a logged column value, or the value itself when it is not a reference.
+        """
+        if isinstance(value, str) and value.startswith(REFERENCE_PREFIX):
+            return self.store.get(pool, value[len(REFERENCE_PREFIX):])
+        return value
+
+    def _is_known(self, digest):
+        with self._lock:
+            if digest in self._known:
+                self._known.move_to_end(digest)
+                return True
+            return False
+
+    def _remember(self, digests):
+        with self._lock:
+            for digest in digests:
+                self._known[digest] = None
+                self._known.move_to_end(digest)
+            while len(self._known) > self.cache_size:
+                self._known.popitem(last=False)
+
+
+_deduplicator = LazySingleton(lambda: get_config().dedup, lambda: enable_dedup(SqlBlobStore(get_config().blob_table)))
+
+
+def enable_dedup(store=None, fields=("system_msg",), min_size: int = 1024, cache_size: int = 10000) -> ContentDeduplicator:
+    """
+    Log large, repeated texts (by default the system prompt) once in a blob store and reference them from the rows.
+
+    Takes the arguments of ContentDeduplicator.
+
+    Returns:
+        ContentDeduplicator: The active deduplicator.
+    """
+    deduplicator = ContentDeduplicator(store, fields, min_size, cache_size)
+    _deduplicator.set(deduplicator)
+    return deduplicator
+
+
+def disable_dedup():
+    """ Go back to logging every text in the row itself. """
+    _deduplicator.clear()
+
+
+def get_deduplicator():
+    """
+    Returns the active deduplicator, or None when deduplication is disabled.
+
+    Deduplication can also be enabled by setting the WONKALYTICS_DEDUP environment variable to 1,
+    the blobs are then stored in the WONKALYTICS_BLOB_TABLE table (default 'wonkalytics_blobs'),
+    unless it was disabled with disable_dedup.
+    """
+    return _deduplicator.get()
@@ -0,0 +1,204 @@
+import atexit
+import logging
+import queue
+import sys
+import threading
+import time
+from .config import LazySingleton, get_config
+
+_STOP = object()
+
+
+class BackgroundDispatcher:
+    """
+    A bounded in-process queue with worker thread(s) that runs logging work off the request path.
+
+    Work is submitted as a callable plus its arguments. Submitting never blocks (unless configured
+    to) so the caller only pays for a queue put. When the queue is full the work item is dropped
+    and counted, so a slow sink can never back up into the application.
+    """
+
+    def __init__(self, max_queue_size=10000, num_workers=1, put_timeout=0.0):
+        """
+        Initializes the dispatcher and starts its worker threads.
+
+        Args:
+            max_queue_size (int): Maximum number of queued work items before new items are dropped.
+            num_workers (int): Number of worker threads draining the queue.
+            put_timeout (float): Seconds to wait for a free queue slot before dropping. 0 never blocks.
+        """
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._put_timeout = put_timeout
+        self._pending = 0
+        self._pending_cond = threading.Condition()
+        self._closed = False
+        self._counter_lock = threading.Lock()
+        self.dropped = 0
+        self.failed = 0
+        self._workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(
+                target=self._run, name=f"wonkalytics-dispatcher-{i}", daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    @property
+    def backlog(self):
+        """ The number of submitted work items that have not finished yet. """
+        return self._pending
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues a callable to be run on a worker thread.
+
+        Returns:
+            bool: True if the work was queued, False if it was dropped because the queue is full or closed.
+        """
+        if self._closed:
+            return False
+        with self._pending_cond:
+            self._pending += 1
+        try:
+            if self._put_timeout:
+                self._queue.put((func, args, kwargs), timeout=self._put_timeout)
+            else:
+                self._queue.put_nowait((func, args, kwargs))
+        except queue.Full:
+            self._task_done()
+            with self._counter_lock:
+                self.dropped += 1
+            logging.warning("Wonkalytics background queue is full, dropping analytics event.")
+            return False
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Blocks until all queued work has been processed.
+
+        Args:
+            timeout (float, optional): Maximum number of seconds to wait. Waits indefinitely if None.
+
+        Returns:
+            bool: True if the queue was drained, False if the timeout expired first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._pending_cond:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._pending_cond.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """
+        Stops accepting work, drains the queue and stops the worker threads.
+
+        Args:
+            timeout (float, optional): Maximum number of seconds to wait for the drain.
+
+        Returns:
+            bool: True if all queued work was processed before closing.
+        """
+        if self._closed:
+            return True
+        self._closed = True
+        drained = self.flush(timeout)
+        for _ in self._workers:
+            try:
+                self._queue.put_nowait(_STOP)
+            except queue.Full:
+                break
+        for worker in self._workers:
+            worker.join(0 if not drained else timeout)
+        return drained
+
+    def _task_done(self):
+        with self._pending_cond:
+            self._pending -= 1
+            if not self._pending:
+                self._pending_cond.notify_all()
+
+    def _run(self):
+        while True:
+            work = self._queue.get()
+            if work is _STOP:
+                return
+            func, args, kwargs = work
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                with self._counter_lock:
+                    self.failed += 1
+                print(
+                    f"WARNING: Wonkalytics background worker had the following error: {e}",
+                    file=sys.stderr,
+                )
+            finally:
+                self._task_done()
+
+
+_dispatcher = LazySingleton(lambda: get_config().background_logging, lambda: enable_background_logging())
+_atexit_registered = False
+
+
+def enable_background_logging(max_queue_size=10000, num_workers=1, put_timeout=0.0, drain_timeout=5.0):
+    """
+    Enable the background dispatcher so analytics events are sent off the request path.
+
+    Args:
+        max_queue_size (int): Maximum number of queued events before new events are dropped.
+        num_workers (int): Number of worker threads sending events.
+        put_timeout (float): Seconds a caller may wait for a free queue slot. 0 never blocks.
+        drain_timeout (float): Seconds to wait for the queue to drain when the interpreter exits.
+
+    Returns:
+        BackgroundDispatcher: The active dispatcher.
+    """
+    global _atexit_registered
+    dispatcher = BackgroundDispatcher(max_queue_size, num_workers, put_timeout)
+    with _dispatcher.lock:
+        old_dispatcher = _dispatcher.set(dispatcher)
+        if not _atexit_registered:
+            atexit.register(lambda: disable_background_logging(drain_timeout))
+            _atexit_registered = True
+    if old_dispatcher is not None:
+        old_dispatcher.close(drain_timeout)
+    return dispatcher
+
+
+def disable_background_logging(timeout=None):
+    """
+    Drain and stop the background dispatcher. Events are sent inline again afterwards.
+
+    Returns:
+        bool: True if all queued events were sent before stopping.
+    """
+    dispatcher = _dispatcher.clear()
+    if dispatcher is None:
+        return True
+    return dispatcher.close(timeout)
+
+
+def get_dispatcher():
+    """
+    Returns the active dispatcher, or None when background logging is disabled.
+
+    Background logging can also be enabled by setting the WONKALYTICS_BACKGROUND_LOGGING environment variable to 1,
+    unless it was disabled with disable_background_logging.
+    """
+    return _dispatcher.get()
+
+
+def flush(timeout=None):
+    """
+    Block until all queued analytics events are sent.
+
+    Returns:
+        bool: True if the queue was drained, False if the timeout expired first.
+    """
+    dispatcher = _dispatcher.value
+    if dispatcher is None:
+        return True
+    return dispatcher.flush(timeout)
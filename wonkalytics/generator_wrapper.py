@@ -1,8 +1,13 @@
-from copy import deepcopy
-import wonkalytics.openai_wrapper as openai_wrapper
-from .analytics import wonkalytics_and_promptlayer_api_request
+import inspect
+import sys
+import time
+from .analytics import get_uid, wonkalytics_and_promptlayer_api_request
+from .async_analytics import queue_analytics_request, submit_analytics_request
 
 def get_api_key():
+    # openai_wrapper imports this module (through utils), so it is imported here
+    import wonkalytics.openai_wrapper as openai_wrapper
+
     # raise an error if the api key is not set
     if openai_wrapper.api_key is None:
         raise Exception(
@@ -12,11 +17,35 @@ def get_api_key():
         return openai_wrapper.api_key
 
 
+# The stream timing columns, see GeneratorWrapper._stream_timing
+STREAM_TIMING_COLUMNS = (
+    "time_to_first_token",
+    "stream_duration",
+    "chunk_count",
+    "chunk_gap_mean",
+    "chunk_gap_max",
+    "tokens_per_sec",
+)
+
 
 class GeneratorWrapper:
     """
     A proxy wrapper for generators, facilitating both synchronous and asynchronous iterations,
     and handling API responses for analytics logging and result processing.
+
+    Exactly one analytics event is logged per stream, when it ends or is closed, so chunks after the
+    finish reason (e.g. the usage sent with stream_options={"include_usage": True}) are included. It is
+    'completed' when the stream ended or the provider reported a finish reason (stop, length,
+    tool_calls, content_filter, ...), and 'aborted' with the partial content when the stream is closed,
+    errors or is garbage collected before that. With 'return_pl_id' the id is returned with the chunk
+    that carries the finish reason, and the event is logged with that id once the stream ends. A stream
+    that is garbage collected or interrupted (KeyboardInterrupt, SystemExit) is only queued for logging,
+    it is never sent on the thread that collects or interrupts it.
+
+    The arrival of every chunk is timed with the monotonic clock that OpenAIWrapper started at the
+    request ('request_started'), so the event records the time to the first token, the stream's
+    duration, the gaps between chunks and the output tokens per second, and its end time is when the
+    last chunk arrived rather than when the stream was opened.
     """
 
     def __init__(self, generator, api_request_arguments):
@@ -25,11 +54,33 @@ class GeneratorWrapper:
 
         Args:
             generator: The generator to be wrapped.
-            api_request_arguments (dict): Arguments for API requests.
+            api_request_arguments (dict): Arguments for API requests. Its 'request_started' is the
+                time.perf_counter() of the request's start, when missing it is derived from the request's timestamps.
         """
         self.generator = generator
-        self.results = []
         self.api_request_arguments = api_request_arguments
+        # The stream is folded into these as it is consumed, so chunks are never retained
+        self._role = ""
+        self._content_parts = []
+        self._is_delta = None
+        self._last_chunk = None
+        self._finish_reason = None
+        self._logged = False
+        # Handed out with the finishing chunk before the stream is logged, see _overridden_next
+        self._uid = None
+        # Async streams are logged without blocking the event loop
+        self._is_async = hasattr(generator, "__anext__")
+        # Chunk arrivals are measured from the start of the request on the same monotonic clock
+        self._started = api_request_arguments.get("request_started")
+        if self._started is None:
+            self._started = time.perf_counter() - (
+                api_request_arguments["request_end_time"] - api_request_arguments["request_start_time"]
+            )
+        self._first_chunk_at = None
+        self._last_chunk_at = None
+        self._chunk_count = 0
+        self._content_chunks = 0
+        self._max_gap = 0.0
 
     def __iter__(self):
         """ Returns the iterator object itself for synchronous iteration. """
@@ -39,19 +90,79 @@ class GeneratorWrapper:
         """ Returns the iterator object itself for asynchronous iteration. """
         return self
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
     async def __anext__(self):
         """ Retrieves the next item asynchronously from the generator. """
-        result = await self.generator.__anext__()
+        try:
+            result = await self.generator.__anext__()
+        except StopAsyncIteration:
+            self._log_once("completed")
+            raise
+        except (KeyboardInterrupt, SystemExit):
+            self._log_once("aborted", background=True)
+            raise
+        except BaseException:
+            # Includes asyncio.CancelledError when the client disconnects mid-stream
+            self._log_once("aborted")
+            raise
         return self._overridden_next(result)
 
     def __next__(self):
         """ Retrieves the next item synchronously from the generator. """
-        result = next(self.generator)
+        try:
+            result = next(self.generator)
+        except StopIteration:
+            self._log_once("completed")
+            raise
+        except (KeyboardInterrupt, SystemExit):
+            self._log_once("aborted", background=True)
+            raise
+        except BaseException:
+            self._log_once("aborted")
+            raise
         return self._overridden_next(result)
 
+    def close(self):
+        """ Closes the stream, logging it as aborted when it did not finish yet. """
+        self._log_once("aborted")
+        close = getattr(self.generator, "close", None)
+        if close is not None:
+            close()
+
+    async def aclose(self):
+        """ Closes the async stream, logging it as aborted when it did not finish yet. """
+        self._log_once("aborted")
+        close = getattr(self.generator, "aclose", None) or getattr(self.generator, "close", None)
+        if close is not None:
+            result = close()
+            if inspect.isawaitable(result):
+                await result
+
+    def __del__(self):
+        # Streams abandoned without close() (e.g. a client disconnected) are logged when collected.
+        # This runs on whatever thread triggered the collection, so the event is only queued.
+        if sys.is_finalizing():
+            return
+        try:
+            self._log_once("aborted", background=True)
+        except Exception:
+            pass
+
     def _overridden_next(self, result):
         """
-        Processes the result, appends it to results, and handles analytics logging.
+        Times the chunk and folds it into the accumulated response. With 'return_pl_id' the chunk that
+        carries the finish reason is returned with the id the stream will be logged with.
 
         Args:
             result: The result obtained from the generator.
@@ -59,34 +170,73 @@ class GeneratorWrapper:
         Returns:
             The processed result, optionally alongside a request ID.
         """
-        # Storing the result
-        self.results.append(result)
+        now = time.perf_counter()
+        if self._chunk_count:
+            gap = now - self._last_chunk_at
+            if gap > self._max_gap:
+                self._max_gap = gap
+        else:
+            self._first_chunk_at = now
+        self._last_chunk_at = now
+        self._chunk_count += 1
+
+        # Accumulating the result
+        self._accumulate(result)
 
-        # Analytics handling based on provider type
+        if not self.api_request_arguments["return_pl_id"]:
+            return result
+        # The stream is logged when it ends, the id it will be logged with is returned with the finishing chunk
         provider_type = self.api_request_arguments["provider_type"]
-        end_condition_met = provider_type == "openai" and (
-            result.choices[0].finish_reason in ["stop", "length"]
-        )
+        if provider_type == "openai" and self._finish_reason is not None and self._uid is None and not self._logged:
+            self._uid = get_uid()
+            return result, self._uid
+        return result, None
 
-        if end_condition_met:
-            # Perform analytics API request if conditions are met
-            request_id = self._perform_analytics_request()
-            if self.api_request_arguments["return_pl_id"]:
-                return result, request_id
+    def _log_once(self, status, background=False):
+        """
+        Logs the stream with the given status, unless it was logged before.
 
-        # Return result with or without request ID
-        return result if not self.api_request_arguments["return_pl_id"] else (result, None)
+        Args:
+            status (str): 'completed' or 'aborted'.
+            background (bool): Only queue the event on the dispatcher (or the SQL executor), never send it on this thread.
+
+        Returns:
+            The request ID from the analytics request, or None if the stream was already logged or is logged in the background.
+        """
+        if self._logged:
+            return None
+        self._logged = True
+        if status == "aborted" and self._finish_reason is not None:
+            # The provider finished the stream, only trailing chunks (e.g. the usage) were not read
+            status = "completed"
+        try:
+            return self._perform_analytics_request(status, background)
+        finally:
+            # Release the buffered content, the stream will not be logged again
+            self._content_parts = []
+            self._last_chunk = None
 
-    def _perform_analytics_request(self):
+    def _perform_analytics_request(self, status="completed", background=False):
         """
         Performs an analytics request based on the gathered results and API arguments.
 
+        Args:
+            status (str): 'completed' or 'aborted', logged as 'stream_status'.
+            background (bool): See _log_once.
+
         Returns:
-            The request ID from the analytics request.
+            The request ID from the analytics request, None when it is logged in the background.
         """
         # Processing the accumulated results for analytics request
         cleaned_result = self.clean_chunk()
-        return wonkalytics_and_promptlayer_api_request(
+        metadata = dict(self.api_request_arguments.get("metadata") or {}, stream_status=status)
+        if self._finish_reason is not None:
+            metadata["finish_reason"] = self._finish_reason
+        metadata.update(self._stream_timing())
+        # The stream ended when its last chunk arrived, or now when none did
+        ended_at = self._last_chunk_at if self._last_chunk_at is not None else time.perf_counter()
+        request_end_time = self.api_request_arguments["request_start_time"] + (ended_at - self._started)
+        args = (
             self.api_request_arguments["function_name"],
             self.api_request_arguments["provider_type"],
             self.api_request_arguments["args"],
@@ -95,35 +245,94 @@ class GeneratorWrapper:
             self.api_request_arguments["request"],
             cleaned_result,
             self.api_request_arguments["request_start_time"],
-            self.api_request_arguments["request_end_time"],
+            request_end_time,
             get_api_key(),
-            return_pl_id=self.api_request_arguments["return_pl_id"],
         )
+        kwargs = {"return_pl_id": self.api_request_arguments["return_pl_id"], "metadata": metadata, "uid": self._uid}
+        if background:
+            # A queue put, the event is built and sent by a worker
+            queue_analytics_request(*args, **kwargs)
+            return None
+        request_func = submit_analytics_request if self._is_async else wonkalytics_and_promptlayer_api_request
+        return request_func(*args, **kwargs)
+
+    def _stream_timing(self):
+        """
+        Returns the timing of the stream, in seconds:
+        - time_to_first_token: from the start of the request to the first chunk.
+        - stream_duration: from the first to the last chunk.
+        - chunk_count: the number of chunks.
+        - chunk_gap_mean, chunk_gap_max: the time between consecutive chunks.
+        - tokens_per_sec: output tokens over the stream's duration, using the reported usage when the
+          provider sends it and otherwise the number of chunks with content (one token each for OpenAI).
+        """
+        if not self._chunk_count:
+            return {"chunk_count": 0}
+        duration = self._last_chunk_at - self._first_chunk_at
+        timing = {
+            "time_to_first_token": self._first_chunk_at - self._started,
+            "stream_duration": duration,
+            "chunk_count": self._chunk_count,
+        }
+        if self._chunk_count > 1:
+            timing["chunk_gap_mean"] = duration / (self._chunk_count - 1)
+            timing["chunk_gap_max"] = self._max_gap
+        usage = getattr(self._last_chunk, "usage", None) if self._last_chunk is not None else None
+        tokens = getattr(usage, "completion_tokens", None) if usage else None
+        if tokens is None:
+            tokens = self._content_chunks
+        if duration > 0 and tokens:
+            timing["tokens_per_sec"] = tokens / duration
+        return timing
+
+    def _accumulate(self, result):
+        """
+        Folds a chunk into the running role and content buffer and keeps it as the last chunk.
+
+        Only the last chunk is referenced, for the final metadata (id, model, created, ...).
+        """
+        if not result.choices:
+            # E.g. a final usage chunk
+            self._last_chunk = result
+            return
+        choice = result.choices[0]
+        finish_reason = getattr(choice, "finish_reason", None)
+        if finish_reason:
+            self._finish_reason = finish_reason
+        if self._is_delta is None:
+            # Check if the response is completion with delta
+            self._is_delta = hasattr(choice, "delta")
+        if self._is_delta:
+            delta = choice.delta
+            role = getattr(delta, "role", None)
+            if role:
+                self._role = role
+            content = getattr(delta, "content", None)
+            if content:
+                self._content_parts.append(content)
+                self._content_chunks += 1
+        self._last_chunk = result
 
     def clean_chunk(self):
         """
-        Cleans and combines the accumulated results into a single response.
+        Combines the accumulated results into a single response.
 
         Returns:
             The combined response from the results.
-        """        
-        # Check if the response is completion with delta
-        if hasattr(self.results[0].choices[0], "delta"):
+        """
+        if self._is_delta and self._last_chunk is not None:
             return self._combine_delta_responses()
 
         # Return an empty string if no recognizable response type
         return ""
 
-
     def _combine_delta_responses(self):
-        """ Combines delta responses into a single response object. """
-        response = {"role": "", "content": ""}
-        for result in self.results:
-            delta = result.choices[0].delta
-            if hasattr(delta, "role") and delta.role:
-                response["role"] = delta.role
-            if hasattr(delta, "content") and delta.content:
-                response["content"] += delta.content
-        final_result = deepcopy(self.results[-1])
-        final_result.choices[0] = response
+        """ Combines the accumulated deltas and the metadata of the last chunk into a single response dict. """
+        response = {"role": self._role, "content": "".join(self._content_parts)}
+        last_chunk = self._last_chunk
+        if hasattr(last_chunk, "model_dump"):
+            final_result = last_chunk.model_dump(exclude={"choices"})
+        else:
+            final_result = {k: v for k, v in last_chunk.items() if k != "choices"}
+        final_result["choices"] = [response]
         return final_result
@@ -0,0 +1,268 @@
+import bisect
+import threading
+import time
+from .config import get_config
+
+# Upper bounds (seconds) of the stage latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class NoopMetrics:
+    """
+    The metrics interface, recording nothing. This is the default, so instrumentation costs a function call.
+
+    A backend (e.g. for StatsD or OpenTelemetry) implements increment, observe and set_gauge and
+    sets 'enabled' to True. Labels are passed as a dict of strings.
+    """
+
+    enabled = False
+
+    def increment(self, name: str, value: float = 1, labels: dict = None):
+        """ Add 'value' to a counter. """
+
+    def observe(self, name: str, value: float, labels: dict = None):
+        """ Record a value, e.g. a duration in seconds, in a histogram. """
+
+    def set_gauge(self, name: str, value: float, labels: dict = None):
+        """ Set a gauge, e.g. a queue depth, to its current value. """
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class InMemoryMetrics(NoopMetrics):
+    """ Keeps counters, gauges and histograms in memory and renders them in the Prometheus text format. """
+
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Args:
+            buckets (tuple): Upper bounds of the histogram buckets, in increasing order.
+        """
+        self.buckets = tuple(buckets)
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, labels=None):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = (name, _label_key(labels))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(len(self.buckets) + 1)
+            histogram.counts[index] += 1
+            histogram.sum += value
+            histogram.count += 1
+
+    def set_gauge(self, name, value, labels=None):
+        with self._lock:
+            self._gauges[(name, _label_key(labels))] = value
+
+    def get(self, name: str, labels: dict = None):
+        """ Returns the value of a counter or gauge, or the (count, sum) of a histogram, None when it was never recorded. """
+        key = (name, _label_key(labels))
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            if key in self._gauges:
+                return self._gauges[key]
+            histogram = self._histograms.get(key)
+            return None if histogram is None else (histogram.count, histogram.sum)
+
+    def render_prometheus(self) -> str:
+        """ Returns all metrics in the Prometheus text exposition format. """
+        lines = []
+        with self._lock:
+            for kind, values in (("counter", self._counters), ("gauge", self._gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (metric_name, labels), value in sorted(values.items()):
+                        if metric_name == name:
+                            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (metric_name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+                    if metric_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + (float("inf"),), histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else _format_value(bound)
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(10), chr(92) + "n").replace(chr(34), chr(92) + chr(34))}"'
+        for key, value in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _StageTimer:
+    """ Observes the seconds spent in a 'with' block as wonkalytics_stage_seconds{stage=...}. """
+
+    __slots__ = ("backend", "labels", "start")
+
+    def __init__(self, backend, stage):
+        self.backend = backend
+        self.labels = {"stage": stage}
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.backend.observe("wonkalytics_stage_seconds", time.perf_counter() - self.start, self.labels)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+_backend = NoopMetrics()
+# The configuration is checked once, by the first instrumented call
+_env_checked = False
+
+
+def _active():
+    backend = _backend
+    if backend.enabled or _env_checked:
+        return backend
+    return get_metrics_backend()
+
+
+def time_stage(stage: str):
+    """
+    Time a pipeline stage, e.g. 'serialize', 'promptlayer_post', 'schema_lookup', 'projection', 'connect' or 'insert'.
+
+    Usage:
+        with time_stage("insert"):
+            ...
+    """
+    backend = _active()
+    if not backend.enabled:
+        return _NULL_TIMER
+    return _StageTimer(backend, stage)
+
+
+def increment(name: str, value: float = 1, labels: dict = None):
+    """ Add to a counter of the active backend. """
+    backend = _active()
+    if backend.enabled:
+        backend.increment(name, value, labels)
+
+
+def set_gauge(name: str, value: float, labels: dict = None):
+    """ Set a gauge of the active backend. """
+    backend = _active()
+    if backend.enabled:
+        backend.set_gauge(name, value, labels)
+
+
+def observe(name: str, value: float, labels: dict = None):
+    """ Record a value in a histogram of the active backend. """
+    backend = _active()
+    if backend.enabled:
+        backend.observe(name, value, labels)
+
+
+def count_event(decision: str):
+    """ Count a logged call by its sampling decision: 'full', 'slim' or 'drop'. """
+    increment("wonkalytics_events_total", 1, {"decision": decision})
+
+
+def count_dropped(reason: str):
+    """ Count an event that was not logged, e.g. 'sampled' or 'queue_full'. """
+    increment("wonkalytics_events_dropped_total", 1, {"reason": reason})
+
+
+def count_sink(sink: str, outcome: str):
+    """ Count an event sent to a sink ('promptlayer' or 'sql'), with outcome 'success', 'spooled', 'rejected' or 'failure'. """
+    increment("wonkalytics_sink_events_total", 1, {"sink": sink, "outcome": outcome})
+
+
+def set_backlog(dispatcher):
+    """ Report the background dispatcher's backlog. """
+    if dispatcher is not None:
+        set_gauge("wonkalytics_backlog", dispatcher.backlog)
+
+
+def set_metrics_backend(backend) -> None:
+    """ Send the pipeline's metrics to 'backend' (see NoopMetrics for the interface), None for no metrics. """
+    global _backend, _env_checked
+    _backend = backend if backend is not None else NoopMetrics()
+    _env_checked = True
+
+
+def enable_metrics(buckets=DEFAULT_BUCKETS) -> InMemoryMetrics:
+    """
+    Record the pipeline's metrics in memory, to be exposed with render_prometheus().
+
+    Returns:
+        InMemoryMetrics: The active backend.
+    """
+    backend = InMemoryMetrics(buckets)
+    set_metrics_backend(backend)
+    return backend
+
+
+def get_metrics_backend():
+    """
+    Returns the active metrics backend.
+
+    In-memory metrics can also be enabled by setting the WONKALYTICS_METRICS environment variable to 1.
+    """
+    global _env_checked
+    if not _backend.enabled and not _env_checked:
+        _env_checked = True
+        if get_config().metrics:
+            return enable_metrics()
+    return _backend
+
+
+def render_prometheus() -> str:
+    """
+    Returns the recorded metrics in the Prometheus text format, e.g. to serve on a /metrics endpoint.
+
+    Raises:
+        RuntimeError: When the active backend does not keep the metrics in memory.
+    """
+    backend = get_metrics_backend()
+    if not isinstance(backend, InMemoryMetrics):
+        raise RuntimeError("Metrics are not recorded in memory, call wonkalytics.metrics.enable_metrics() first.")
+    return backend.render_prometheus()
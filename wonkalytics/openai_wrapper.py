@@ -1,6 +1,25 @@
-import datetime
+import functools
 import inspect
-from .utils import async_wrapper, get_api_key, wonkalytics_api_handler
+import time
+import types
+from .cache import get_response_cache
+from .ratelimit import get_rate_limiter
+from .utils import async_cached_wrapper, async_wrapper, end_time_now, get_api_key, log_failed_call, wonkalytics_api_handler
+
+# Attribute values that are returned as is instead of being wrapped
+_PASSTHROUGH_TYPES = (str, bytes, int, float, bool, type(None), list, tuple, dict, set, frozenset)
+
+def _same_target(cached, attribute):
+    """ Check whether a cached wrapper still wraps 'attribute', bound methods are new objects on every access. """
+    if cached is attribute:
+        return True
+    return (
+        type(attribute) is types.MethodType
+        and type(cached) is types.MethodType
+        and cached.__func__ is attribute.__func__
+        and cached.__self__ is attribute.__self__
+    )
+
 
 class OpenAIWrapper(object):
     """
@@ -20,6 +39,9 @@ class OpenAIWrapper(object):
         object.__setattr__(self, "_obj", obj)
         object.__setattr__(self, "_function_name", function_name)
         object.__setattr__(self, "provider", provider)
+        # Child wrappers by attribute name, so e.g. openai.ChatCompletion.create is only wrapped once
+        object.__setattr__(self, "_children", {})
+        object.__setattr__(self, "_is_class", inspect.isclass(obj))
 
     def __call__(self, *args, **kwargs):
         """
@@ -38,37 +60,64 @@ class OpenAIWrapper(object):
             raise TypeError("Tags must be a list of strings.")
 
         return_pl_id = kwargs.pop("return_pl_id", kwargs.pop("return_wl_id", False))
-        request_start_time = datetime.datetime.now().timestamp()
+        request_start_time = time.time()
+        # Every duration of the call is measured from here with the monotonic clock
+        request_started = time.perf_counter()
 
         # Pop the request param, so openai does not get params is does not want
         request = kwargs.pop('request', None)
 
         # Accessing the actual object to be called
         wrapped_obj = object.__getattribute__(self, "_obj")
+        function_name = object.__getattribute__(self, "_function_name")
+        provider = object.__getattribute__(self, "provider")
         # Handling instantiation if the object is a class
-        if inspect.isclass(wrapped_obj):
+        if object.__getattribute__(self, "_is_class"):
             return OpenAIWrapper(
                 wrapped_obj(*args, **kwargs),
-                function_name=object.__getattribute__(self, "_function_name"),
-                provider=object.__getattribute__(self, "provider"),
+                function_name=function_name,
+                provider=provider,
             )
 
-        # Execute the function and handle the response
-        response = wrapped_obj(*args, **kwargs)
-        # If response is a coroutine, handle asynchronously
-        if inspect.iscoroutine(response) or inspect.iscoroutinefunction(wrapped_obj):
+        func = functools.partial(wrapped_obj, *args, **kwargs)
+        # Wait for the rate limiter when it is enabled, cache hits do not
+        rate_limiter = get_rate_limiter()
+        if rate_limiter is not None:
+            func = rate_limiter.wrap(func, kwargs, request)
+
+        # Serve deterministic calls from the response cache when it is enabled
+        response_cache = get_response_cache()
+        cache_key = response_cache.key(function_name, provider, args, kwargs) if response_cache is not None else None
+        cache_hit = None
+        try:
+            if cache_key is not None:
+                result = response_cache.call(cache_key, func)
+                # The call is async when it returned an awaitable
+                if inspect.isawaitable(result):
+                    return async_cached_wrapper(
+                        result, return_pl_id, request_start_time, request_started,
+                        function_name, provider, tags, request, args, kwargs
+                    )
+                response, cache_hit = result
+            else:
+                # Execute the function and handle the response
+                response = func()
+        except Exception as e:
+            # Failed calls are logged with their error, then raised as if the wrapper was not there
+            log_failed_call(function_name, provider, args, kwargs, tags, request, e, request_start_time, return_pl_id, request_started=request_started)
+            raise
+        # If response is awaitable (e.g. a coroutine), handle asynchronously
+        if inspect.isawaitable(response):
             return async_wrapper(
-                response, return_pl_id, request_start_time,
-                object.__getattribute__(self, "_function_name"),
-                object.__getattribute__(self, "provider"), tags,request, *args, **kwargs
+                response, return_pl_id, request_start_time, request_started,
+                function_name, provider, tags,request, *args, **kwargs
             )
 
         # Handle synchronous function call
-        request_end_time = datetime.datetime.now().timestamp()
         return wonkalytics_api_handler(
-            object.__getattribute__(self, "_function_name"),
-            object.__getattribute__(self, "provider"), args, kwargs, tags,request, response,
-            request_start_time, request_end_time, get_api_key(), return_pl_id=return_pl_id
+            function_name, provider, args, kwargs, tags,request, response,
+            request_start_time, end_time_now(request_start_time, request_started), get_api_key(), return_pl_id=return_pl_id,
+            metadata=None if cache_hit is None else {"cache_hit": cache_hit}, request_started=request_started,
         )
 
     def __getattr__(self, name):
@@ -83,17 +132,24 @@ class OpenAIWrapper(object):
         """
         # Get the actual attribute from the wrapped object
         attribute = getattr(object.__getattribute__(self, "_obj"), name)
-        # Wrap callable attributes in another wrapper instance
-        if name != "count_tokens" and (
-            inspect.isclass(attribute) or inspect.isfunction(attribute) 
-            or inspect.ismethod(attribute) or isinstance(attribute, object)):
-            return OpenAIWrapper(
-                attribute,
-                function_name=f'{object.__getattribute__(self, "_function_name")}.{name}',
-                provider=object.__getattribute__(self, "provider"),
-            )
-        # Return non-callable attributes directly
-        return attribute
+        # Return primitive attributes (api_key, api_base, ...) directly
+        if name == "count_tokens" or isinstance(attribute, _PASSTHROUGH_TYPES):
+            return attribute
+
+        # Reuse the wrapper of this attribute as long as it still wraps the same object
+        children = object.__getattribute__(self, "_children")
+        child = children.get(name)
+        if child is not None and _same_target(object.__getattribute__(child, "_obj"), attribute):
+            return child
+
+        # Wrap the other attributes (modules, classes, functions, methods, ...) in another wrapper instance
+        child = OpenAIWrapper(
+            attribute,
+            function_name=f'{object.__getattribute__(self, "_function_name")}.{name}',
+            provider=object.__getattribute__(self, "provider"),
+        )
+        children[name] = child
+        return child
 
     def __setattr__(self, name, value):
         """
@@ -103,6 +159,7 @@ class OpenAIWrapper(object):
             name (str): The name of the attribute to set.
             value: The value to set for the attribute.
         """
+        object.__getattribute__(self, "_children").pop(name, None)
         setattr(object.__getattribute__(self, "_obj"), name, value)
 
     def __delattr__(self, name):
@@ -112,4 +169,5 @@ class OpenAIWrapper(object):
         Args:
             name (str): The name of the attribute to delete.
         """
+        object.__getattribute__(self, "_children").pop(name, None)
         delattr(object.__getattribute__(self, "_obj"), name)
@@ -0,0 +1,363 @@
+import atexit
+import logging
+import random
+import re
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from .breaker import get_breaker
+from .metrics import time_stage
+
+# SQLSTATEs meaning the connection itself is gone and should not be reused
+_DISCONNECT_SQLSTATES = {"08S01", "08001", "08003", "08004", "08007", "01002"}
+
+# Azure SQL errors that are expected to go away within seconds (failovers, throttling, deadlocks), see
+# https://learn.microsoft.com/en-us/azure/azure-sql/database/troubleshoot-common-errors-issues
+TRANSIENT_SQL_ERRORS = frozenset({
+    20, 64, 121, 233, 1205, 4060, 4221, 10053, 10054, 10060, 10928, 10929, 10936,
+    40143, 40197, 40501, 40540, 40613, 41301, 41302, 41305, 41325, 41839, 49918, 49919, 49920,
+})
+_ERROR_NUMBER = re.compile(r"\((\d+)\)")
+
+# Defaults for newly created pools, see configure_pools
+POOL_SETTINGS = {
+    "max_size": 5,
+    "idle_timeout": 300.0,
+    "health_check_interval": 30.0,
+    "acquire_timeout": 30.0,
+    "transient_retries": 2,
+    "retry_delay": 0.2,
+    "max_retry_delay": 2.0,
+}
+
+
+def build_connection_string(
+    server,
+    database,
+    username,
+    password,
+    encrypt: str = "yes",
+    connection_timeout: int = 30,
+    trust_server_certificate: str = "no",
+) -> str:
+    """ Build the ODBC connection string for the Azure SQL database. """
+    return f"DRIVER={{ODBC Driver 18 for SQL Server}};SERVER={server};DATABASE={database};Uid={username};Pwd={password};Encrypt={encrypt};TrustServerCertificate={trust_server_certificate};Connection Timeout={connection_timeout};"
+
+
+def is_pyodbc_error(error: Exception) -> bool:
+    """
+    Check whether an error is a pyodbc.Error.
+
+    pyodbc is only imported when the first connection is opened, before that no error can come from it.
+    """
+    pyodbc = sys.modules.get("pyodbc")
+    return pyodbc is not None and isinstance(error, pyodbc.Error)
+
+
+def is_disconnect_error(error: Exception) -> bool:
+    """
+    Check whether a pyodbc error means the connection is broken (network failure, failover, killed session).
+
+    Args:
+        error (Exception): The error raised while using a connection.
+
+    Returns:
+        bool: True if the connection should be discarded instead of returned to the pool.
+    """
+    if not is_pyodbc_error(error):
+        return False
+    sqlstate = error.args[0] if error.args else ""
+    if sqlstate in _DISCONNECT_SQLSTATES:
+        return True
+    message = str(error).lower()
+    return "communication link failure" in message or "connection is busy" in message
+
+
+def is_transient_sql_error(error: Exception) -> bool:
+    """
+    Check whether a pyodbc error carries one of the TRANSIENT_SQL_ERRORS, which the ODBC driver puts
+    in the message, e.g. '... is not currently available. (40613) (SQLDriverConnect)'.
+    """
+    if not is_pyodbc_error(error):
+        return False
+    message = " ".join(str(arg) for arg in error.args[1:]) if len(error.args) > 1 else str(error)
+    return any(int(number) in TRANSIENT_SQL_ERRORS for number in _ERROR_NUMBER.findall(message))
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of pyodbc connections for a single connection string.
+
+    Connections are handed out most-recently-used first, evicted once they have been idle for
+    longer than 'idle_timeout', health checked with a 'SELECT 1' when they have not been used for
+    'health_check_interval' seconds, and discarded when they fail with a disconnect error.
+    """
+
+    def __init__(
+        self,
+        connection_string: str,
+        max_size: int = 5,
+        idle_timeout: float = 300.0,
+        health_check_interval: float = 30.0,
+        acquire_timeout: float = 30.0,
+        transient_retries: int = 2,
+        retry_delay: float = 0.2,
+        max_retry_delay: float = 2.0,
+    ):
+        """
+        Initializes an empty pool, connections are opened on demand.
+
+        Args:
+            connection_string (str): The ODBC connection string.
+            max_size (int): Maximum number of open connections (idle and in use).
+            idle_timeout (float): Seconds after which an idle connection is closed.
+            health_check_interval (float): Idle seconds after which a connection is checked before reuse.
+            acquire_timeout (float): Seconds to wait for a free connection when the pool is exhausted.
+            transient_retries (int): How many times run retries after one of the TRANSIENT_SQL_ERRORS.
+            retry_delay (float): Seconds before the first retry, doubled (with jitter) for every next one.
+            max_retry_delay (float): Maximum seconds between retries.
+        """
+        self._connection_string = connection_string
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self.transient_retries = transient_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._idle = deque()  # (connection, last used monotonic time), most recent on the right
+        self._size = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+    @property
+    def size(self):
+        """ The number of open connections, idle and in use. """
+        return self._size
+
+    @property
+    def idle(self):
+        """ The number of idle connections. """
+        return len(self._idle)
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection from the pool for the duration of the 'with' block.
+
+        Broken connections are discarded, other errors roll back the open transaction before the
+        connection is returned to the pool.
+        """
+        cnxn = self._acquire()
+        try:
+            yield cnxn
+        except Exception as e:
+            if is_disconnect_error(e) or not _rollback_quietly(cnxn):
+                self._discard(cnxn)
+            else:
+                self._release(cnxn)
+            raise
+        else:
+            self._release(cnxn)
+
+    def run(self, func, retries: int = 1):
+        """
+        Call 'func' with a pooled connection, reconnecting when the connection turns out to be broken
+        and retrying with backoff after a transient Azure SQL error.
+
+        When circuit breakers are enabled (see breaker.enable_circuit_breakers) and the 'sql' breaker
+        is open, breaker.CircuitOpenError is raised right away.
+
+        Args:
+            func (callable): Called with the connection, should commit its own transaction.
+            retries (int): How many times to retry on a fresh connection after a disconnect error.
+
+        Returns:
+            The return value of 'func'.
+        """
+        breaker = get_breaker("sql")
+        if breaker is None:
+            return self._run(func, retries)
+        return breaker.call(self._run, func, retries)
+
+    def _run(self, func, retries):
+        disconnects = transient = 0
+        while True:
+            try:
+                with self.connection() as cnxn:
+                    return func(cnxn)
+            except Exception as e:
+                if disconnects < retries and is_disconnect_error(e):
+                    disconnects += 1
+                    logging.warning(f"Wonkalytics SQL connection was broken, reconnecting: {e}")
+                elif transient < self.transient_retries and is_transient_sql_error(e):
+                    # Equal jitter: at least half the backoff, so retries of many threads spread out
+                    delay = min(self.max_retry_delay, self.retry_delay * 2**transient)
+                    transient += 1
+                    logging.warning(f"Wonkalytics got a transient SQL error, retrying in {delay:.1f}s: {e}")
+                    time.sleep(delay / 2 + random.uniform(0, delay / 2))
+                else:
+                    raise
+
+    def close(self):
+        """ Close all idle connections. Connections in use are closed when they are returned. """
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, deque()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for cnxn, _ in idle:
+            _close_quietly(cnxn)
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            stale = []
+            cnxn = None
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    # Evict connections from the least recently used side
+                    while self._idle and now - self._idle[0][1] > self.idle_timeout:
+                        stale.append(self._idle.popleft()[0])
+                        self._size -= 1
+                    if self._idle:
+                        cnxn, last_used = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        last_used = None
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise TimeoutError(
+                            f"Wonkalytics could not get a SQL connection within {self.acquire_timeout} seconds, all {self.max_size} are in use."
+                        )
+                    self._cond.wait(remaining)
+            for stale_cnxn in stale:
+                _close_quietly(stale_cnxn)
+
+            if cnxn is None:
+                try:
+                    # Imported on first use, so importing Wonkalytics stays cheap
+                    import pyodbc
+
+                    with time_stage("connect"):
+                        return pyodbc.connect(self._connection_string)
+                except Exception:
+                    self._forget()
+                    raise
+
+            if time.monotonic() - last_used < self.health_check_interval or self._is_healthy(cnxn):
+                return cnxn
+            self._discard(cnxn)
+
+    def _is_healthy(self, cnxn) -> bool:
+        try:
+            cnxn.cursor().execute("SELECT 1").fetchone()
+            return True
+        except Exception as e:
+            if not is_pyodbc_error(e):
+                # The connection is not handed out, give its slot back before raising
+                self._discard(cnxn)
+                raise
+            logging.info(f"Wonkalytics dropped an unhealthy pooled SQL connection: {e}")
+            return False
+
+    def _release(self, cnxn):
+        with self._cond:
+            if not self._closed:
+                self._idle.append((cnxn, time.monotonic()))
+                self._cond.notify()
+                return
+            self._size -= 1
+        _close_quietly(cnxn)
+
+    def _discard(self, cnxn):
+        self._forget()
+        _close_quietly(cnxn)
+
+    def _forget(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+
+def _rollback_quietly(cnxn) -> bool:
+    try:
+        cnxn.rollback()
+        return True
+    except Exception as e:
+        if not is_pyodbc_error(e):
+            raise
+        return False
+
+
+def _close_quietly(cnxn):
+    try:
+        cnxn.close()
+    except Exception:
+        pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(
+    server,
+    database,
+    username,
+    password,
+    encrypt: str = "yes",
+    connection_timeout: int = 30,
+    trust_server_certificate: str = "no",
+) -> ConnectionPool:
+    """
+    Returns the process-wide connection pool for the given connection parameters, creating it on first use.
+
+    Returns:
+        ConnectionPool: The shared pool, configured with the settings from configure_pools.
+    """
+    key = (server, database, username, password, encrypt, connection_timeout, trust_server_certificate)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(
+                    build_connection_string(*key), **POOL_SETTINGS
+                )
+                _pools[key] = pool
+    return pool
+
+
+def configure_pools(**settings):
+    """
+    Change the settings used for new connection pools and apply them to existing ones.
+
+    Args:
+        **settings: Any of POOL_SETTINGS, e.g. 'max_size', 'acquire_timeout' or 'transient_retries'.
+    """
+    unknown = set(settings) - set(POOL_SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown connection pool settings: {', '.join(sorted(unknown))}")
+    POOL_SETTINGS.update(settings)
+    with _pools_lock:
+        for pool in _pools.values():
+            for name, value in settings.items():
+                setattr(pool, name, value)
+
+
+def close_all_pools():
+    """ Close every pooled connection, e.g. on shutdown or after forking. """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+atexit.register(close_all_pools)
@@ -0,0 +1,344 @@
+import logging
+import threading
+from datetime import datetime
+from .authinfo import extract_auth_info_pl_tags
+from .config import get_config
+
+# Prefixes removed from the flattened keys, in this order. A key stripped by a later prefix wins
+# over a key with the same name that was stripped by an earlier one, or not stripped at all.
+_PREFIXES = ("kwargs_", "request_", "metadata_")
+
+
+_TRUNCATION_MARKER = "\n\n[... {} characters truncated ...]\n\n"
+
+# Legacy large text types, their length is reported as their capacity (2147483647 or 1073741823) instead of -1
+_LARGE_TEXT_TYPES = frozenset({"text", "ntext"})
+
+# Flattened names are memoized up to this many per plan, so events with arbitrary keys cannot grow a plan forever
+_MAX_MEMO_SIZE = 4096
+
+
+class AnalyticsRow:
+    """ A projected analytics row: the column names, sorted, and their values in the same order. """
+
+    __slots__ = ("columns", "values")
+
+    def __init__(self, columns: tuple, values: list):
+        self.columns = columns
+        self.values = values
+
+    def __len__(self):
+        return len(self.columns)
+
+    def as_dict(self) -> dict:
+        return dict(zip(self.columns, self.values))
+
+    def __repr__(self):
+        return f"AnalyticsRow({self.as_dict()!r})"
+
+
+class ProjectionPlan:
+    """
+    Projects analytics events onto the columns of one table.
+
+    An event is a nested dict. Its leaves are named by joining their path with '_' (like flattening
+    the dict), after which the 'kwargs_', 'request_' and 'metadata_' prefixes are removed. The
+    resulting name of every path is resolved once and memoized, so events are projected straight
+    into a row without building the flattened dict. Subtrees that cannot contain a column are
+    skipped, and keys that are not a column are only warned about the first time they are seen.
+
+    On top of that the ChatGPT messages are logged as 'system_msg' and 'messages', the response
+    message as 'response', the auth info as 'tenant_id', 'username' and 'email', and a 'timestamp'
+    is added unless the event already has one.
+
+    Text longer than its column is truncated, keeping its head and tail around a truncation marker.
+    (MAX), text and ntext columns are limited to 'max_text_length' characters.
+    """
+
+    def __init__(self, columns, max_text_length: int = None):
+        """
+        Args:
+            columns (dict or Iterable[str]): The columns of the table, either names mapped to their
+                ColumnInfo or just the names (no length limits).
+            max_text_length (int, optional): Maximum number of characters for (MAX), text and ntext columns, 0 for
+                no limit. Defaults to WONKALYTICS_MAX_TEXT_LENGTH (see config.Config.max_text_length).
+        """
+        if max_text_length is None:
+            max_text_length = get_config().max_text_length
+        self.column_names = frozenset(columns)
+        self.limits = {}
+        if isinstance(columns, dict):
+            for name, info in columns.items():
+                if info.max_length is None:
+                    continue
+                if info.max_length == -1 or info.data_type in _LARGE_TEXT_TYPES:
+                    # These report -1 or their 2 GB capacity, so max_text_length is the limit that matters
+                    limits = [limit for limit in (info.max_length, max_text_length) if limit > 0]
+                    if limits:
+                        self.limits[name] = min(limits)
+                elif info.max_length > 0:
+                    self.limits[name] = info.max_length
+        self._leaves = {}
+        self._branches = {}
+        self._warned = set()
+        self._lock = threading.Lock()
+
+    def project(self, item: dict) -> AnalyticsRow:
+        """
+        Project an analytics event onto the table's columns.
+
+        Args:
+            item (dict): The event, e.g. {'kwargs': {...}, 'request_response': {...}, 'request': {...}, ...}.
+
+        Returns:
+            AnalyticsRow: The values of the table's columns found in the event.
+
+        Raises:
+            ValueError: If none of the event's keys are a column of the table.
+        """
+        values = {}
+        ranks = {}
+        found = {}
+        self._collect(item, "", values, ranks, found)
+
+        # The auth info, messages and response are set after the event's own top level keys,
+        # prefixed keys still take precedence over them
+        request = item.get("request")
+        auth_info = request.get("auth_info") if isinstance(request, dict) else None
+        tenantid, user_name, user_mail = extract_auth_info_pl_tags(auth_info)
+        self._set(values, ranks, "tenant_id", tenantid)
+        self._set(values, ranks, "username", user_name)
+        self._set(values, ranks, "email", user_mail)
+
+        messages = found.get("kwargs_messages") or []
+        if len(messages) == 0:
+            logging.warning(
+                "The item that you want to log with Wonkalytics has no ChatGPT messages. If this is intentional you can ignore this warning."
+            )
+        for key, val in _map_messages_to_keyvals(messages, self.limits).items():
+            self._set(values, ranks, key, val)
+
+        choices = found.get("request_response_choices")
+        if choices:
+            choice = choices[0]
+            if "content" in choice.keys():
+                self._set(values, ranks, "response", choice["content"])
+            if "message" in choice.keys():
+                self._set(values, ranks, "response", choice["message"]["content"])
+
+        # Timestamp the row, unless it was already stamped when the event was queued
+        if "timestamp" in self.column_names and not isinstance(values.get("timestamp"), datetime):
+            values["timestamp"] = datetime.now()
+
+        if not values:
+            raise ValueError("Filtered dictionary is empty. None of the keys are allowed.")
+
+        limits = self.limits
+        if limits:
+            for column, value in values.items():
+                limit = limits.get(column)
+                if limit is not None and isinstance(value, str) and len(value) > limit:
+                    values[column] = truncate_text(value, limit)
+
+        columns = tuple(sorted(values))
+        return AnalyticsRow(columns, [values[column] for column in columns])
+
+    def _collect(self, node, parent, values, ranks, found):
+        for key, value in node.items():
+            name = f"{parent}_{key}" if parent else key
+            if isinstance(value, dict):
+                descend = self._branches.get(name)
+                if descend is None:
+                    descend = self._resolve_branch(name)
+                if descend:
+                    self._collect(value, name, values, ranks, found)
+                continue
+            if name == "kwargs_messages":
+                # Logged as 'system_msg' and 'messages' instead
+                found[name] = value
+                continue
+            if name == "request_response_choices":
+                found[name] = value
+            leaf = self._leaves.get(name, False)
+            if leaf is False:
+                leaf = self._resolve_leaf(name)
+            if leaf is not None:
+                column, rank = leaf
+                if ranks.get(column, -1) <= rank:
+                    values[column] = value
+                    ranks[column] = rank
+
+    def _set(self, values, ranks, column, value):
+        if column not in self.column_names:
+            self._warn_once(column)
+        elif ranks.get(column, 0) == 0:
+            values[column] = value
+            ranks[column] = 0
+
+    def _resolve_leaf(self, name):
+        column, rank = _strip_prefixes(name)
+        leaf = (column, rank) if column in self.column_names else None
+        if leaf is None:
+            self._warn_once(column)
+        if len(self._leaves) < _MAX_MEMO_SIZE:
+            self._leaves[name] = leaf
+        return leaf
+
+    def _resolve_branch(self, name):
+        # Every leaf below this dict is named '<name>_...', so it can only be a column when a column
+        # starts with the stripped '<name>_'. Prefixes end with the only '_' in them, so stripping
+        # the start of a name gives the same result as stripping the whole name.
+        start, _ = _strip_prefixes(f"{name}_")
+        descend = (
+            not start
+            or name in ("kwargs", "request_response")
+            or any(column.startswith(start) for column in self.column_names)
+        )
+        if not descend:
+            self._warn_once(f"{start}*")
+        if len(self._branches) < _MAX_MEMO_SIZE:
+            self._branches[name] = descend
+        return descend
+
+    def _warn_once(self, key):
+        with self._lock:
+            if key in self._warned or len(self._warned) >= _MAX_MEMO_SIZE:
+                return
+            self._warned.add(key)
+        logging.warning(f"Key '{key}' is not allowed in SQL table and will be ignored.")
+
+
+def _strip_prefixes(name):
+    rank = 0
+    for i, prefix in enumerate(_PREFIXES, 1):
+        if name.startswith(prefix):
+            name = name[len(prefix):]
+            rank = i
+    return name, rank
+
+
+def _map_messages_to_keyvals(messages: list[dict], limits: dict = None) -> dict:
+    """
+    Converts a list of ChatGPT message dictionaries into a format suitable for analytics.
+    This function segregates 'system' messages and compiles other messages into a single string.
+
+    Each message in the list is examined for its 'role'. Messages with the 'system' role are
+    stored under the 'system_msg' key. Other messages are concatenated into a single string,
+    separated by their roles and line breaks, and stored under the 'messages' key. This allows
+    for easy distinction between system-generated messages and user/assistant interactions in the analytics.
+
+    Args:
+        messages (list[dict]): A list of message dictionaries, each containing 'role' and 'content' keys.
+        limits (dict, optional): Maximum number of characters of the 'system_msg' and 'messages' values,
+            longer values keep their head and tail around a truncation marker.
+
+    Returns:
+        dict: A dictionary with two keys, 'system_msg' and 'messages', containing the processed messages.
+              'system_msg' contains the content of the last 'system' role message. 'messages' contains
+              a concatenated string of all other messages.
+    """
+    limits = limits or {}
+    analytics_key_vals = {}
+    parts = []
+
+    for msg in messages:
+        content = msg["content"]
+        if content is None:
+            # E.g. an assistant message with only tool calls
+            content = ""
+        elif not isinstance(content, str):
+            content = str(content)
+        if msg["role"] == "system":
+            analytics_key_vals["system_msg"] = content
+        # There might be situations where 'user' and 'assistent' messages are pre-given (before the response) to give examples to the model. These should be separately logged from the "actual" user and assistent messages.
+        else:
+            parts.extend((msg["role"], ":\n", content, "\n\n"))
+
+    if "system_msg" in analytics_key_vals:
+        analytics_key_vals["system_msg"] = truncate_text(analytics_key_vals["system_msg"], limits.get("system_msg"))
+    analytics_key_vals["messages"] = _join_truncated(parts, limits.get("messages"))
+
+    return analytics_key_vals
+
+
+def truncate_text(text: str, limit: int = None) -> str:
+    """
+    Limit a text to 'limit' characters, keeping its head and tail around a truncation marker.
+
+    Args:
+        text (str): The text to truncate.
+        limit (int, optional): Maximum number of characters, None for no limit.
+
+    Returns:
+        str: The text itself when it fits, otherwise the truncated text of exactly 'limit' characters.
+    """
+    if limit is None or len(text) <= limit:
+        return text
+    return _join_truncated([text], limit)
+
+
+def _join_truncated(parts: list, limit: int = None) -> str:
+    """ Join the parts, truncating the result like truncate_text without joining the parts that are dropped. """
+    total = sum(map(len, parts))
+    if limit is None or total <= limit:
+        return "".join(parts)
+
+    # The marker's length depends on the number of truncated characters
+    keep = limit
+    for _ in range(3):
+        marker = _TRUNCATION_MARKER.format(total - keep)
+        keep = limit - len(marker)
+    if keep <= 0:
+        return "".join(parts)[:limit]
+
+    tail_size = keep // 2
+    head = _take_head(parts, keep - tail_size)
+    tail = _take_tail(parts, tail_size) if tail_size else ""
+    return f"{head}{marker}{tail}"
+
+
+def _take_head(parts, size):
+    taken = []
+    for part in parts:
+        if len(part) >= size:
+            taken.append(part[:size])
+            break
+        taken.append(part)
+        size -= len(part)
+    return "".join(taken)
+
+
+def _take_tail(parts, size):
+    taken = []
+    for part in reversed(parts):
+        if len(part) >= size:
+            taken.append(part[len(part) - size:])
+            break
+        taken.append(part)
+        size -= len(part)
+    return "".join(reversed(taken))
+
+
+_plans = {}
+_plans_lock = threading.Lock()
+
+
+def get_projection_plan(schema) -> ProjectionPlan:
+    """
+    Returns the projection plan of a table schema, compiling it on first use.
+
+    Plans are shared by schemas with the same columns (and text length limit), so reloading an unchanged
+    schema keeps the memoized plan.
+
+    Args:
+        schema (TableSchema): The schema of the analytics table.
+    """
+    max_text_length = get_config().max_text_length
+    key = (schema.table_name, frozenset(schema.columns.values()), max_text_length)
+    plan = _plans.get(key)
+    if plan is None:
+        with _plans_lock:
+            plan = _plans.get(key)
+            if plan is None:
+                plan = _plans[key] = ProjectionPlan(schema.columns, max_text_length)
+    return plan
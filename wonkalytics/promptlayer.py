@@ -0,0 +1,446 @@
+import asyncio
+import atexit
+import gzip
+import logging
+import sys
+import threading
+import time
+import weakref
+from .breaker import CircuitOpenError, get_breaker
+from .config import get_config, on_configure
+from .serialization import EncodedEvent, dumps
+from .spool import spool_failed_event
+
+
+class PromptLayerClient:
+    """
+    Sends track-request events to PromptLayer over a shared keep-alive session.
+
+    Every request has a connect and a read timeout, so a slow PromptLayer can no longer hang the
+    calling thread. Bodies larger than 'compress_min_bytes' are gzip compressed when 'compress' is enabled.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 10.0,
+        compress: bool = False,
+        compress_min_bytes: int = 1024,
+        pool_maxsize: int = 10,
+    ):
+        """
+        Args:
+            base_url (str): The PromptLayer API url, e.g. 'https://api.promptlayer.com'.
+            connect_timeout (float): Seconds to wait for the TCP/TLS connection.
+            read_timeout (float): Seconds to wait for the response.
+            compress (bool): Gzip compress request bodies (sent with 'Content-Encoding: gzip').
+            compress_min_bytes (int): Bodies smaller than this are sent uncompressed.
+            pool_maxsize (int): Maximum number of kept-alive connections.
+        """
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.compress = compress
+        self.compress_min_bytes = compress_min_bytes
+        # Imported on first use, so importing Wonkalytics stays cheap
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def track_request(self, event: dict) -> "requests.Response":
+        """
+        Send a single event to the '/track-request' endpoint.
+
+        Args:
+            event (dict or EncodedEvent): The JSON serializable event, an EncodedEvent is sent with its existing encoding.
+
+        Returns:
+            requests.Response: The response of PromptLayer.
+
+        Raises:
+            requests.RequestException: On connection errors, timeouts and non 2xx responses.
+            breaker.CircuitOpenError: When the 'promptlayer' circuit breaker is open.
+        """
+        breaker = get_breaker("promptlayer")
+        if breaker is not None:
+            return breaker.call(self._post, event)
+        return self._post(event)
+
+    def _post(self, event):
+        body, headers = _encode_body(event, self.compress, self.compress_min_bytes)
+        response = self._session.post(
+            f"{self.base_url}/track-request",
+            data=body,
+            headers=headers,
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response
+
+    def close(self):
+        """ Close the kept-alive connections. """
+        self._session.close()
+
+
+class AsyncPromptLayerClient:
+    """
+    The asyncio counterpart of PromptLayerClient, using a kept-alive httpx.AsyncClient.
+
+    An httpx.AsyncClient is bound to the event loop it is used on, use get_async_promptlayer_client
+    to get the client of the running loop.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        connect_timeout: float = 3.05,
+        read_timeout: float = 10.0,
+        compress: bool = False,
+        compress_min_bytes: int = 1024,
+        pool_maxsize: int = 10,
+    ):
+        """ Takes the same arguments as PromptLayerClient. """
+        self.base_url = base_url.rstrip("/")
+        self.compress = compress
+        self.compress_min_bytes = compress_min_bytes
+        import httpx
+
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize),
+        )
+
+    async def track_request(self, event: dict) -> "httpx.Response":
+        """
+        Send a single event to the '/track-request' endpoint.
+
+        Raises:
+            httpx.HTTPError: On connection errors, timeouts and non 2xx responses.
+            breaker.CircuitOpenError: When the 'promptlayer' circuit breaker is open.
+        """
+        breaker = get_breaker("promptlayer")
+        if breaker is not None:
+            return await breaker.acall(self._post, event)
+        return await self._post(event)
+
+    async def _post(self, event):
+        body, headers = _encode_body(event, self.compress, self.compress_min_bytes)
+        response = await self._client.post(
+            f"{self.base_url}/track-request", content=body, headers=headers
+        )
+        response.raise_for_status()
+        return response
+
+    async def close(self):
+        """ Close the kept-alive connections. """
+        await self._client.aclose()
+
+
+def _encode_body(event, compress: bool, compress_min_bytes: int):
+    body = event.body if isinstance(event, EncodedEvent) else dumps(event)
+    headers = {"Content-Type": "application/json"}
+    if compress and len(body) >= compress_min_bytes:
+        body = gzip.compress(body, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+    return body, headers
+
+
+class PromptLayerBatcher:
+    """
+    Buffers track-request events and sends them together from a background thread.
+
+    PromptLayer's track-request endpoint takes one event per request, so a flush sends the buffered
+    events back to back over the client's kept-alive connection instead of from every request thread.
+    A flush is triggered when 'batch_size' events are buffered or the oldest event waited 'max_latency' seconds.
+
+    Events that fail with a retryable error, or are rejected by the circuit breaker, are spooled when
+    spooling is enabled (see spool.enable_spool).
+    """
+
+    def __init__(self, client: PromptLayerClient, batch_size: int = 50, max_latency: float = 2.0, max_buffer: int = 10000):
+        """
+        Args:
+            client (PromptLayerClient): The client used to send the events.
+            batch_size (int): Number of buffered events that triggers a flush.
+            max_latency (float): Maximum seconds an event is buffered.
+            max_buffer (int): Maximum number of buffered events, further events are refused by add().
+        """
+        self.client = client
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.max_buffer = max_buffer
+        self.sent = 0
+        self.failed = 0
+        self.spooled = 0
+        self._events = []
+        self._first_added = None
+        self._sending = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="wonkalytics-promptlayer-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def add(self, event: dict) -> bool:
+        """
+        Buffer an event to be sent with the next flush.
+
+        Returns:
+            bool: True if the event was buffered, False if the buffer is full or the batcher is closed.
+        """
+        with self._cond:
+            if self._closed or len(self._events) >= self.max_buffer:
+                return False
+            if not self._events:
+                self._first_added = time.monotonic()
+            self._events.append(event)
+            if len(self._events) >= self.batch_size:
+                self._cond.notify()
+        return True
+
+    def flush(self, timeout=None) -> bool:
+        """
+        Send all buffered events now.
+
+        Returns:
+            bool: True if the buffer was emptied before the timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._first_added = float("-inf")
+            self._cond.notify()
+            while self._events or self._sending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=None) -> bool:
+        """
+        Stop accepting events, send the buffered ones and stop the background thread.
+
+        Events added after close() starts are refused (add returns False), so they are sent directly.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        drained = self.flush(timeout)
+        self._thread.join(timeout)
+        return drained
+
+    def _is_due(self):
+        return self._events and (
+            len(self._events) >= self.batch_size
+            or time.monotonic() - self._first_added >= self.max_latency
+        )
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._is_due():
+                    if self._closed:
+                        # The buffered events are sent before the thread stops, due or not
+                        if not self._events:
+                            return
+                        break
+                    self._cond.wait(self.max_latency / 2)
+                events, self._events = self._events, []
+                self._sending = True
+            try:
+                for event in events:
+                    try:
+                        self.client.track_request(event)
+                        self.sent += 1
+                    except Exception as e:
+                        self._failed(event, e)
+            finally:
+                with self._cond:
+                    self._sending = False
+                    self._cond.notify_all()
+
+    def _failed(self, event, error):
+        # Like analytics._send_analytics_event, undelivered events are spooled and replayed later
+        if spool_failed_event("promptlayer", event, error):
+            self.spooled += 1
+            return
+        self.failed += 1
+        # The breaker reported that it opened, not every rejected event
+        if not isinstance(error, CircuitOpenError):
+            print(
+                f"WARNING: While logging your request to PromptLayer Wonkalytics had the following error: {error}",
+                file=sys.stderr,
+            )
+
+
+_client = None
+# Whether _client was built from the settings, rather than by configure_promptlayer
+_client_from_config = False
+_async_clients = weakref.WeakKeyDictionary()
+_batcher = None
+_lock = threading.Lock()
+_atexit_registered = False
+_CLIENT_SETTINGS = ("promptlayer_url", "promptlayer_connect_timeout", "promptlayer_read_timeout", "promptlayer_gzip")
+
+
+def get_promptlayer_client() -> PromptLayerClient:
+    """
+    Returns the shared PromptLayer client, creating it on first use.
+
+    The client is configured from the URL_API_PROMPTLAYER, WONKALYTICS_PL_CONNECT_TIMEOUT,
+    WONKALYTICS_PL_READ_TIMEOUT and WONKALYTICS_PL_GZIP environment variables unless
+    configure_promptlayer was called.
+    """
+    global _client, _client_from_config
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = _client_for(get_config())
+                _client_from_config = True
+    return _client
+
+
+def _client_for(config):
+    return PromptLayerClient(
+        config.promptlayer_url,
+        connect_timeout=config.promptlayer_connect_timeout,
+        read_timeout=config.promptlayer_read_timeout,
+        compress=config.promptlayer_gzip,
+    )
+
+
+def _rebuild_client(old_config, new_config):
+    """ Replace the client built from the settings when configure changed them, see config.on_configure. """
+    global _client
+    if old_config is not None and all(getattr(old_config, name) == getattr(new_config, name) for name in _CLIENT_SETTINGS):
+        return
+    with _lock:
+        if _client is None or not _client_from_config:
+            return
+        old_client, _client = _client, _client_for(new_config)
+        if _batcher is not None:
+            _batcher.client = _client
+    _async_clients.clear()
+    old_client.close()
+
+
+on_configure(_rebuild_client)
+
+
+def get_async_promptlayer_client() -> AsyncPromptLayerClient:
+    """ Returns the AsyncPromptLayerClient of the running event loop, configured like the shared client. """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        sync_client = get_promptlayer_client()
+        client = _async_clients[loop] = AsyncPromptLayerClient(
+            sync_client.base_url,
+            connect_timeout=sync_client.timeout[0],
+            read_timeout=sync_client.timeout[1],
+            compress=sync_client.compress,
+            compress_min_bytes=sync_client.compress_min_bytes,
+        )
+    return client
+
+
+async def close_async_promptlayer_client():
+    """ Close the AsyncPromptLayerClient of the running event loop, e.g. on application shutdown. """
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+
+def configure_promptlayer(base_url=None, **settings) -> PromptLayerClient:
+    """
+    Replace the shared PromptLayer client.
+
+    Args:
+        base_url (str, optional): The PromptLayer API url, defaults to the URL_API_PROMPTLAYER environment variable.
+        **settings: Any other PromptLayerClient argument, e.g. 'read_timeout' or 'compress'.
+
+    Returns:
+        PromptLayerClient: The new client.
+    """
+    global _client, _client_from_config
+    client = PromptLayerClient(
+        base_url or get_config().promptlayer_url,
+        **settings,
+    )
+    with _lock:
+        old_client, _client = _client, client
+        # Kept when the settings change, configure_promptlayer was asked for explicitly
+        _client_from_config = False
+        if _batcher is not None:
+            _batcher.client = client
+    # Async clients are recreated with the new settings on next use
+    _async_clients.clear()
+    if old_client is not None:
+        old_client.close()
+    return client
+
+
+def enable_promptlayer_batching(batch_size: int = 50, max_latency: float = 2.0, drain_timeout: float = 10.0):
+    """
+    Buffer PromptLayer events and send them in batches from a background thread.
+
+    Returns:
+        PromptLayerBatcher: The active batcher.
+    """
+    global _batcher, _atexit_registered
+    client = get_promptlayer_client()
+    with _lock:
+        old_batcher, _batcher = _batcher, PromptLayerBatcher(client, batch_size, max_latency)
+        if not _atexit_registered:
+            atexit.register(lambda: disable_promptlayer_batching(drain_timeout))
+            _atexit_registered = True
+    if old_batcher is not None:
+        old_batcher.close(drain_timeout)
+    return _batcher
+
+
+def disable_promptlayer_batching(timeout=None) -> bool:
+    """
+    Send the buffered events and go back to sending every event right away.
+
+    Returns:
+        bool: True if all buffered events were handled before stopping.
+    """
+    global _batcher
+    with _lock:
+        batcher, _batcher = _batcher, None
+    if batcher is None:
+        return True
+    return batcher.close(timeout)
+
+
+def track_request(event: dict):
+    """
+    Send an event to PromptLayer, through the batcher when batching is enabled.
+
+    Raises:
+        requests.RequestException: When the event is sent right away and PromptLayer cannot be reached or rejects it.
+    """
+    batcher = _batcher
+    if batcher is not None and batcher.add(event):
+        return
+    if batcher is not None:
+        logging.warning("Wonkalytics PromptLayer batch buffer is full or closed, sending the event directly.")
+    get_promptlayer_client().track_request(event)
+
+
+async def atrack_request(event: dict):
+    """
+    Send an event to PromptLayer without blocking the event loop, through the batcher when batching is enabled.
+
+    Raises:
+        httpx.HTTPError: When PromptLayer cannot be reached or rejects the event.
+    """
+    batcher = _batcher
+    if batcher is not None and batcher.add(event):
+        return
+    await get_async_promptlayer_client().track_request(event)
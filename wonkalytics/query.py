@@ -0,0 +1,126 @@
+from datetime import datetime
+from .rollup import Database, as_datetime, default_database, rollup_table, table_columns
+
+# Metrics computed from the rollup columns, with the columns they need
+METRICS = {
+    "calls": ("SUM([calls])", ("calls",)),
+    "scored": ("SUM([score_count])", ("score_count",)),
+    "avg_score": ("SUM([score_sum]) / NULLIF(SUM([score_count]), 0)", ("score_sum", "score_count")),
+    "avg_latency": ("SUM([latency_sum]) / NULLIF(SUM([latency_count]), 0)", ("latency_sum", "latency_count")),
+    "max_latency": ("MAX([latency_max])", ("latency_max",)),
+    "avg_time_to_first_token": ("SUM([ttft_sum]) / NULLIF(SUM([ttft_count]), 0)", ("ttft_sum", "ttft_count")),
+    "prompt_tokens": ("SUM([prompt_tokens])", ("prompt_tokens",)),
+    "completion_tokens": ("SUM([completion_tokens])", ("completion_tokens",)),
+    "total_tokens": ("SUM([total_tokens])", ("total_tokens",)),
+}
+
+
+def aggregate(
+    metrics=("calls",),
+    group_by=(),
+    granularity: str = "day",
+    start: datetime = None,
+    end: datetime = None,
+    filters: dict = None,
+    by_bucket: bool = True,
+    target=None,
+    table_name: str = None,
+) -> list:
+    """
+    Query the rollups (see rollup.RollupMaintainer) instead of the raw analytics rows.
+
+    Example:
+    ```
+    # Calls and average score per tenant per day, for the last week
+    aggregate(["calls", "avg_score"], group_by=["tenant_id"], start=datetime.now() - timedelta(days=7))
+    ```
+
+    Args:
+        metrics (Iterable[str]): Names from METRICS, e.g. 'calls', 'avg_score', 'avg_latency' or 'total_tokens'.
+        group_by (Iterable[str]): Dimensions of the rollup, e.g. 'tenant_id' and 'model'.
+        granularity (str): 'hour' or 'day'.
+        start (datetime, optional): First bucket to include.
+        end (datetime, optional): Buckets before this are included.
+        filters (dict, optional): Dimension values the rows must have, e.g. {'model': 'gpt-4'}.
+        by_bucket (bool): Return a row per bucket, otherwise the totals over the whole range.
+        target (optional): A pool.ConnectionPool or a sqlite3.Connection, defaults to the configured Azure SQL database.
+        table_name (str, optional): The analytics table, defaults to AZURE_TABLE_NAME.
+
+    Returns:
+        list: A dict per row, with 'bucket' (when by_bucket), the group_by dimensions and the metrics.
+
+    Raises:
+        ValueError: For unknown metrics, or dimensions the rollup does not have.
+    """
+    if target is None:
+        db, default_table = default_database()
+        table_name = table_name or default_table
+    else:
+        db = target if isinstance(target, Database) else Database(target)
+    table = rollup_table(table_name, granularity)
+    metrics, group_by, filters = list(metrics), list(group_by), dict(filters or {})
+
+    unknown = [metric for metric in metrics if metric not in METRICS]
+    if unknown:
+        raise ValueError(f"Unknown metrics: {', '.join(unknown)}. Choose from {', '.join(METRICS)}.")
+
+    def query(cnxn):
+        columns = set(table_columns(cnxn, table))
+        # Column names are checked against the table, so they are safe to put in the query
+        missing = [name for name in group_by + list(filters) if name not in columns or name == "bucket"]
+        missing += [c for metric in metrics for c in METRICS[metric][1] if c not in columns]
+        if missing:
+            raise ValueError(f"The rollup {table} has no column(s) {', '.join(sorted(set(missing)))}.")
+
+        keys = (["bucket"] if by_bucket else []) + group_by
+        selects = [f"[{key}]" for key in keys] + [f"{METRICS[metric][0]} AS [{metric}]" for metric in metrics]
+        conditions, params = [], []
+        if start is not None:
+            conditions.append("[bucket] >= ?")
+            params.append(db.param(start))
+        if end is not None:
+            conditions.append("[bucket] < ?")
+            params.append(db.param(end))
+        for name, value in filters.items():
+            if value is None:
+                conditions.append(f"[{name}] IS NULL")
+            else:
+                conditions.append(f"[{name}] = ?")
+                params.append(value)
+
+        sql = f"SELECT {', '.join(selects)} FROM [{table}]"
+        if conditions:
+            sql += f" WHERE {' AND '.join(conditions)}"
+        if keys:
+            sql += f" GROUP BY {', '.join(f'[{key}]' for key in keys)} ORDER BY {', '.join(f'[{key}]' for key in keys)}"
+        cursor = cnxn.cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    results = []
+    for row in db.run(query):
+        result = dict(zip((["bucket"] if by_bucket else []) + group_by + metrics, row))
+        if by_bucket:
+            result["bucket"] = as_datetime(result["bucket"])
+        results.append(result)
+    return results
+
+
+def calls(group_by=("tenant_id",), granularity: str = "day", **kwargs) -> list:
+    """ Number of calls per bucket and group, see aggregate for the arguments. """
+    return aggregate(["calls"], group_by, granularity, **kwargs)
+
+
+def average_score(group_by=("tenant_id",), granularity: str = "day", **kwargs) -> list:
+    """ Average score and number of scored calls per bucket and group, see aggregate for the arguments. """
+    return aggregate(["avg_score", "scored"], group_by, granularity, **kwargs)
+
+
+def latency(group_by=("model",), granularity: str = "day", **kwargs) -> list:
+    """ Average and maximum latency (end_time - start_time) in seconds per bucket and group, see aggregate. """
+    return aggregate(["avg_latency", "max_latency"], group_by, granularity, **kwargs)
+
+
+def token_volume(group_by=("tenant_id", "model"), granularity: str = "day", **kwargs) -> list:
+    """ Prompt, completion and total tokens per bucket and group, see aggregate for the arguments. """
+    return aggregate(["prompt_tokens", "completion_tokens", "total_tokens"], group_by, granularity, **kwargs)
@@ -0,0 +1,548 @@
+import asyncio
+import inspect
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import NamedTuple, Optional
+from .authinfo import extract_auth_info_pl_tags
+from .config import LazySingleton, get_config
+from .metrics import increment, observe, set_gauge
+
+# Headers OpenAI returns with every response (and 429 error), see https://platform.openai.com/docs/guides/rate-limits
+_LIMIT_HEADERS = {"requests": "x-ratelimit-limit-requests", "tokens": "x-ratelimit-limit-tokens"}
+_REMAINING_HEADERS = {"requests": "x-ratelimit-remaining-requests", "tokens": "x-ratelimit-remaining-tokens"}
+_RESET_HEADERS = {"requests": "x-ratelimit-reset-requests", "tokens": "x-ratelimit-reset-tokens"}
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+# How often an async call that is not first in line checks whether it is, a call that is waits for the quota it needs
+_ASYNC_POLL_INTERVAL = 0.01
+# How long a model is paused after a 429 that does not say when to retry
+_DEFAULT_RETRY_AFTER = 1.0
+
+
+class ModelLimit(NamedTuple):
+    """ The quota of a model, None when it is not limited (or is learned from the response headers). """
+
+    requests_per_minute: Optional[float] = None
+    tokens_per_minute: Optional[float] = None
+
+
+class RateLimitTimeout(TimeoutError):
+    """ Raised when a call waited longer than the limiter's 'max_wait' for its turn. """
+
+
+def parse_duration(value) -> Optional[float]:
+    """ Parse a reset header like '1s', '6m0s' or '20ms' into seconds, None when it cannot be parsed. """
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def estimate_tokens(kwargs: dict) -> int:
+    """
+    Estimate the tokens a call counts against the tokens-per-minute quota: about 4 characters per
+    prompt token, plus the completion tokens it may use (max_tokens for every choice).
+
+    The estimate is corrected with the reported usage once the response arrives.
+    """
+    characters = 0
+    messages = kwargs.get("messages") or ()
+    for message in messages:
+        content = message.get("content") if isinstance(message, dict) else None
+        if isinstance(content, str):
+            characters += len(content)
+        elif isinstance(content, list):
+            characters += sum(len(part.get("text") or "") for part in content if isinstance(part, dict))
+    for name in ("prompt", "input"):
+        value = kwargs.get(name)
+        if isinstance(value, str):
+            characters += len(value)
+        elif isinstance(value, list):
+            characters += sum(len(item) for item in value if isinstance(item, str))
+    prompt_tokens = characters // 4 + 4 * len(messages)
+    max_tokens = kwargs.get("max_tokens") or kwargs.get("max_completion_tokens") or 0
+    return prompt_tokens + max_tokens * (kwargs.get("n") or 1)
+
+
+class _QuotaBucket:
+    """
+    A token bucket that refills at 'headroom' times the per-minute limit, evenly over the minute.
+
+    It holds at most 'burst_seconds' worth of quota, so calls are paced instead of sent in bursts that
+    use up the minute's quota and then wait for it to reset. A take larger than that is allowed when
+    the bucket is full and leaves it in debt.
+    """
+
+    def __init__(self, per_minute: float, headroom: float, burst_seconds: float):
+        self.headroom = headroom
+        self.burst_seconds = burst_seconds
+        self.level = None
+        self._updated = time.monotonic()
+        self.set_limit(per_minute)
+
+    def set_limit(self, per_minute: float):
+        self.limit = per_minute
+        self.rate = per_minute * self.headroom / 60.0
+        self.capacity = max(self.rate * self.burst_seconds, 1.0)
+        if self.level is None or self.level > self.capacity:
+            self.level = self.capacity
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """ Returns the seconds until 'amount' (at most the capacity) is available. """
+        self._refill(now)
+        needed = min(amount, self.capacity)
+        if self.level >= needed:
+            return 0.0
+        return (needed - self.level) / self.rate
+
+    def take(self, amount: float, now: float):
+        """ Take 'amount', a negative amount gives back what was taken too much. """
+        self._refill(now)
+        self.level = min(self.capacity, self.level - amount)
+
+    def clamp(self, remaining: float, now: float):
+        """ The server reported only 'remaining' of the quota left, e.g. because other processes share it. """
+        self._refill(now)
+        self.level = min(self.level, remaining)
+
+
+class _Ticket:
+    __slots__ = ("tenant", "tokens", "enqueued")
+
+    def __init__(self, tenant, tokens):
+        self.tenant = tenant
+        self.tokens = tokens
+        self.enqueued = time.monotonic()
+
+
+class _ModelQueue:
+    """ The quota of one model and the calls waiting for it, queued per tenant and served round-robin. """
+
+    def __init__(self, model: str, limit: ModelLimit, headroom: float, burst_seconds: float):
+        self.model = model
+        self.headroom = headroom
+        self.burst_seconds = burst_seconds
+        self.requests = None
+        self.tokens = None
+        self.set_limits(limit.requests_per_minute, limit.tokens_per_minute)
+        self.paused_until = 0.0
+        self.waiting = OrderedDict()
+        self.queued = 0
+        self.cond = threading.Condition()
+
+    def set_limits(self, requests_per_minute=None, tokens_per_minute=None):
+        for name, limit in (("requests", requests_per_minute), ("tokens", tokens_per_minute)):
+            if not limit:
+                continue
+            bucket = getattr(self, name)
+            if bucket is None:
+                setattr(self, name, _QuotaBucket(limit, self.headroom, self.burst_seconds))
+            elif bucket.limit != limit:
+                bucket.set_limit(limit)
+
+    def enqueue(self, ticket: _Ticket):
+        self.waiting.setdefault(ticket.tenant, deque()).append(ticket)
+        self.queued += 1
+
+    def remove(self, ticket: _Ticket):
+        tickets = self.waiting.get(ticket.tenant)
+        if tickets is not None and ticket in tickets:
+            tickets.remove(ticket)
+            self.queued -= 1
+            if not tickets:
+                del self.waiting[ticket.tenant]
+
+    def poll(self, ticket: _Ticket, now: float):
+        """
+        Grant the ticket when it is first in line and the quota allows it.
+
+        Returns:
+            0.0 when the ticket was granted, the seconds until it can be when it is first in line, or
+            None when it has to wait for the calls before it.
+        """
+        tenant, tickets = next(iter(self.waiting.items()))
+        if tickets[0] is not ticket:
+            return None
+        wait = self.paused_until - now
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1, now))
+        if self.tokens is not None and ticket.tokens:
+            wait = max(wait, self.tokens.wait_time(ticket.tokens, now))
+        if wait > 0:
+            return wait
+
+        if self.requests is not None:
+            self.requests.take(1, now)
+        if self.tokens is not None:
+            self.tokens.take(ticket.tokens, now)
+        tickets.popleft()
+        self.queued -= 1
+        if tickets:
+            # The tenant's next call waits for the other tenants' calls
+            self.waiting.move_to_end(tenant)
+        else:
+            del self.waiting[tenant]
+        return 0.0
+
+
+class Reservation(NamedTuple):
+    """ A call that was let through, returned by RateLimiter.acquire. """
+
+    model: str
+    tokens: int
+    waited: float
+
+
+class RateLimiter:
+    """
+    Paces the calls through OpenAIWrapper to stay just under the per-model quotas, instead of
+    sending them until OpenAI answers with 429s.
+
+    Every model has a bucket for requests and one for (estimated) tokens per minute. A call waits
+    until both have room, calls of different tenants take turns so one tenant's burst does not
+    starve the others. The remaining quota in the response headers lowers the buckets when other
+    processes use the same quota, a 429 pauses the model until the quota resets.
+    """
+
+    def __init__(
+        self,
+        limits: dict = None,
+        default_limit: ModelLimit = None,
+        headroom: float = 0.95,
+        burst_seconds: float = 1.0,
+        max_wait: float = None,
+        learn_limits: bool = True,
+    ):
+        """
+        Args:
+            limits (dict, optional): Model names mapped to their ModelLimit.
+            default_limit (ModelLimit, optional): The limit of the models that are not in 'limits'.
+            headroom (float): The share of the quota that is used, so throughput settles just under it.
+            burst_seconds (float): How many seconds of quota can be used at once after a quiet period.
+            max_wait (float, optional): Seconds a call may wait for its turn before RateLimitTimeout is raised.
+            learn_limits (bool): Take the limits of the models from the response headers.
+        """
+        self.limits = dict(limits or {})
+        self.default_limit = default_limit
+        self.headroom = headroom
+        self.burst_seconds = burst_seconds
+        self.max_wait = max_wait
+        self.learn_limits = learn_limits
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def _queue(self, model: str, create: bool = False):
+        queue = self._queues.get(model)
+        if queue is None:
+            limit = self.limits.get(model, self.default_limit)
+            if limit is None and not create:
+                return None
+            with self._lock:
+                queue = self._queues.get(model)
+                if queue is None:
+                    queue = _ModelQueue(model, limit or ModelLimit(), self.headroom, self.burst_seconds)
+                    self._queues[model] = queue
+        return queue
+
+    def acquire(self, model: str, tenant: str = None, tokens: int = 0) -> Reservation:
+        """
+        Wait until a call to 'model' is allowed.
+
+        Args:
+            model (str): The model (or Azure deployment) of the call.
+            tenant (str, optional): Calls of different tenants take turns.
+            tokens (int): The estimated tokens of the call, see estimate_tokens.
+
+        Returns:
+            Reservation: Pass it to observe once the response arrived.
+
+        Raises:
+            RateLimitTimeout: When the call waited longer than 'max_wait'.
+        """
+        queue = self._queue(model)
+        if queue is None:
+            return Reservation(model, tokens, 0.0)
+        ticket = _Ticket(tenant, tokens)
+        with queue.cond:
+            queue.enqueue(ticket)
+            self._report_queued(queue)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = queue.poll(ticket, now)
+                    if wait == 0.0:
+                        break
+                    wait = self._limit_wait(ticket, wait, now)
+                    queue.cond.wait(wait)
+            except BaseException:
+                queue.remove(ticket)
+                raise
+            finally:
+                # The next call in line (or after a removed call) can check whether it is its turn
+                queue.cond.notify_all()
+                self._report_queued(queue)
+        return self._granted(queue, ticket)
+
+    async def aacquire(self, model: str, tenant: str = None, tokens: int = 0) -> Reservation:
+        """ Like acquire, without blocking the event loop while the call waits. """
+        queue = self._queue(model)
+        if queue is None:
+            return Reservation(model, tokens, 0.0)
+        ticket = _Ticket(tenant, tokens)
+        with queue.cond:
+            queue.enqueue(ticket)
+            self._report_queued(queue)
+        try:
+            while True:
+                with queue.cond:
+                    now = time.monotonic()
+                    wait = queue.poll(ticket, now)
+                    if wait == 0.0:
+                        queue.cond.notify_all()
+                        break
+                    wait = self._limit_wait(ticket, _ASYNC_POLL_INTERVAL if wait is None else wait, now)
+                await asyncio.sleep(wait)
+        except BaseException:
+            with queue.cond:
+                queue.remove(ticket)
+                queue.cond.notify_all()
+            raise
+        finally:
+            self._report_queued(queue)
+        return self._granted(queue, ticket)
+
+    def _limit_wait(self, ticket, wait, now):
+        if self.max_wait is None:
+            return wait
+        remaining = ticket.enqueued + self.max_wait - now
+        if remaining <= 0:
+            raise RateLimitTimeout(f"Waited more than {self.max_wait}s for the rate limit")
+        return remaining if wait is None else min(wait, remaining)
+
+    def _charge(self, model: str, tokens: int) -> Reservation:
+        """ Count a call that was sent without waiting for its turn against the quota. """
+        queue = self._queue(model)
+        if queue is None:
+            return Reservation(model, tokens, 0.0)
+        with queue.cond:
+            now = time.monotonic()
+            if queue.requests is not None:
+                queue.requests.take(1, now)
+            if queue.tokens is not None:
+                queue.tokens.take(tokens, now)
+        return Reservation(model, tokens, 0.0)
+
+    def _granted(self, queue, ticket):
+        waited = time.monotonic() - ticket.enqueued
+        observe("wonkalytics_ratelimit_wait_seconds", waited, {"model": queue.model})
+        return Reservation(queue.model, ticket.tokens, waited)
+
+    def _report_queued(self, queue):
+        set_gauge("wonkalytics_ratelimit_queued", queue.queued, {"model": queue.model})
+
+    def observe(self, reservation: Reservation, response):
+        """
+        Update the quota of a model from a response: its rate-limit headers (when the client exposes
+        them) and the tokens it actually used.
+        """
+        headers = response_headers(response)
+        usage = getattr(response, "usage", None) if not isinstance(response, dict) else response.get("usage")
+        total_tokens = usage.get("total_tokens") if isinstance(usage, dict) else getattr(usage, "total_tokens", None)
+        if headers is None and total_tokens is None:
+            return
+        queue = self._queue(reservation.model, create=headers is not None and self.learn_limits)
+        if queue is None:
+            return
+        with queue.cond:
+            now = time.monotonic()
+            if total_tokens is not None and queue.tokens is not None:
+                queue.tokens.take(total_tokens - reservation.tokens, now)
+            if headers is not None:
+                self._observe_headers(queue, headers, now)
+            queue.cond.notify_all()
+
+    def observe_error(self, reservation: Reservation, error: Exception):
+        """ Pause the model after a 429, until the quota resets. """
+        if not is_rate_limit_error(error):
+            return
+        increment("wonkalytics_ratelimit_throttled_total", 1, {"model": reservation.model})
+        headers = response_headers(error) or {}
+        queue = self._queue(reservation.model, create=True)
+        with queue.cond:
+            now = time.monotonic()
+            self._observe_headers(queue, headers, now)
+            retry_after = parse_duration(headers.get("retry-after-ms"))
+            retry_after = retry_after / 1000 if retry_after is not None else parse_duration(headers.get("retry-after"))
+            if retry_after is None:
+                resets = [parse_duration(headers.get(header)) for header in _RESET_HEADERS.values()]
+                retry_after = max([reset for reset in resets if reset is not None], default=_DEFAULT_RETRY_AFTER)
+            queue.paused_until = max(queue.paused_until, now + retry_after)
+            queue.cond.notify_all()
+
+    def _observe_headers(self, queue, headers, now):
+        if self.learn_limits:
+            queue.set_limits(
+                _number(headers.get(_LIMIT_HEADERS["requests"])),
+                _number(headers.get(_LIMIT_HEADERS["tokens"])),
+            )
+        for name, bucket in (("requests", queue.requests), ("tokens", queue.tokens)):
+            remaining = _number(headers.get(_REMAINING_HEADERS[name]))
+            if bucket is None or remaining is None:
+                continue
+            bucket.clamp(remaining, now)
+            if remaining <= 0:
+                reset = parse_duration(headers.get(_RESET_HEADERS[name]))
+                if reset:
+                    queue.paused_until = max(queue.paused_until, now + reset)
+
+    def stats(self) -> dict:
+        """ Returns the limits, the remaining quota and the number of waiting calls per model. """
+        stats = {}
+        for model, queue in list(self._queues.items()):
+            with queue.cond:
+                stats[model] = {
+                    "queued": queue.queued,
+                    "requests_per_minute": None if queue.requests is None else queue.requests.limit,
+                    "tokens_per_minute": None if queue.tokens is None else queue.tokens.limit,
+                    "paused_for": max(queue.paused_until - time.monotonic(), 0.0),
+                }
+        return stats
+
+    def wrap(self, func, kwargs: dict, request=None):
+        """
+        Returns 'func' (that calls the API with 'kwargs') waiting for its turn first, or 'func' itself
+        when the call has no model.
+
+        Whether the call is async is decided by what 'func' returns, so e.g. a sync function that returns
+        a coroutine waits with aacquire. Outside an event loop the call waits before 'func' is called. On
+        an event loop 'func' is called first: an awaitable waits for its turn before it is awaited, a sync
+        call (that already blocked the loop) is counted against the quota without waiting.
+        """
+        model = kwargs.get("model") or kwargs.get("engine") or kwargs.get("deployment_id")
+        if not isinstance(model, str):
+            return func
+        tenant = None
+        if isinstance(request, dict) and request.get("auth_info") is not None:
+            tenant = extract_auth_info_pl_tags(request["auth_info"])[0]
+        tokens = estimate_tokens(kwargs)
+
+        async def observed(reservation, awaitable):
+            if reservation is None:
+                reservation = await self.aacquire(model, tenant, tokens)
+            try:
+                response = await awaitable
+            except Exception as e:
+                self.observe_error(reservation, e)
+                raise
+            self.observe(reservation, response)
+            return response
+
+        def limited():
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                reservation = self.acquire(model, tenant, tokens)
+            else:
+                reservation = None
+            try:
+                response = func()
+            except Exception as e:
+                self.observe_error(reservation or self._charge(model, tokens), e)
+                raise
+            if inspect.isawaitable(response):
+                return observed(reservation, response)
+            if reservation is None:
+                reservation = self._charge(model, tokens)
+            self.observe(reservation, response)
+            return response
+        return limited
+
+
+def _number(value) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def response_headers(obj) -> Optional[dict]:
+    """
+    Returns the HTTP headers of a response or API error with lowercase names, or None when the client does
+    not expose them: errors of openai<1.0 have 'headers', streams and errors of openai>=1.0 a 'response'.
+    """
+    headers = getattr(obj, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(obj, "response", None), "headers", None)
+    if headers is None or not hasattr(headers, "items"):
+        return None
+    return {str(name).lower(): value for name, value in headers.items()}
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """ Check whether an error is OpenAI's 429, for openai<1.0 and >=1.0. """
+    if type(error).__name__ == "RateLimitError":
+        return True
+    return getattr(error, "http_status", None) == 429 or getattr(error, "status_code", None) == 429
+
+
+_limiter = LazySingleton(lambda: get_config().rate_limit, lambda: enable_rate_limiting())
+
+
+def enable_rate_limiting(
+    limits: dict = None,
+    default_limit: ModelLimit = None,
+    headroom: float = 0.95,
+    burst_seconds: float = 1.0,
+    max_wait: float = None,
+    learn_limits: bool = True,
+) -> RateLimiter:
+    """
+    Pace the calls through OpenAIWrapper to stay under the rate limits of OpenAI.
+
+    Example:
+    ```
+    wonkalytics.enable_rate_limiting(
+        limits={"gpt-4": ModelLimit(requests_per_minute=500, tokens_per_minute=30000)},
+        default_limit=ModelLimit(requests_per_minute=3500),
+    )
+    ```
+
+    The limits are per process, give every worker its share of the quota. See RateLimiter for the arguments.
+
+    Returns:
+        RateLimiter: The active limiter.
+    """
+    limiter = RateLimiter(limits, default_limit, headroom, burst_seconds, max_wait, learn_limits)
+    _limiter.set(limiter)
+    return limiter
+
+
+def disable_rate_limiting():
+    """ Send calls as they come again. """
+    _limiter.clear()
+
+
+def get_rate_limiter():
+    """
+    Returns the active rate limiter, or None when calls are not paced.
+
+    Rate limiting can also be enabled by setting the WONKALYTICS_RATE_LIMIT environment variable to 1,
+    the limits are then learned from the response headers, until disable_rate_limiting is called.
+    """
+    return _limiter.get()
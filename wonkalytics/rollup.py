@@ -0,0 +1,327 @@
+import argparse
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import NamedTuple
+from .config import get_config
+
+
+class Measure(NamedTuple):
+    """ An aggregate kept per bucket: how it is computed from raw rows and how hours are combined into days. """
+
+    name: str
+    expression: str
+    # Raw table columns the measure needs, it is left out when the table does not have them
+    columns: tuple = ()
+    combine: str = "SUM"
+
+
+MEASURES = (
+    Measure("calls", "COUNT(*)"),
+    Measure("score_count", "COUNT([score])", ("score",)),
+    Measure("score_sum", "SUM([score])", ("score",)),
+    Measure("latency_count", "COUNT([end_time] - [start_time])", ("start_time", "end_time")),
+    Measure("latency_sum", "SUM([end_time] - [start_time])", ("start_time", "end_time")),
+    Measure("latency_max", "MAX([end_time] - [start_time])", ("start_time", "end_time"), "MAX"),
+    Measure("ttft_count", "COUNT([time_to_first_token])", ("time_to_first_token",)),
+    Measure("ttft_sum", "SUM([time_to_first_token])", ("time_to_first_token",)),
+    Measure("prompt_tokens", "SUM([response_usage_prompt_tokens])", ("response_usage_prompt_tokens",)),
+    Measure("completion_tokens", "SUM([response_usage_completion_tokens])", ("response_usage_completion_tokens",)),
+    Measure("total_tokens", "SUM([response_usage_total_tokens])", ("response_usage_total_tokens",)),
+)
+
+DEFAULT_DIMENSIONS = ("tenant_id", "model")
+STATE_TABLE = "wonkalytics_rollup_state"
+_HOUR = timedelta(hours=1)
+_DAY = timedelta(days=1)
+
+
+def rollup_table(table_name: str, granularity: str) -> str:
+    """ The name of the 'hour' or 'day' rollup table of an analytics table. """
+    if granularity not in ("hour", "day"):
+        raise ValueError(f"Unknown rollup granularity {granularity!r}, expected 'hour' or 'day'.")
+    return f"{table_name}_rollup_{'hourly' if granularity == 'hour' else 'daily'}"
+
+
+def floor_hour(value: datetime) -> datetime:
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def floor_day(value: datetime) -> datetime:
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def as_datetime(value):
+    """ SQLite returns datetimes as ISO strings, SQL Server as datetimes. """
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+def table_columns(cnxn, table_name: str) -> list:
+    """ Returns the column names of a table, from an empty result set so it works on any database. """
+    cursor = cnxn.cursor()
+    cursor.execute(f"SELECT * FROM [{table_name}] WHERE 1 = 0")
+    columns = [description[0] for description in cursor.description]
+    cursor.fetchall()
+    return columns
+
+
+class Database:
+    """ Runs functions with a connection of a ConnectionPool or an sqlite3 connection (the local stand-in for Azure SQL). """
+
+    def __init__(self, target):
+        """
+        Args:
+            target: A pool.ConnectionPool, or a sqlite3.Connection.
+        """
+        self.target = target
+        self.is_sqlite = isinstance(target, sqlite3.Connection)
+        self._lock = threading.Lock()
+
+    def run(self, func):
+        if self.is_sqlite:
+            # A sqlite3 connection is not safe to share between threads without a lock
+            with self._lock:
+                return func(self.target)
+        return self.target.run(func)
+
+    def param(self, value):
+        """ Datetimes are compared as ISO strings in SQLite, which is how they are stored there. """
+        if self.is_sqlite and isinstance(value, datetime):
+            return value.isoformat(" ")
+        return value
+
+    def create_table(self, cnxn, table_name: str, columns_sql: str):
+        if self.is_sqlite:
+            sql = f"CREATE TABLE IF NOT EXISTS [{table_name}] ({columns_sql})"
+        else:
+            sql = f"IF OBJECT_ID(N'{table_name}', N'U') IS NULL CREATE TABLE [{table_name}] ({columns_sql})"
+        cnxn.cursor().execute(sql)
+
+    def create_index(self, cnxn, table_name: str, index_name: str, columns_sql: str):
+        if self.is_sqlite:
+            sql = f"CREATE INDEX IF NOT EXISTS [{index_name}] ON [{table_name}] ({columns_sql})"
+        else:
+            sql = (
+                f"IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = N'{index_name}') "
+                f"CREATE INDEX [{index_name}] ON [{table_name}] ({columns_sql})"
+            )
+        cnxn.cursor().execute(sql)
+
+
+def default_database():
+    """ Returns the Database and the analytics table from the configured Azure SQL settings. """
+    from .pool import get_pool
+
+    config = get_config()
+    config.require_sql()
+    pool = get_pool(config.server, config.database, config.username, config.password)
+    return Database(pool), config.table_name
+
+
+class RollupMaintainer:
+    """
+    Keeps hourly and daily aggregates of an analytics table up to date.
+
+    Every run re-aggregates the hours from the high-water mark up to now, by scanning only the raw
+    rows in each hour (an index on [timestamp] keeps this cheap), and replaces their rollup rows.
+    Re-aggregating is idempotent, so a bucket can be rolled up as often as needed:
+    - The high-water mark trails now by 'settle_lag', so rows that are inserted late (batched,
+      queued or replayed from the spool) are still counted.
+    - Every 'score_interval' the hours of the last 'score_window' are rolled up again, which folds in
+      score() updates of recent rows.
+    The daily rollup is recomputed from the hourly rollup for the days that were touched.
+    """
+
+    def __init__(
+        self,
+        target=None,
+        table_name: str = None,
+        dimensions=DEFAULT_DIMENSIONS,
+        settle_lag: timedelta = timedelta(minutes=5),
+        score_window: timedelta = timedelta(hours=24),
+        score_interval: timedelta = timedelta(minutes=15),
+    ):
+        """
+        Args:
+            target (optional): A pool.ConnectionPool or a sqlite3.Connection, defaults to the configured Azure SQL database.
+            table_name (str, optional): The analytics table, defaults to AZURE_TABLE_NAME.
+            dimensions (Iterable[str]): Columns to group by, e.g. 'tenant_id', 'model' or a tag column.
+                Columns the table does not have are left out.
+            settle_lag (timedelta): How long after its timestamp a row may still be inserted.
+            score_window (timedelta): How long after a row was logged its score may still change.
+            score_interval (timedelta): How often the score window is rolled up again.
+        """
+        if target is None:
+            self.db, default_table = default_database()
+            table_name = table_name or default_table
+        else:
+            self.db = target if isinstance(target, Database) else Database(target)
+        if not table_name:
+            raise ValueError("Wonkalytics rollups need the name of the analytics table.")
+        self.table_name = table_name
+        self.hourly_table = rollup_table(table_name, "hour")
+        self.daily_table = rollup_table(table_name, "day")
+        self.requested_dimensions = tuple(dimensions)
+        self.settle_lag = settle_lag
+        self.score_window = score_window
+        self.score_interval = score_interval
+        self.dimensions = None
+        self.measures = None
+        self._last_score_run = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self, now: datetime = None) -> int:
+        """
+        Bring the rollups up to date.
+
+        Args:
+            now (datetime, optional): The current time, in the timezone of the [timestamp] column (local time by default).
+
+        Returns:
+            int: The number of hours that were rolled up.
+        """
+        now = now or datetime.now()
+        return self.db.run(lambda cnxn: self._roll_up(cnxn, now))
+
+    def start(self, interval: float = 60.0):
+        """ Run the maintainer every 'interval' seconds in a background thread. """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name="wonkalytics-rollup", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """ Stop the background thread. """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self, interval):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.warning(f"Wonkalytics could not update the rollups of {self.table_name}: {e}")
+            self._stop.wait(interval)
+
+    def _prepare(self, cnxn):
+        raw_columns = set(table_columns(cnxn, self.table_name))
+        dimensions = [column for column in self.requested_dimensions if column in raw_columns]
+        measures = [measure for measure in MEASURES if set(measure.columns) <= raw_columns]
+        columns_sql = ", ".join(
+            ["[bucket] DATETIME NOT NULL"]
+            + [f"[{column}] NVARCHAR(450) NULL" for column in dimensions]
+            + [f"[{measure.name}] FLOAT NULL" for measure in measures]
+        )
+        for table in (self.hourly_table, self.daily_table):
+            self.db.create_table(cnxn, table, columns_sql)
+            self.db.create_index(cnxn, table, f"ix_{table}_bucket", "[bucket]")
+        self.db.create_table(
+            cnxn, STATE_TABLE, "[table_name] NVARCHAR(450) NOT NULL PRIMARY KEY, [high_water] DATETIME NOT NULL"
+        )
+        cnxn.commit()
+        # Rollup tables created earlier keep their columns, measures added since are left out
+        rollup_columns = set(table_columns(cnxn, self.hourly_table))
+        self.dimensions = [column for column in dimensions if column in rollup_columns]
+        self.measures = [measure for measure in measures if measure.name in rollup_columns]
+
+    def _roll_up(self, cnxn, now):
+        if self.measures is None:
+            self._prepare(cnxn)
+        cursor = cnxn.cursor()
+        cursor.execute(f"SELECT [high_water] FROM [{STATE_TABLE}] WHERE [table_name] = ?", (self.table_name,))
+        row = cursor.fetchone()
+        high_water = as_datetime(row[0]) if row else None
+        if high_water is None:
+            cursor.execute(f"SELECT MIN([timestamp]) FROM [{self.table_name}]")
+            high_water = as_datetime(cursor.fetchone()[0])
+            if high_water is None:
+                return 0
+
+        start = floor_hour(high_water)
+        if self._last_score_run is None or now - self._last_score_run >= self.score_interval:
+            start = min(start, floor_hour(now - self.score_window))
+            self._last_score_run = now
+        hours = []
+        hour = start
+        while hour <= now:
+            self._roll_up_hour(cnxn, hour)
+            hours.append(hour)
+            hour += _HOUR
+        for day in sorted({floor_day(hour) for hour in hours}):
+            self._roll_up_day(cnxn, day)
+
+        cursor = cnxn.cursor()
+        cursor.execute(f"DELETE FROM [{STATE_TABLE}] WHERE [table_name] = ?", (self.table_name,))
+        cursor.execute(
+            f"INSERT INTO [{STATE_TABLE}] ([table_name], [high_water]) VALUES (?, ?)",
+            (self.table_name, self.db.param(max(high_water, now - self.settle_lag))),
+        )
+        cnxn.commit()
+        return len(hours)
+
+    def _roll_up_hour(self, cnxn, hour):
+        groups = [f"CAST([{column}] AS NVARCHAR(450))" for column in self.dimensions]
+        sql = (
+            f"SELECT {', '.join(groups + [measure.expression for measure in self.measures])} "
+            f"FROM [{self.table_name}] WHERE [timestamp] >= ? AND [timestamp] < ?"
+        )
+        if groups:
+            sql += f" GROUP BY {', '.join(groups)}"
+        self._replace(cnxn, self.hourly_table, hour, sql, (self.db.param(hour), self.db.param(hour + _HOUR)))
+
+    def _roll_up_day(self, cnxn, day):
+        groups = [f"[{column}]" for column in self.dimensions]
+        sql = (
+            f"SELECT {', '.join(groups + [f'{measure.combine}([{measure.name}])' for measure in self.measures])} "
+            f"FROM [{self.hourly_table}] WHERE [bucket] >= ? AND [bucket] < ?"
+        )
+        if groups:
+            sql += f" GROUP BY {', '.join(groups)}"
+        self._replace(cnxn, self.daily_table, day, sql, (self.db.param(day), self.db.param(day + _DAY)))
+
+    def _replace(self, cnxn, table, bucket, select_sql, params):
+        cursor = cnxn.cursor()
+        cursor.execute(select_sql, params)
+        calls = len(self.dimensions)
+        # Without dimensions an empty bucket still aggregates to one row, with 0 calls
+        rows = [(self.db.param(bucket),) + tuple(row) for row in cursor.fetchall() if row[calls]]
+        cursor.execute(f"DELETE FROM [{table}] WHERE [bucket] = ?", (self.db.param(bucket),))
+        if rows:
+            columns = ["bucket"] + self.dimensions + [measure.name for measure in self.measures]
+            cursor.executemany(
+                f"INSERT INTO [{table}] ({', '.join(f'[{c}]' for c in columns)}) VALUES ({', '.join(['?'] * len(columns))})",
+                rows,
+            )
+        cnxn.commit()
+
+
+def main(argv=None):
+    """ Maintain the rollups of the configured analytics table: python -m wonkalytics.rollup [--once] """
+    parser = argparse.ArgumentParser(prog="python -m wonkalytics.rollup", description=main.__doc__)
+    parser.add_argument("--table", default=None, help="The analytics table, defaults to AZURE_TABLE_NAME.")
+    parser.add_argument("--dimensions", nargs="+", default=list(DEFAULT_DIMENSIONS), help="Columns to group by.")
+    parser.add_argument("--interval", type=float, default=60.0, help="Seconds between runs.")
+    parser.add_argument("--once", action="store_true", help="Update the rollups once and exit.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    maintainer = RollupMaintainer(table_name=args.table, dimensions=args.dimensions)
+    while True:
+        started = time.monotonic()
+        logging.info(f"Wonkalytics rolled up {maintainer.run_once()} hours of {maintainer.table_name}")
+        if args.once:
+            return 0
+        time.sleep(max(0.0, args.interval - (time.monotonic() - started)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
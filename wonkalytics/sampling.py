@@ -0,0 +1,229 @@
+import random
+import threading
+import time
+from collections import Counter
+from .authinfo import extract_auth_info_pl_tags
+from .config import LazySingleton, get_config
+from .dispatcher import get_dispatcher
+
+# Decisions of SamplingPolicy.decide
+FULL = "full"
+SLIM = "slim"
+DROP = "drop"
+
+
+class TokenBucket:
+    """ Allows 'rate' events per second on average, with bursts of up to 'burst' events. """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1.0)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> bool:
+        """ Take a token, returns False when the bucket is empty. """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class SamplingRule:
+    """
+    Which share of the matching calls is logged.
+
+    A rule matches a call when every criterion that is set matches: one of 'tags' is in the call's
+    tags, and the tenant, model and function name are equal.
+    """
+
+    def __init__(
+        self,
+        name: str = None,
+        rate: float = 1.0,
+        max_per_second: float = None,
+        tags=None,
+        tenant: str = None,
+        model: str = None,
+        function_name: str = None,
+        always_log: bool = False,
+    ):
+        """
+        Args:
+            name (str, optional): Name of the rule in the counters, defaults to a description of its criteria.
+            rate (float): Probability that a matching call is logged.
+            max_per_second (float, optional): Maximum number of matching calls logged per second.
+            tags (Iterable[str], optional): Matches calls with any of these tags ('pl_tags'/'wl_tags').
+            tenant (str, optional): Matches calls of this tenant id (from the request's auth info).
+            model (str, optional): Matches calls with this 'model' (or 'engine') argument.
+            function_name (str, optional): Matches calls of this function, e.g. 'openai.ChatCompletion.create'.
+            always_log (bool): Log every matching call at full fidelity, regardless of rate and load.
+        """
+        self.tags = frozenset(tags) if tags is not None else None
+        self.tenant = tenant
+        self.model = model
+        self.function_name = function_name
+        self.rate = rate
+        self.always_log = always_log
+        self.bucket = TokenBucket(max_per_second) if max_per_second is not None else None
+        self.name = name or ",".join(
+            f"{key}={value}"
+            for key, value in (
+                ("tags", tags), ("tenant", tenant), ("model", model), ("function_name", function_name)
+            )
+            if value is not None
+        ) or "default"
+
+    def matches(self, function_name, tags, tenant, model) -> bool:
+        return (
+            (self.tags is None or (tags is not None and not self.tags.isdisjoint(tags)))
+            and (self.tenant is None or self.tenant == tenant)
+            and (self.model is None or self.model == model)
+            and (self.function_name is None or self.function_name == function_name)
+        )
+
+
+class SamplingPolicy:
+    """
+    Decides per call whether it is logged in full, logged without its payload, or not logged.
+
+    The first matching rule applies, calls that match no rule are logged with 'default_rate'. Calls
+    are always logged in full when a rule says so, when the caller asked for the request id (e.g. to
+    score the response later), when a stream was aborted and when the API raised an error. When the background logging backlog
+    reaches 'shed_backlog' events, sampled calls are logged without their messages and response
+    content (a slim row) until the backlog drains. Every decision is counted per rule.
+    """
+
+    def __init__(self, rules=(), default_rate: float = 1.0, shed_backlog: int = None, backlog=None):
+        """
+        Args:
+            rules (Iterable[SamplingRule]): The rules, in order of precedence.
+            default_rate (float): Probability that a call matching no rule is logged.
+            shed_backlog (int, optional): Backlog from which payloads are shed, None to never shed.
+            backlog (callable, optional): Returns the current backlog, defaults to the background
+                dispatcher's queue size (0 when background logging is disabled).
+        """
+        self.rules = list(rules)
+        self.default_rule = SamplingRule("default", rate=default_rate)
+        self.shed_backlog = shed_backlog
+        self.backlog = backlog or _dispatcher_backlog
+        self._needs_tenant = any(rule.tenant is not None for rule in self.rules)
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def decide(self, function_name, tags=None, tenant=None, model=None, force: bool = False) -> str:
+        """
+        Returns FULL, SLIM or DROP for a call.
+
+        Args:
+            function_name (str): The wrapped function, e.g. 'openai.ChatCompletion.create'.
+            tags (list, optional): The call's tags.
+            tenant (str, optional): The tenant id of the call.
+            model (str, optional): The model of the call.
+            force (bool): Log the call in full regardless of the rules.
+        """
+        rule = next(
+            (rule for rule in self.rules if rule.matches(function_name, tags, tenant, model)),
+            self.default_rule,
+        )
+        if force or rule.always_log:
+            decision = FULL
+        elif rule.rate < 1.0 and random.random() >= rule.rate:
+            decision = DROP
+        elif rule.bucket is not None and not rule.bucket.take():
+            decision = DROP
+        elif self.shed_backlog is not None and self.backlog() >= self.shed_backlog:
+            decision = SLIM
+        else:
+            decision = FULL
+        with self._lock:
+            self._counts[rule.name, decision] += 1
+        return decision
+
+    def decide_event(self, function_name, kwargs, tags, request, metadata=None, return_pl_id=False) -> str:
+        """ Returns the decision for a call, with the arguments of wonkalytics_and_promptlayer_api_request. """
+        tenant = None
+        if self._needs_tenant and isinstance(request, dict):
+            tenant = extract_auth_info_pl_tags(request.get("auth_info"))[0]
+        force = bool(return_pl_id) or (
+            isinstance(metadata, dict)
+            and (metadata.get("stream_status") == "aborted" or metadata.get("error_type") is not None)
+        )
+        model = kwargs.get("model") or kwargs.get("engine")
+        return self.decide(function_name, tags, tenant, model, force)
+
+    def stats(self) -> dict:
+        """
+        Returns the number of calls per rule and decision, e.g. {'default': {'full': 10, 'drop': 90}}.
+        """
+        stats = {}
+        with self._lock:
+            for (rule_name, decision), count in self._counts.items():
+                stats.setdefault(rule_name, {})[decision] = count
+        return stats
+
+
+def _dispatcher_backlog():
+    dispatcher = get_dispatcher()
+    return 0 if dispatcher is None else dispatcher.backlog
+
+
+def _sampling_configured():
+    config = get_config()
+    return config.sample_rate is not None or config.shed_backlog is not None
+
+
+def _enable_sampling_from_config():
+    config = get_config()
+    return enable_sampling(
+        default_rate=config.sample_rate if config.sample_rate is not None else 1.0,
+        shed_backlog=config.shed_backlog,
+    )
+
+
+_policy = LazySingleton(_sampling_configured, _enable_sampling_from_config)
+
+
+def enable_sampling(rules=(), default_rate: float = 1.0, shed_backlog: int = None) -> SamplingPolicy:
+    """
+    Log only a sample of the calls, and shed payloads when logging falls behind.
+
+    Example:
+    ```
+    wonkalytics.enable_sampling(
+        rules=[
+            SamplingRule(tags=["healthcheck"], rate=0.01),
+            SamplingRule(tenant="<tenant id>", max_per_second=20),
+            SamplingRule(tags=["eval"], always_log=True),
+        ],
+        default_rate=0.5,
+        shed_backlog=5000,
+    )
+    ```
+
+    Returns:
+        SamplingPolicy: The active policy.
+    """
+    policy = SamplingPolicy(rules, default_rate, shed_backlog)
+    _policy.set(policy)
+    return policy
+
+
+def disable_sampling():
+    """ Go back to logging every call in full. """
+    _policy.clear()
+
+
+def get_sampling_policy():
+    """
+    Returns the active sampling policy, or None when every call is logged.
+
+    Sampling can also be enabled with the WONKALYTICS_SAMPLE_RATE (the default rate) and
+    WONKALYTICS_SHED_BACKLOG environment variables, unless it was disabled with disable_sampling.
+    """
+    return _policy.get()
@@ -0,0 +1,183 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import NamedTuple, Optional
+from .config import get_config
+from .pool import get_pool, is_pyodbc_error
+
+
+class ColumnInfo(NamedTuple):
+    """ The definition of a single column as reported by INFORMATION_SCHEMA.COLUMNS. """
+
+    name: str
+    data_type: str
+    # Maximum number of characters for character types, -1 for (MAX) and None for other types
+    max_length: Optional[int] = None
+
+
+class TableSchema:
+    """ The columns of an analytics table, as loaded at 'loaded_at' (monotonic time). """
+
+    def __init__(self, table_name: str, columns: dict, loaded_at: float):
+        self.table_name = table_name
+        self.columns = columns
+        self.column_names = frozenset(columns)
+        self.loaded_at = loaded_at
+
+    def __contains__(self, column_name):
+        return column_name in self.columns
+
+    def __repr__(self):
+        return f"TableSchema({self.table_name!r}, columns={sorted(self.column_names)})"
+
+
+class SchemaCache:
+    """
+    A thread-safe cache of table schemas with a time to live.
+
+    Entries are keyed by (server, database, table_name) and reloaded once they are older than 'ttl'
+    seconds, or right away after invalidate().
+    """
+
+    def __init__(self, ttl: float = None):
+        """
+        Args:
+            ttl (float, optional): Seconds before a cached schema is loaded again. 0 disables caching.
+                Defaults to the schema_ttl setting (WONKALYTICS_SCHEMA_TTL).
+        """
+        self._ttl = ttl
+        self._entries = {}
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    @property
+    def ttl(self) -> float:
+        return get_config().schema_ttl if self._ttl is None else self._ttl
+
+    @ttl.setter
+    def ttl(self, ttl: float):
+        self._ttl = ttl
+
+    def get(self, key: tuple, loader, refresh: bool = False) -> TableSchema:
+        """
+        Returns the cached schema for 'key', calling 'loader()' when it is missing or expired.
+
+        Loads are single-flight per key: concurrent callers of the same table wait for one query
+        instead of all querying INFORMATION_SCHEMA themselves, other tables are not held up by it.
+        """
+        with self._lock:
+            schema = self._entries.get(key)
+            if not refresh and schema is not None and time.monotonic() - schema.loaded_at < self.ttl:
+                return schema
+            flight = self._loading.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._loading[key] = Future()
+        if not leader:
+            return flight.result()
+
+        try:
+            schema = loader()
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+            flight.set_exception(e)
+            raise
+        with self._lock:
+            self._entries[key] = schema
+            del self._loading[key]
+        flight.set_result(schema)
+        return schema
+
+    def invalidate(self, server=None, database=None, table_name=None):
+        """ Drop cached schemas matching the given parts of the key, or all schemas if none are given. """
+        with self._lock:
+            for key in list(self._entries):
+                if all(
+                    wanted is None or wanted == part
+                    for wanted, part in zip((server, database, table_name), key)
+                ):
+                    del self._entries[key]
+
+
+_cache = SchemaCache()
+
+
+def configure_schema_cache(ttl: float):
+    """
+    Set the time to live of cached table schemas, instead of the schema_ttl setting.
+
+    Args:
+        ttl (float): Seconds before a cached schema is loaded again. 0 disables caching. None goes back to the setting.
+    """
+    _cache.ttl = ttl
+
+
+def get_table_schema(
+    table_name: str,
+    server: str,
+    database: str,
+    username: str,
+    password: str,
+    encrypt: str = "yes",
+    connection_timeout: int = 30,
+    trust_server_certificate: str = "no",
+    refresh: bool = False,
+) -> TableSchema:
+    """
+    Returns the (cached) column definitions of a table in the Azure SQL database.
+
+    Args:
+        table_name (str): The name of the table.
+        refresh (bool): Reload the schema even if the cached one has not expired.
+
+    Returns:
+        TableSchema: The columns of the table with their types and maximum lengths.
+    """
+    pool = get_pool(
+        server,
+        database,
+        username,
+        password,
+        encrypt,
+        connection_timeout,
+        trust_server_certificate,
+    )
+    return _cache.get(
+        (server, database, table_name),
+        lambda: pool.run(lambda cnxn: _load_table_schema(cnxn, table_name)),
+        refresh,
+    )
+
+
+def refresh_table_schema(*args, **kwargs) -> TableSchema:
+    """ Reload a table schema right away, takes the same arguments as get_table_schema. """
+    return get_table_schema(*args, refresh=True, **kwargs)
+
+
+def invalidate_table_schema(server=None, database=None, table_name=None):
+    """ Drop cached schemas so they are reloaded on next use. Without arguments all schemas are dropped. """
+    _cache.invalidate(server, database, table_name)
+
+
+def is_invalid_column_error(error: Exception) -> bool:
+    """ Check whether a pyodbc error is SQL Server's 'Invalid column name' (error 207, SQLSTATE 42S22). """
+    if not is_pyodbc_error(error):
+        return False
+    sqlstate = error.args[0] if error.args else ""
+    return sqlstate == "42S22" or "invalid column name" in str(error).lower()
+
+
+def _load_table_schema(cnxn, table_name: str) -> TableSchema:
+    query = "SELECT COLUMN_NAME, DATA_TYPE, CHARACTER_MAXIMUM_LENGTH FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = ?"
+    cursor = cnxn.cursor()
+    cursor.execute(query, table_name)
+    columns = {
+        row.COLUMN_NAME: ColumnInfo(
+            row.COLUMN_NAME, row.DATA_TYPE.lower(), row.CHARACTER_MAXIMUM_LENGTH
+        )
+        for row in cursor.fetchall()
+    }
+    logging.debug(f"Loaded schema for table {table_name}: {sorted(columns)}")
+    return TableSchema(table_name, columns, time.monotonic())
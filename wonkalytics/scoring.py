@@ -0,0 +1,320 @@
+import atexit
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from .config import LazySingleton, get_config
+from .projection import AnalyticsRow
+
+# SQL Server accepts at most 2100 parameters per statement
+_MAX_PARAMETERS = 2000
+
+
+class ScoreResult:
+    """ The outcome of a score or row update: the number of rows that were actually updated. """
+
+    __slots__ = ("id", "rows_updated", "with_insert")
+
+    def __init__(self, id: str, rows_updated: int, with_insert: bool = False):
+        self.id = id
+        self.rows_updated = rows_updated
+        # The update arrived before the row was written and was applied by its INSERT
+        self.with_insert = with_insert
+
+    def __bool__(self):
+        return self.rows_updated > 0
+
+    def __repr__(self):
+        return f"ScoreResult(id={self.id!r}, rows_updated={self.rows_updated}, with_insert={self.with_insert})"
+
+
+class _PendingUpdate:
+    """ The coalesced column updates of one row, with the futures of the calls that requested them. """
+
+    __slots__ = ("pool", "table_name", "id", "values", "futures", "submitted_at", "next_attempt")
+
+    def __init__(self, pool, table_name, id, values, future):
+        self.pool = pool
+        self.table_name = table_name
+        self.id = id
+        self.values = values
+        self.futures = [future]
+        self.submitted_at = time.monotonic()
+        self.next_attempt = self.submitted_at
+
+
+class ScoreWriter:
+    """
+    Buffers score and row property updates and applies them in bulk.
+
+    Updates are coalesced per row id, later values win, and flushed by a background thread as one
+    'UPDATE ... FROM (VALUES ...)' statement per table and column set, which reports the ids it
+    updated. Updates of rows that do not exist yet (the row's INSERT is still queued) are held and
+    retried until 'pending_ttl' seconds have passed. When the row is written in the meantime the held
+    updates are merged into its INSERT (see merge_pending).
+    """
+
+    def __init__(self, max_latency: float = 0.5, batch_size: int = 500, retry_interval: float = 1.0, pending_ttl: float = 300.0):
+        """
+        Initializes the writer and starts its flush thread.
+
+        Args:
+            max_latency (float): Maximum seconds an update is buffered before it is flushed.
+            batch_size (int): Number of buffered rows that triggers a flush.
+            retry_interval (float): Seconds between attempts for updates of rows that did not exist yet.
+            pending_ttl (float): Seconds after which an update of a row that never appeared is given up.
+        """
+        self.max_latency = max_latency
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.pending_ttl = pending_ttl
+        self.rows_updated = 0
+        self.expired = 0
+        self._updates = {}
+        self._cond = threading.Condition()
+        self._flushing = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="wonkalytics-score-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, pool, table_name: str, response_id: str, values: dict) -> Future:
+        """
+        Queue an update of a row.
+
+        Args:
+            pool (ConnectionPool): The pool of the database the row is in.
+            table_name (str): The table of the row.
+            response_id (str): The row's 'id'.
+            values (dict): Column names mapped to their new values.
+
+        Returns:
+            Future: Resolves to a ScoreResult once the update is applied or given up.
+        """
+        future = Future()
+        key = (id(pool), table_name, response_id)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("The score writer is closed.")
+            update = self._updates.get(key)
+            if update is None:
+                self._updates[key] = _PendingUpdate(pool, table_name, response_id, dict(values), future)
+            else:
+                update.values.update(values)
+                update.futures.append(future)
+                update.next_attempt = min(update.next_attempt, time.monotonic())
+            if len(self._updates) >= self.batch_size:
+                self._cond.notify()
+        return future
+
+    def merge_pending(self, pool, table_name: str, row: AnalyticsRow):
+        """
+        Take the buffered updates of a row that is about to be inserted and merge them into it.
+
+        Args:
+            pool (ConnectionPool): The pool the row is inserted with.
+            table_name (str): The table the row is inserted into.
+            row (AnalyticsRow): The projected row, with an 'id' column.
+
+        Returns:
+            tuple: The row with the updated values and the taken updates, to be passed to
+                   resolve_with_insert once the row is written. The row itself and None when there were no updates.
+        """
+        if not self._updates or "id" not in row.columns:
+            return row, None
+        response_id = row.values[row.columns.index("id")]
+        with self._cond:
+            update = self._updates.pop((id(pool), table_name, response_id), None)
+        if update is None:
+            return row, None
+        return merge_into_row(row, update.values), update
+
+    def flush(self, timeout=None) -> bool:
+        """
+        Apply all buffered updates now. Updates of rows that do not exist yet stay buffered.
+
+        Returns:
+            bool: True if the flush finished before the timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            for update in self._updates.values():
+                update.next_attempt = float("-inf")
+            self._cond.notify()
+            while self._flushing or any(update.next_attempt == float("-inf") for update in self._updates.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=None) -> bool:
+        """ Flush the buffered updates, give up on updates of rows that do not exist, and stop the thread. """
+        drained = self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            updates, self._updates = list(self._updates.values()), {}
+            self._cond.notify_all()
+        for update in updates:
+            self._resolve(update, 0)
+        self._thread.join(timeout)
+        return drained
+
+    def _due_updates(self):
+        now = time.monotonic()
+        if len(self._updates) < self.batch_size and not any(
+            update.next_attempt <= now - self.max_latency for update in self._updates.values()
+        ):
+            return []
+        due = [key for key, update in self._updates.items() if update.next_attempt <= now]
+        return [self._updates.pop(key) for key in due]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due = self._due_updates()
+                while not due:
+                    if self._closed:
+                        return
+                    self._cond.wait(self.max_latency / 2)
+                    due = self._due_updates()
+                self._flushing += 1
+            try:
+                groups = {}
+                for update in due:
+                    key = (id(update.pool), update.table_name, tuple(sorted(update.values)))
+                    groups.setdefault(key, []).append(update)
+                for (_, table_name, columns), updates in groups.items():
+                    self._apply(updates[0].pool, table_name, columns, updates)
+            finally:
+                with self._cond:
+                    self._flushing -= 1
+                    self._cond.notify_all()
+
+    def _apply(self, pool, table_name, columns, updates):
+        chunk_size = max(1, _MAX_PARAMETERS // (len(columns) + 1))
+        for start in range(0, len(updates), chunk_size):
+            chunk = updates[start : start + chunk_size]
+            try:
+                updated_ids = pool.run(lambda cnxn: _update_from_values(cnxn, table_name, columns, chunk))
+            except Exception as e:
+                logging.warning(f"Wonkalytics could not apply {len(chunk)} row updates: {e}")
+                for update in chunk:
+                    self._resolve(update, 0, error=e)
+                continue
+            for update in chunk:
+                if update.id in updated_ids:
+                    self.rows_updated += 1
+                    self._resolve(update, 1)
+                else:
+                    self._hold(update)
+
+    def _hold(self, update):
+        now = time.monotonic()
+        if now - update.submitted_at >= self.pending_ttl:
+            self.expired += 1
+            self._resolve(update, 0)
+            return
+        update.next_attempt = now + self.retry_interval
+        key = (id(update.pool), update.table_name, update.id)
+        with self._cond:
+            if self._closed:
+                self._resolve(update, 0)
+                return
+            newer = self._updates.get(key)
+            if newer is not None:
+                # Updates submitted during the flush win over the held ones
+                update.values.update(newer.values)
+                update.futures.extend(newer.futures)
+                update.next_attempt = newer.next_attempt
+            self._updates[key] = update
+
+    @staticmethod
+    def _resolve(update, rows_updated, error=None):
+        for future in update.futures:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(ScoreResult(update.id, rows_updated))
+
+
+def merge_into_row(row: AnalyticsRow, values: dict) -> AnalyticsRow:
+    """ Returns the row with the given column values set. """
+    merged = dict(zip(row.columns, row.values))
+    merged.update(values)
+    columns = tuple(sorted(merged))
+    return AnalyticsRow(columns, [merged[column] for column in columns])
+
+
+def resolve_with_insert(update, error: Exception = None):
+    """ Resolve the futures of updates that were merged into their row's INSERT (see ScoreWriter.merge_pending). """
+    for future in update.futures:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(ScoreResult(update.id, 1, with_insert=True))
+
+
+def _update_from_values(cnxn, table_name, columns, updates):
+    row_values = ", ".join(["(" + ", ".join(["?"] * (len(columns) + 1)) + ")"] * len(updates))
+    assignments = ", ".join(f"t.[{column}] = v.[{column}]" for column in columns)
+    sql = (
+        f"UPDATE t SET {assignments} OUTPUT inserted.id "
+        f"FROM [{table_name}] AS t JOIN (VALUES {row_values}) AS v (id, {', '.join(f'[{c}]' for c in columns)}) "
+        f"ON t.id = v.id"
+    )
+    params = []
+    for update in updates:
+        params.append(update.id)
+        params.extend(update.values[column] for column in columns)
+    cursor = cnxn.cursor()
+    cursor.execute(sql, params)
+    updated_ids = {row[0] for row in cursor.fetchall()}
+    cnxn.commit()
+    return updated_ids
+
+
+_writer = LazySingleton(lambda: get_config().score_batching, lambda: enable_score_batching())
+_atexit_registered = False
+
+
+def enable_score_batching(max_latency: float = 0.5, batch_size: int = 500, pending_ttl: float = 300.0, drain_timeout: float = 10.0) -> ScoreWriter:
+    """
+    Buffer score() and update_row_property() updates and apply them in bulk, including updates of
+    rows whose INSERT has not landed yet.
+
+    Returns:
+        ScoreWriter: The active score writer.
+    """
+    global _atexit_registered
+    writer = ScoreWriter(max_latency, batch_size, pending_ttl=pending_ttl)
+    with _writer.lock:
+        old_writer = _writer.set(writer)
+        if not _atexit_registered:
+            atexit.register(lambda: disable_score_batching(drain_timeout))
+            _atexit_registered = True
+    if old_writer is not None:
+        old_writer.close(drain_timeout)
+    return writer
+
+
+def disable_score_batching(timeout=None) -> bool:
+    """
+    Apply the buffered updates and go back to one UPDATE per call.
+
+    Returns:
+        bool: True if all buffered updates were applied before stopping.
+    """
+    writer = _writer.clear()
+    if writer is None:
+        return True
+    return writer.close(timeout)
+
+
+def get_score_writer():
+    """
+    Returns the active score writer, or None when every update is applied right away.
+
+    Score batching can also be enabled by setting the WONKALYTICS_SCORE_BATCHING environment variable to 1,
+    unless it was disabled with disable_score_batching.
+    """
+    return _writer.get()
@@ -0,0 +1,98 @@
+import json
+from datetime import datetime
+
+# orjson is optional, it is used when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_PRIMITIVES = (str, int, float, bool, type(None))
+
+
+def is_json_serializable(value) -> bool:
+    """
+    Check whether a value can be encoded as JSON, without encoding it.
+
+    Primitives are accepted by a type check, lists, tuples and dicts are walked. Any other type
+    (functions, clients, ...) is rejected, like json.dumps would.
+    """
+    if isinstance(value, _PRIMITIVES):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all(is_json_serializable(item) for item in value)
+    if isinstance(value, dict):
+        return all(
+            isinstance(key, _PRIMITIVES) and is_json_serializable(item)
+            for key, item in value.items()
+        )
+    return False
+
+
+def _default(value):
+    # Pydantic models, e.g. the response objects of openai>=1.0
+    if hasattr(value, "model_dump"):
+        return value.model_dump()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value) -> bytes:
+    """ Encode a value as compact JSON bytes, with orjson when it is installed. """
+    if orjson is not None:
+        return orjson.dumps(value, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, default=_default, separators=(",", ":")).encode("utf-8")
+
+
+def _tagged_default(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if hasattr(value, "model_dump"):
+        return value.model_dump()
+    return str(value)
+
+
+def _decode_object(obj):
+    if len(obj) == 1 and "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+
+def encode_event(event) -> bytes:
+    """
+    Encode an event for storage (the spool, the collector), datetimes are kept as datetimes by decode_event.
+
+    Unlike dumps, values that cannot be encoded are stored as their string representation.
+    """
+    if isinstance(event, EncodedEvent):
+        return event.body
+    if orjson is not None:
+        return orjson.dumps(
+            event,
+            default=_tagged_default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME,
+        )
+    return json.dumps(event, default=_tagged_default, separators=(",", ":")).encode("utf-8")
+
+
+def decode_event(payload: bytes):
+    """ Decode an event encoded with encode_event. """
+    return json.loads(payload, object_hook=_decode_object)
+
+
+class EncodedEvent:
+    """
+    An event together with its JSON encoding, which is made once on first use and then shared by
+    every sink that needs bytes (the PromptLayer request body, the spool, ...).
+    """
+
+    __slots__ = ("event", "_body")
+
+    def __init__(self, event: dict):
+        self.event = event
+        self._body = None
+
+    @property
+    def body(self) -> bytes:
+        if self._body is None:
+            self._body = dumps(self.event)
+        return self._body
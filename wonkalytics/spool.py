@@ -0,0 +1,438 @@
+import argparse
+import atexit
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from .config import LazySingleton, get_config
+from .pool import is_transient_sql_error
+from .serialization import EncodedEvent, decode_event, encode_event
+
+# How durable a spooled event is, mapped to SQLite's synchronous setting (the spool runs in WAL mode)
+FSYNC_POLICIES = {
+    "always": "FULL",  # fsync on every append, survives power loss
+    "normal": "NORMAL",  # fsync on WAL checkpoints, survives a crash of the process
+    "off": "OFF",  # leave it to the OS
+}
+
+_SINKS = {}
+
+
+def register_sink(name: str, func):
+    """
+    Register the function that replays spooled events of a sink.
+
+    Args:
+        name (str): The sink name used when appending events, e.g. 'sql' or 'promptlayer'.
+        func (callable): Called with the decoded event, raises when the sink is still unavailable.
+    """
+    _SINKS[name] = func
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """
+    Check whether a failed write is worth retrying later: connection problems, timeouts and
+    server-side errors, rather than a row or event that will never be accepted.
+    """
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    # The client libraries are imported on first use, an error cannot come from one that was never imported
+    pyodbc = sys.modules.get("pyodbc")
+    if pyodbc is not None:
+        if isinstance(error, (pyodbc.OperationalError, pyodbc.InterfaceError)):
+            return True
+        if isinstance(error, pyodbc.Error):
+            sqlstate = error.args[0] if error.args else ""
+            return sqlstate.startswith("08") or sqlstate == "HYT00" or is_transient_sql_error(error)
+    requests = sys.modules.get("requests")
+    if requests is not None:
+        if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            return True
+        if isinstance(error, requests.HTTPError) and error.response is not None:
+            return error.response.status_code == 429 or error.response.status_code >= 500
+    httpx = sys.modules.get("httpx")
+    if httpx is not None:
+        if isinstance(error, httpx.TransportError):
+            return True
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+
+class Spool:
+    """
+    A durable, append-only spool of events that could not be delivered, stored in an SQLite WAL database.
+
+    The spool is capped at 'max_bytes' of payload, when full the oldest events are dropped to make room.
+    It can be shared by the processes of a node (e.g. gunicorn workers and the CLI): events are claimed
+    with a lease before they are replayed, so every event is replayed by one process at a time.
+    Events are stored without their 'api_key', the sink adds the current key back when it is replayed.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024, fsync: str = "normal"):
+        """
+        Opens (or creates) the spool database.
+
+        Args:
+            path (str): Path of the SQLite database file.
+            max_bytes (int): Maximum total size of the spooled payloads.
+            fsync (str): One of 'always', 'normal' or 'off', see FSYNC_POLICIES.
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync should be one of {', '.join(FSYNC_POLICIES)}, got {fsync!r}")
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self._owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(f"PRAGMA synchronous={FSYNC_POLICIES[fsync]}")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sink TEXT NOT NULL,
+                payload BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                created REAL NOT NULL,
+                last_error TEXT,
+                owner TEXT,
+                lease_until REAL NOT NULL DEFAULT 0
+            )"""
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS events_next_attempt ON events (next_attempt)")
+
+    def append(self, sink: str, event, error: Exception = None):
+        """
+        Durably store an event for a sink.
+
+        Args:
+            sink (str): The registered sink that should receive the event.
+            event: The event, anything encode_event can encode. An EncodedEvent is stored with its existing encoding.
+            error (Exception, optional): Why the event could not be delivered.
+        """
+        payload = encode_event(_without_api_key(event))
+        now = time.time()
+        with self._lock:
+            if len(payload) > self.max_bytes:
+                self.dropped += 1
+                return
+            # One write transaction, so the room made is not taken by another process
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._make_room(len(payload))
+                self._db.execute(
+                    "INSERT INTO events (sink, payload, size, next_attempt, created, last_error) VALUES (?, ?, ?, ?, ?, ?)",
+                    (sink, payload, len(payload), now, now, None if error is None else str(error)),
+                )
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def due(self, limit: int = 100) -> list:
+        """
+        Returns up to 'limit' events ready to be replayed as (id, sink, event, attempts), oldest first.
+
+        The events are not claimed, use claim() to replay them.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, sink, payload, attempts FROM events WHERE next_attempt <= ? AND lease_until <= ? ORDER BY id LIMIT ?",
+                (time.time(), time.time(), limit),
+            ).fetchall()
+        return [(event_id, sink, decode_event(payload), attempts) for event_id, sink, payload, attempts in rows]
+
+    def claim(self, limit: int = 100, lease: float = 300.0) -> list:
+        """
+        Claim up to 'limit' due events for this process, so no other process replays them at the same time.
+
+        A claimed event is released by ack(), retry_later() or release(), or when its 'lease' of seconds
+        runs out, e.g. because the process that claimed it died.
+
+        Returns:
+            list: The claimed events as (id, sink, event, attempts), oldest first.
+        """
+        now = time.time()
+        # A token per claim, so only the rows of this claim are read back
+        token = f"{self._owner}-{uuid.uuid4().hex}"
+        with self._lock:
+            # A single UPDATE is atomic, other processes skip the rows it claims
+            self._db.execute(
+                """UPDATE events SET owner = ?, lease_until = ? WHERE id IN (
+                    SELECT id FROM events WHERE next_attempt <= ? AND lease_until <= ? ORDER BY id LIMIT ?
+                )""",
+                (token, now + lease, now, now, limit),
+            )
+            rows = self._db.execute(
+                "SELECT id, sink, payload, attempts FROM events WHERE owner = ? ORDER BY id", (token,)
+            ).fetchall()
+        return [(event_id, sink, decode_event(payload), attempts) for event_id, sink, payload, attempts in rows]
+
+    def ack(self, event_id: int):
+        """ Remove a delivered event. """
+        with self._lock:
+            self._db.execute("DELETE FROM events WHERE id = ?", (event_id,))
+
+    def retry_later(self, event_id: int, delay: float, error: Exception = None):
+        """ Count a failed replay, release the event and postpone its next attempt by 'delay' seconds. """
+        with self._lock:
+            self._db.execute(
+                "UPDATE events SET attempts = attempts + 1, next_attempt = ?, last_error = ?, owner = NULL, lease_until = 0 WHERE id = ?",
+                (time.time() + delay, None if error is None else str(error), event_id),
+            )
+
+    def release(self, event_ids):
+        """ Give claimed events back without counting an attempt, e.g. when they were skipped. """
+        with self._lock:
+            self._db.executemany(
+                "UPDATE events SET owner = NULL, lease_until = 0 WHERE id = ?", [(event_id,) for event_id in event_ids]
+            )
+
+    def reset_backoff(self):
+        """ Make every spooled event that is not being replayed due right away. """
+        with self._lock:
+            self._db.execute("UPDATE events SET next_attempt = 0 WHERE lease_until <= ?", (time.time(),))
+
+    def list(self, limit: int = 20) -> list:
+        """ Returns the oldest 'limit' events as dicts, for inspection. """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, sink, size, attempts, next_attempt, created, last_error FROM events ORDER BY id LIMIT ?",
+                (limit,),
+            ).fetchall()
+        keys = ("id", "sink", "size", "attempts", "next_attempt", "created", "last_error")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def stats(self) -> dict:
+        """ Returns the number of spooled events per sink, the total payload size and the number of dropped events. """
+        with self._lock:
+            per_sink = dict(self._db.execute("SELECT sink, COUNT(*) FROM events GROUP BY sink").fetchall())
+            size = self._size()
+        return {"events": per_sink, "bytes": size, "dropped": self.dropped}
+
+    def purge(self, sink: str = None) -> int:
+        """ Delete all spooled events, or only those of 'sink'. Returns the number of deleted events. """
+        with self._lock:
+            if sink is None:
+                deleted = self._db.execute("DELETE FROM events").rowcount
+            else:
+                deleted = self._db.execute("DELETE FROM events WHERE sink = ?", (sink,)).rowcount
+        return deleted
+
+    def replay(self, limit: int = 100, base_delay: float = 1.0, max_delay: float = 300.0) -> dict:
+        """
+        Try to deliver the due events once.
+
+        After a failure the remaining events of that sink are skipped for this round, the failed event
+        is postponed with exponential backoff and jitter.
+
+        Returns:
+            dict: The number of 'delivered', 'failed' and 'skipped' events.
+        """
+        result = {"delivered": 0, "failed": 0, "skipped": 0}
+        down = set()
+        skipped = []
+        try:
+            for event_id, sink, event, attempts in self.claim(limit):
+                if sink in down:
+                    skipped.append(event_id)
+                    continue
+                func = _SINKS.get(sink)
+                if func is None:
+                    logging.warning(f"Wonkalytics spool has events for unknown sink '{sink}', skipping them.")
+                    down.add(sink)
+                    skipped.append(event_id)
+                    continue
+                try:
+                    func(event)
+                except Exception as e:
+                    down.add(sink)
+                    delay = min(max_delay, base_delay * 2**attempts) * random.uniform(0.5, 1.0)
+                    self.retry_later(event_id, delay, e)
+                    result["failed"] += 1
+                    continue
+                self.ack(event_id)
+                result["delivered"] += 1
+        finally:
+            # Skipped events are due again in the next round, here or in another process
+            self.release(skipped)
+        result["skipped"] = len(skipped)
+        return result
+
+    def close(self):
+        """ Close the spool database. """
+        with self._lock:
+            self._db.close()
+
+    def _size(self) -> int:
+        # Read from the database, other processes append to and replay from the same spool
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM events").fetchone()[0]
+
+    def _make_room(self, size: int):
+        excess = self._size() + size - self.max_bytes
+        if excess <= 0:
+            return
+        for event_id, event_size in self._db.execute("SELECT id, size FROM events ORDER BY id").fetchall():
+            self._db.execute("DELETE FROM events WHERE id = ?", (event_id,))
+            self.dropped += 1
+            excess -= event_size
+            if excess <= 0:
+                return
+
+
+def _without_api_key(event):
+    """ The event without its 'api_key', which should not be written to disk in plaintext. """
+    data = event.event if isinstance(event, EncodedEvent) else event
+    if isinstance(data, dict) and "api_key" in data:
+        return {key: value for key, value in data.items() if key != "api_key"}
+    return event
+
+
+class SpoolReplayer:
+    """ A background thread that replays due events from a spool every 'interval' seconds. """
+
+    def __init__(self, spool: Spool, interval: float = 5.0, base_delay: float = 1.0, max_delay: float = 300.0):
+        self.spool = spool
+        self.interval = interval
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="wonkalytics-spool-replayer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """ Stop replaying, events stay in the spool. """
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                # Keep going while full pages are delivered, so a recovered sink drains quickly
+                while not self._stop.is_set():
+                    result = self.spool.replay(base_delay=self.base_delay, max_delay=self.max_delay)
+                    if result["delivered"] < 100:
+                        break
+            except Exception as e:
+                logging.warning(f"Wonkalytics spool replay failed: {e}")
+
+
+_spool = LazySingleton(lambda: get_config().spool, lambda: enable_spool())
+# The replayer of the active spool, replaced together with it under _spool.lock
+_replayer = None
+_atexit_registered = False
+
+
+def default_spool_path() -> str:
+    """ The spool location, WONKALYTICS_SPOOL_PATH (see config.Config.spool_path) or ~/.cache/wonkalytics/spool.db. """
+    return get_config().spool_path or os.path.join(os.path.expanduser("~"), ".cache", "wonkalytics", "spool.db")
+
+
+def enable_spool(path: str = None, max_bytes: int = 256 * 1024 * 1024, fsync: str = "normal", replay_interval: float = 5.0, max_delay: float = 300.0) -> Spool:
+    """
+    Store events that could not be delivered to Azure SQL or PromptLayer on disk and replay them in the background.
+
+    Args:
+        path (str, optional): Path of the spool database, defaults to default_spool_path().
+        max_bytes (int): Maximum total size of the spooled events, the oldest are dropped beyond it.
+        fsync (str): One of 'always', 'normal' or 'off', see FSYNC_POLICIES.
+        replay_interval (float): Seconds between replay rounds.
+        max_delay (float): Maximum backoff in seconds for an event that keeps failing.
+
+    Returns:
+        Spool: The active spool.
+    """
+    global _replayer, _atexit_registered
+    disable_spool()
+    with _spool.lock:
+        spool = Spool(path or default_spool_path(), max_bytes, fsync)
+        _spool.set(spool)
+        _replayer = SpoolReplayer(spool, replay_interval, max_delay=max_delay)
+        if not _atexit_registered:
+            atexit.register(disable_spool)
+            _atexit_registered = True
+        return spool
+
+
+def disable_spool():
+    """ Stop the replayer and close the spool. Spooled events are kept on disk for the next start. """
+    global _replayer
+    with _spool.lock:
+        spool = _spool.clear()
+        replayer, _replayer = _replayer, None
+    if replayer is not None:
+        replayer.stop()
+    if spool is not None:
+        spool.close()
+
+
+def get_spool():
+    """
+    Returns the active spool, or None when spooling is disabled.
+
+    Spooling can also be enabled by setting the WONKALYTICS_SPOOL environment variable to 1,
+    unless it was disabled with disable_spool.
+    """
+    return _spool.get()
+
+
+def spool_failed_event(sink: str, event, error: Exception) -> bool:
+    """
+    Spool an event whose delivery failed with a retryable error.
+
+    Returns:
+        bool: True if the event was spooled, False if spooling is disabled or the error is not retryable.
+    """
+    spool = get_spool()
+    if spool is None or not is_retryable_error(error):
+        return False
+    spool.append(sink, event, error)
+    return True
+
+
+def main(argv=None):
+    """ Inspect and replay the spool: python -m wonkalytics.spool {stats,list,replay,purge}. """
+    parser = argparse.ArgumentParser(prog="python -m wonkalytics.spool", description=main.__doc__)
+    parser.add_argument("--path", default=default_spool_path(), help="Path of the spool database.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="Show the number of spooled events per sink.")
+    list_parser = commands.add_parser("list", help="Show the oldest spooled events.")
+    list_parser.add_argument("--limit", type=int, default=20)
+    replay_parser = commands.add_parser("replay", help="Deliver all spooled events now, ignoring their backoff.")
+    replay_parser.add_argument("--limit", type=int, default=1000)
+    purge_parser = commands.add_parser("purge", help="Delete spooled events.")
+    purge_parser.add_argument("--sink", default=None)
+    args = parser.parse_args(argv)
+
+    # Importing analytics registers the sql and promptlayer sinks
+    from . import analytics  # noqa: F401
+
+    spool = Spool(args.path)
+    if args.command == "stats":
+        print(json.dumps(spool.stats(), indent=2))
+    elif args.command == "list":
+        for event in spool.list(args.limit):
+            print(json.dumps(event))
+    elif args.command == "replay":
+        spool.reset_backoff()
+        print(json.dumps(spool.replay(limit=args.limit)))
+    elif args.command == "purge":
+        print(f"Deleted {spool.purge(args.sink)} events.")
+    spool.close()
+
+
+if __name__ == "__main__":
+    # The sinks register on the imported wonkalytics.spool, not on this __main__ copy of the module
+    from wonkalytics.spool import main as spool_main
+
+    sys.exit(spool_main())
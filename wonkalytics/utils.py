@@ -1,13 +1,11 @@
-import asyncio
 import datetime
-import functools
-import requests
 import sys
+import time
 from .analytics import wonkalytics_and_promptlayer_api_request
+from .async_analytics import queue_analytics_request, run_in_sql_executor, submit_analytics_request
 from .generator_wrapper import GeneratorWrapper
 import wonkalytics.openai_wrapper  as openai_wrapper
 import types
-import contextvars
 
 def get_api_key():
     """ Get the API key from openai_wrapper, raise an error if not set. """
@@ -15,26 +13,88 @@ def get_api_key():
         raise ValueError("PROMPTLAYER_API_KEY not set in openai_wrapper.")
     return openai_wrapper.api_key
 
-def wonkalytics_api_handler(function_name, provider_type, args, kwargs, tags,request, response, request_start_time, request_end_time, api_key, return_pl_id=False):
+def end_time_now(request_start_time, request_started=None):
+    """
+    Returns the end time of a request that is still being handled, as a timestamp.
+
+    'request_started' is the time.perf_counter() taken with 'request_start_time', the duration is then
+    measured with the monotonic clock, so it is not skewed when the wall clock is adjusted.
+    """
+    if request_started is None:
+        return datetime.datetime.now().timestamp()
+    return request_start_time + (time.perf_counter() - request_started)
+
+def wonkalytics_api_handler(function_name, provider_type, args, kwargs, tags,request, response, request_start_time, request_end_time, api_key, return_pl_id=False, metadata=None, request_started=None):
     """ Handle API requests for both generators and regular responses. """
     if isinstance(response, (types.GeneratorType, types.AsyncGeneratorType)) or type(response).__name__ in ["Stream", "AsyncStream"]:
         return GeneratorWrapper(response, {
             "function_name": function_name, "provider_type": provider_type, "request": request, "args": args, "kwargs": kwargs, "tags": tags, 
             "request_start_time": request_start_time, "request_end_time": request_end_time, "return_pl_id": return_pl_id,
+            "metadata": metadata, "request_started": request_started,
+        })
+    else:
+        request_id = wonkalytics_and_promptlayer_api_request(function_name, provider_type, args, kwargs, tags,request, response, request_start_time, request_end_time, api_key, return_pl_id, metadata=metadata)
+        return (response, request_id) if return_pl_id else response
+
+def async_wonkalytics_api_handler(function_name, provider_type, args, kwargs, tags,request, response, request_start_time, request_end_time, api_key, return_pl_id=False, metadata=None, request_started=None):
+    """ Handle API responses of async calls, logging never blocks the event loop. """
+    if isinstance(response, (types.GeneratorType, types.AsyncGeneratorType)) or type(response).__name__ in ["Stream", "AsyncStream"]:
+        return GeneratorWrapper(response, {
+            "function_name": function_name, "provider_type": provider_type, "request": request, "args": args, "kwargs": kwargs, "tags": tags,
+            "request_start_time": request_start_time, "request_end_time": request_end_time, "return_pl_id": return_pl_id,
+            "metadata": metadata, "request_started": request_started,
         })
     else:
-        request_id = wonkalytics_and_promptlayer_api_request(function_name, provider_type, args, kwargs, tags,request, response, request_start_time, request_end_time, api_key, return_pl_id)
+        request_id = submit_analytics_request(function_name, provider_type, args, kwargs, tags,request, response, request_start_time, request_end_time, api_key, return_pl_id, metadata=metadata)
         return (response, request_id) if return_pl_id else response
 
+def error_metadata(error: Exception) -> dict:
+    """ The metadata of a call the API raised an error for, e.g. a 429 or a timeout. """
+    metadata = {"error_type": type(error).__name__, "error_message": str(error)}
+    status = getattr(error, "http_status", None) or getattr(error, "status_code", None)
+    if status is not None:
+        metadata["error_status"] = status
+    return metadata
+
+
+def log_failed_call(function_name, provider_type, args, kwargs, tags, request, error, request_start_time, return_pl_id=False, is_async=False, request_started=None):
+    """
+    Log a call the API raised an error for, the caller re-raises it. Errors are always logged, see SamplingPolicy.
+
+    The event is only queued (see async_analytics.queue_analytics_request), so the error is re-raised
+    without waiting for PromptLayer or Azure SQL. Logging never raises, so the caller gets the API's error
+    rather than one of Wonkalytics.
+    """
+    try:
+        end_time = end_time_now(request_start_time, request_started)
+        log = submit_analytics_request if is_async else queue_analytics_request
+        log(function_name, provider_type, args, kwargs, tags, request, None, request_start_time, end_time, get_api_key(), return_pl_id, metadata=error_metadata(error))
+    except Exception as e:
+        print(f"WARNING: While logging your failed request Wonkalytics had the following error: {e}", file=sys.stderr)
+
+
 async def run_async(func, *args, **kwargs):
-    """ Run the given function in an asynchronous thread. """
-    loop = asyncio.get_running_loop()
-    context = contextvars.copy_context()
-    return await loop.run_in_executor(None, functools.partial(context.run, func, *args, **kwargs))
+    """ Run the given function in a thread of the dedicated Wonkalytics executor. """
+    return await run_in_sql_executor(func, *args, **kwargs)
 
 
-async def async_wrapper(coroutine_obj, return_pl_id, request_start_time, function_name, provider_type, tags, request, *args, **kwargs):
+async def async_wrapper(coroutine_obj, return_pl_id, request_start_time, request_started, function_name, provider_type, tags, request, *args, **kwargs):
     """ Async wrapper for handling coroutine objects and logging. """
-    response = await coroutine_obj
-    request_end_time = datetime.datetime.now().timestamp()
-    return await run_async(wonkalytics_api_handler, function_name, provider_type, args, kwargs, tags, request, response, request_start_time, request_end_time, get_api_key(), return_pl_id)
+    try:
+        response = await coroutine_obj
+    except Exception as e:
+        log_failed_call(function_name, provider_type, args, kwargs, tags, request, e, request_start_time, return_pl_id, is_async=True, request_started=request_started)
+        raise
+    end_time = end_time_now(request_start_time, request_started)
+    return async_wonkalytics_api_handler(function_name, provider_type, args, kwargs, tags, request, response, request_start_time, end_time, get_api_key(), return_pl_id, request_started=request_started)
+
+
+async def async_cached_wrapper(cached_call, return_pl_id, request_start_time, request_started, function_name, provider_type, tags, request, args, kwargs):
+    """ Async wrapper for calls served through the response cache (see ResponseCache.call), the response is logged with 'cache_hit'. """
+    try:
+        response, cache_hit = await cached_call
+    except Exception as e:
+        log_failed_call(function_name, provider_type, args, kwargs, tags, request, e, request_start_time, return_pl_id, is_async=True, request_started=request_started)
+        raise
+    end_time = end_time_now(request_start_time, request_started)
+    return async_wonkalytics_api_handler(function_name, provider_type, args, kwargs, tags, request, response, request_start_time, end_time, get_api_key(), return_pl_id, metadata={"cache_hit": cache_hit}, request_started=request_started)